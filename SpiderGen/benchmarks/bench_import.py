@@ -0,0 +1,68 @@
+'''
+Cold-start benchmark of the generation-only path: importing spidergen and ModelManager and registering the models
+from config.py, which are loaded lazily on first use. Each scenario runs in a fresh interpreter with -X importtime.
+Run from the SpiderGen folder with:
+    python -m benchmarks.bench_import --repeat 5
+'''
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+GENERATION = '''
+from config import model_config
+from utils.model_manager import ModelManager
+from procedure_generation.spidergen import spidergen
+model_manager = ModelManager()
+model_manager.create_model_environ(sources=model_config['sources'], model_names=model_config['model_names'], roles=model_config['roles'])
+'''
+
+SCENARIOS = dict({
+    'interpreter': 'pass',
+    'generation': GENERATION,
+    # the clustering and plotting libraries that were imported with spidergen_utils before they were made lazy
+    'generation_with_clustering_and_plotting': GENERATION + '''
+import sklearn.cluster, sklearn.metrics, scipy.cluster.hierarchy, threadpoolctl
+import networkx, matplotlib.pyplot
+''',
+})
+
+HEAVY_MODULES = ['numpy', 'sklearn', 'scipy', 'networkx', 'matplotlib', 'threadpoolctl', 'openai', 'anthropic', 'sentence_transformers', 'torch']
+
+def parse_importtime(stderr):
+    '''
+    returns the cumulative import time in microseconds of each top level import in the -X importtime output
+    '''
+    imports = dict({})
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # top level imports are the ones which are not indented
+        if not name.startswith('  '):
+            imports[name.strip()] = int(cumulative)
+    return imports
+
+def run_scenario(code, repeat, top):
+    code += '\nimport sys\nprint(",".join(m for m in %r if m in sys.modules))' % HEAVY_MODULES
+    seconds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, check=True)
+        seconds.append(time.perf_counter() - started)
+    imports = parse_importtime(process.stderr)
+    return dict({
+        'seconds': statistics.median(seconds),
+        'import_seconds': sum(imports.values()) / 1e6,
+        'heavy_modules_loaded': [module for module in process.stdout.strip().split(',') if module],
+        'slowest_imports': dict(sorted(imports.items(), key=lambda item: -item[1])[:top]),
+    })
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help='number of fresh interpreters started for each scenario, the median is reported')
+    parser.add_argument('--top', type=int, default=10, help='number of slowest top level imports reported')
+    args = parser.parse_args()
+    print(json.dumps({name: run_scenario(code, args.repeat, args.top) for name, code in SCENARIOS.items()}, indent=2))
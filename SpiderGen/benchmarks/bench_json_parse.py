@@ -0,0 +1,108 @@
+'''
+Micro-benchmark of safe_json_load against the previous regex and literal_eval chain on large LLM responses.
+Run from the SpiderGen folder with:
+    python -m benchmarks.bench_json_parse --products 50 --repeat 20
+'''
+import re
+import ast
+import json
+import time
+import argparse
+from utils.model_manager import safe_json_load
+
+def legacy_safe_json_load(response_content):
+    '''
+    the parsing chain used by safe_json_load before the single pass parser, kept as the benchmark baseline
+    '''
+    response_content = re.sub(r"^```[a-zA-Z]*\n?", "", response_content.strip())
+    response_content = re.sub(r"```$", "", response_content.strip())
+    if '{' in response_content:
+        start = response_content.find('{')
+        brace_count = 0
+        end = start
+        for i in range(start, len(response_content)):
+            if response_content[i] == '{':
+                brace_count += 1
+            elif response_content[i] == '}':
+                brace_count -= 1
+                if brace_count == 0:
+                    end = i + 1
+                    break
+        if end > start:
+            response_content = response_content[start:end]
+    try:
+        return ast.literal_eval(response_content)
+    except Exception:
+        pass
+    try:
+        return json.loads(response_content)
+    except Exception:
+        pass
+    fixed_val = (
+        response_content
+        .replace(" None", " null")
+        .replace(" True", " true")
+        .replace(" False", " false")
+    )
+    fixed_val = re.sub(r',(\s*[}\]])', r'\1', fixed_val)
+    fixed_val = re.sub(r"(?<=\{|,)\s*'([^']+)'\s*:", lambda m: f'"{m.group(1)}":', fixed_val)
+    fixed_val = re.sub(r"'([^']*)'", lambda m: '"' + m.group(1).replace('"', '\\"') + '"', fixed_val)
+    try:
+        return json.loads(fixed_val)
+    except Exception:
+        return {}
+
+def make_response(n_processes, style):
+    '''
+    builds a product template response with n_processes processes in each life cycle module
+
+    style: 'json' for well formed JSON, 'python' for a Python literal, or 'lenient' for JSON with code fences and trailing commas
+    '''
+    modules = ['A1', 'A2', 'A3', 'A4', 'A5', 'B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'C1', 'C2', 'C3', 'C4']
+    template = dict({'processes': dict({})})
+    for module in modules:
+        template['processes'][f'{module} Processes'] = {
+            f'{module} process {i}': dict({
+                'description': f'Description of process {i} of module {module}, including materials and energy used. ' * 3,
+                'rationale': f'Process {i} is included because it is required by the EN 15804 module {module}.',
+                'link': f'https://example.com/{module}/{i}',
+                'applicable': True,
+            })
+            for i in range(n_processes)
+        }
+    if style == 'python':
+        return repr(template)
+    text = json.dumps(template, indent=4)
+    if style == 'lenient':
+        text = '```json\n' + text.replace('\n        }', ',\n        }') + '\n```'
+    return text
+
+def time_parser(parser, text, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = parser(text)
+    return (time.perf_counter() - start) / repeat, result
+
+def run(n_processes, repeat):
+    results = []
+    for style in ['json', 'python', 'lenient']:
+        text = make_response(n_processes, style)
+        legacy_time, legacy_result = time_parser(legacy_safe_json_load, text, repeat)
+        new_time, new_result = time_parser(safe_json_load, text, repeat)
+        results.append(dict({
+            'style': style,
+            'response_bytes': len(text.encode('utf-8')),
+            'legacy_seconds': legacy_time,
+            'safe_json_load_seconds': new_time,
+            'speedup': legacy_time / new_time if new_time > 0 else None,
+            'legacy_parsed': legacy_result != {},
+            'safe_json_load_parsed': new_result != {},
+        }))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=50, help='number of processes in each life cycle module')
+    parser.add_argument('--repeat', type=int, default=20, help='number of times each response is parsed')
+    args = parser.parse_args()
+    print(json.dumps(run(args.products, args.repeat), indent=2))
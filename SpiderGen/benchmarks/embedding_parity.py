@@ -0,0 +1,83 @@
+'''
+Parity check of an embedding source against the fp32 sentence transformer: the processes of the same product templates
+are embedded and clustered with both models, and the cluster assignments of each life cycle module are compared with
+the adjusted Rand index. Exits with status 1 if any module falls below --min-ari.
+Run from the SpiderGen folder with:
+    python -m benchmarks.embedding_parity --candidate onnx_int8 --traces traces/spidergen/Chairs
+
+Without --traces, synthetic product templates are used.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from utils.model_manager import ModelManager
+from utils.fake_llm import synthetic_product_templates
+from procedure_generation.spidergen_utils import (LIFE_CYCLE_MODULES, collect_processes, embed_processes, module_clustering_job,
+                                                  get_k_means_clustering)
+
+def load_trace_templates(trace_folder):
+    '''
+    returns the sample product templates checkpointed in the trace folder of a product category
+    '''
+    templates_folder = os.path.join(trace_folder, 'sample_products_templates')
+    templates = dict({})
+    for product in sorted(os.listdir(templates_folder)):
+        path = os.path.join(templates_folder, product, 'checkpoint.json')
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                templates[product] = json.load(f)['artifact']
+    return templates
+
+def module_assignments(processes, embeddings, clustering_method):
+    '''
+    returns the cluster label of each process name of each module
+    '''
+    assignments = dict({})
+    for module in LIFE_CYCLE_MODULES:
+        encoded_processes, processes_dict, all_processes, sample_weight = module_clustering_job(processes, embeddings, module)
+        clusters = get_k_means_clustering(encoded_processes, processes_dict, all_processes, method=clustering_method, sample_weight=sample_weight)
+        labels = {process: cluster_id for cluster_id, cluster_processes in clusters.items() for process in cluster_processes}
+        assignments[module] = [labels[process] for process in all_processes]
+    return assignments
+
+def run(model_name, reference_source, candidate_source, product_templates, clustering_method):
+    from sklearn.metrics import adjusted_rand_score
+    processes = collect_processes(product_templates)
+    model_manager = ModelManager()
+    model_manager.create_model_environ([reference_source, candidate_source], [model_name, model_name], ['reference', 'candidate'])
+    report = dict({'model_name': model_name, 'reference': reference_source, 'candidate': candidate_source})
+    embeddings = dict({})
+    for role in ['reference', 'candidate']:
+        # the first call loads the model, so it is timed separately from the embedding of the processes
+        model_manager.models[role].encode(['warm up'])
+        started = time.perf_counter()
+        embeddings[role] = embed_processes(processes, model_manager.models[role])
+        report[f'{role}_encode_seconds'] = time.perf_counter() - started
+    cosine = np.sum(embeddings['reference'] * embeddings['candidate'], axis=1)
+    report['cosine_similarity'] = dict({'mean': float(cosine.mean()), 'min': float(cosine.min())})
+    reference = module_assignments(processes, embeddings['reference'], clustering_method)
+    candidate = module_assignments(processes, embeddings['candidate'], clustering_method)
+    report['adjusted_rand_index'] = {module: float(adjusted_rand_score(reference[module], candidate[module]))
+                                     for module in LIFE_CYCLE_MODULES if len(reference[module]) > 0}
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model-name', default='all-mpnet-base-v2')
+    parser.add_argument('--reference', default='sentence_transformer', help='source of the reference embeddings')
+    parser.add_argument('--candidate', default='onnx_int8', help='source of the embeddings checked against the reference')
+    parser.add_argument('--traces', default=None, help='trace folder of a product category to take the product templates from')
+    parser.add_argument('--products', type=int, default=50, help='number of synthetic product templates, if --traces is not set')
+    parser.add_argument('--clustering-method', default='kmeans', choices=['kmeans', 'agglomerative'])
+    parser.add_argument('--min-ari', type=float, default=0.9, help='lowest adjusted Rand index of a module that passes')
+    args = parser.parse_args()
+    templates = load_trace_templates(args.traces) if args.traces else synthetic_product_templates(args.products)
+    report = run(args.model_name, args.reference, args.candidate, templates, args.clustering_method)
+    print(json.dumps(report, indent=2))
+    failed = [module for module, score in report['adjusted_rand_index'].items() if score < args.min_ari]
+    if failed:
+        print(f'cluster assignments of {failed} differ from the reference (adjusted Rand index below {args.min_ari})', file=sys.stderr)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,174 @@
+'''
+Offline benchmark suite of SpiderGen, run with the fake LLM and embedding models so that no API keys are needed.
+Each benchmark is run for every size (number of sample products) and reports its median wall time, throughput and peak
+traced memory as JSON. Run from the SpiderGen folder with:
+    python -m benchmarks.run_benchmarks --sizes 5 50 500 5000 --output results.json
+
+and check for regressions against a previous result, exiting with status 1 if any benchmark is slower or uses more
+memory than the baseline by more than the tolerance:
+    python -m benchmarks.run_benchmarks --output results.json --baseline baseline.json --tolerance 0.25
+'''
+import sys
+import json
+import time
+import platform
+import argparse
+import statistics
+import tracemalloc
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+from utils.model_manager import ModelManager, safe_json_load
+from utils.fake_llm import FakeLLM, FakeEmbedding, SyntheticResponder, synthetic_product_templates, synthetic_pfg
+from utils.instrumentation import get_tracer
+from procedure_generation.spidergen import spidergen
+from procedure_generation.pfg_render import render_svg
+from procedure_generation.spidergen_utils import (get_clusters_summary, get_k_means_clustering, collect_processes,
+                                                  embed_processes, module_clustering_job, visualize_process_flow)
+
+BENCHMARKS = ['safe_json_load', 'get_k_means_clustering', 'get_clusters_summary', 'visualize_process_flow', 'render_svg', 'spidergen']
+
+def name_variety(size):
+    '''
+    returns the name variety of the synthetic templates of size products, so the number of distinct process names grows with size
+    '''
+    return max(1, size // 10)
+
+def measure(function, repeat):
+    '''
+    runs function repeat times, then once more under tracemalloc
+
+    returns the median wall time in seconds and the peak traced memory in bytes
+    '''
+    seconds = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - started)
+        # spans of the instrumented functions would otherwise pile up across runs
+        get_tracer().clear()
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        get_tracer().clear()
+    return statistics.median(seconds), peak
+
+def setup_safe_json_load(size, args):
+    text = json.dumps(synthetic_product_templates(size, name_variety=name_variety(size)))
+    return lambda: safe_json_load(text), len(text.encode('utf-8')), 'bytes'
+
+def setup_get_k_means_clustering(size, args):
+    processes = collect_processes(synthetic_product_templates(size, name_variety=name_variety(size)))
+    embeddings = embed_processes(processes, FakeEmbedding())
+    encoded_processes, processes_dict, all_processes, sample_weight = module_clustering_job(processes, embeddings, 'A1')
+    return (lambda: get_k_means_clustering(encoded_processes, processes_dict, all_processes, method=args.clustering_method, sample_weight=sample_weight),
+            len(all_processes), 'processes')
+
+def setup_get_clusters_summary(size, args):
+    templates = synthetic_product_templates(size, name_variety=name_variety(size))
+    transformer_model = FakeEmbedding()
+    return lambda: get_clusters_summary(templates, transformer_model, clustering_method=args.clustering_method), size, 'products'
+
+def setup_visualize_process_flow(size, args):
+    # drawing thousands of processes with matplotlib is slow, so large sizes are capped
+    pfg = synthetic_pfg(min(size, args.max_pfg_processes))
+
+    def render():
+        fig, _ = visualize_process_flow(pfg)
+        plt.close(fig)
+    return render, len(pfg['processes']), 'processes'
+
+def setup_render_svg(size, args):
+    # the layered layout and SVG emitter are not capped, unlike the matplotlib rendering
+    pfg = synthetic_pfg(size)
+    return lambda: render_svg(pfg), size, 'processes'
+
+def setup_spidergen(size, args):
+    model_manager = ModelManager()
+    responder = SyntheticResponder(name_variety=name_variety(size))
+    model_manager.register_model('llm', 'fake', 'fake', FakeLLM(responder, latency=args.latency))
+    model_manager.register_model('embedding_transformer', 'fake_embedding', 'fake_embedding', FakeEmbedding())
+    return (lambda: spidergen('Benchmark products', 'Synthetic products of the offline benchmark', size, model_manager,
+                              trace=False, max_concurrency=args.concurrency, clustering_method=args.clustering_method),
+            size, 'products')
+
+SETUPS = dict({
+    'safe_json_load': setup_safe_json_load,
+    'get_k_means_clustering': setup_get_k_means_clustering,
+    'get_clusters_summary': setup_get_clusters_summary,
+    'visualize_process_flow': setup_visualize_process_flow,
+    'render_svg': setup_render_svg,
+    'spidergen': setup_spidergen,
+})
+
+def run(benchmarks, sizes, args):
+    results = []
+    for benchmark in benchmarks:
+        for size in sizes:
+            function, units, unit = SETUPS[benchmark](size, args)
+            seconds, peak = measure(function, args.repeat)
+            results.append(dict({
+                'benchmark': benchmark,
+                'size': size,
+                'seconds': seconds,
+                'throughput': units / seconds if seconds > 0 else None,
+                'unit': f'{unit}/s',
+                'peak_memory_bytes': peak,
+            }))
+            print(f'{benchmark:<24} size {size:>5}: {seconds:.4f}s, {units / max(seconds, 1e-12):.1f} {unit}/s, peak {peak / 2**20:.1f} MiB', file=sys.stderr)
+    return results
+
+def find_regressions(results, baseline, tolerance):
+    '''
+    returns a description of every result whose time or peak memory exceeds its baseline by more than tolerance
+    '''
+    baseline_results = {(result['benchmark'], result['size']): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        previous = baseline_results.get((result['benchmark'], result['size']))
+        if previous is None:
+            continue
+        for metric in ['seconds', 'peak_memory_bytes']:
+            if previous[metric] and result[metric] > previous[metric] * (1 + tolerance):
+                regressions.append(f"{result['benchmark']} size {result['size']}: {metric} {previous[metric]:.4g} -> {result[metric]:.4g}")
+    return regressions
+
+def environment():
+    return dict({
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'numpy': np.__version__,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    })
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5, 50, 500, 5000], help='numbers of sample products')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=BENCHMARKS, help='benchmarks to run')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs of each benchmark, the median is reported')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the fake LLM waits before each response')
+    parser.add_argument('--concurrency', type=int, default=8, help='number of sample product templates generated at once by spidergen')
+    parser.add_argument('--clustering-method', default='kmeans', choices=['kmeans', 'agglomerative'])
+    parser.add_argument('--max-pfg-processes', type=int, default=200, help='largest PFG rendered by visualize_process_flow')
+    parser.add_argument('--output', default=None, help='JSON file the results are written to, instead of stdout')
+    parser.add_argument('--baseline', default=None, help='JSON results of a previous run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative increase of time or memory over the baseline that is a regression')
+    args = parser.parse_args()
+
+    report = dict({'environment': environment(), 'config': vars(args), 'results': run(args.only, args.sizes, args)})
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = find_regressions(report['results'], json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'regression: {regression}', file=sys.stderr)
+        sys.exit(1 if regressions else 0)
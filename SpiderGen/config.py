@@ -2,8 +2,39 @@
 # specifically, select a sentence transformer, and a large langugage model 
 anthropic_api_key = 'blank'
 openai_api_key = ''
+# optional endpoints for OpenAI or Anthropic compatible servers, None uses the default endpoint
+openai_base_url = None
+anthropic_base_url = None
+# endpoint and settings of the 'local' LLM source, an OpenAI-compatible inference server such as vLLM, llama.cpp or Ollama
+local_llm_base_url = 'http://localhost:8000/v1'
+local_llm_config = dict({
+    'batching': True,              # coalesce concurrent prompts into batched /v1/completions requests
+    'max_batch_size': 8,           # prompts per request
+    'max_wait': 0.01,              # seconds to wait for more prompts before a batch is sent
+    'pool_size': 16,               # connections kept open to the server
+    'max_tokens': 4096,
+    'prompt_format': '{prompt}',   # batched prompts skip the chat template of the model, which can be applied here
+})
 model_config = dict({
     'roles': ['embedding_transformer', 'llm'],
     'model_names': ['all-mpnet-base-v2', 'o3'],
     'sources': ['sentence_transformer', 'openai']
-})
\ No newline at end of file
+})
+# settings of the 'onnx' and 'onnx_int8' embedding sources, which run an ONNX export of the sentence transformer on CPU
+onnx_embedding_config = dict({
+    'folder': None,            # folder of the exported models, None uses ./models/onnx/<model name>
+    'batch_size': 64,          # sentences per inference call
+    'intra_op_threads': None,  # threads per operator, None uses every core
+})
+# per-provider limits shared by every request in the process, None disables a limit
+# expected_output_tokens sets the output tokens reserved per request until responses report their usage
+rate_limits = dict({
+    'openai': dict({'requests_per_minute': 500, 'tokens_per_minute': 200000, 'max_concurrency': 16}),
+    'anthropic': dict({'requests_per_minute': 50, 'tokens_per_minute': 80000, 'max_concurrency': 8}),
+    'local': dict({'requests_per_minute': None, 'tokens_per_minute': None, 'max_concurrency': 32}),
+})
+# optional prices in dollars per million tokens, by model name, used to report the cost of each LLM call, i.e
+# token_prices = dict({'o3': dict({'input': 2.0, 'cached_input': 0.5, 'output': 8.0})})
+# anthropic models can also set 'cache_write_input', the price of tokens written to the prompt cache
+# and 'batch' is the fraction of the price charged for batch API requests, 0.5 by default
+token_prices = dict({})
@@ -0,0 +1,78 @@
+'''
+Selection of the number of clusters for the processes of a life cycle module.
+Each candidate number of clusters is fitted exactly once and scored with the Davies-Bouldin index,
+and the labels of the winning partition are returned directly instead of refitting it.
+'''
+import numpy as np
+
+CLUSTERING_METHODS = ['kmeans', 'agglomerative']
+
+def candidate_cluster_counts(processes_dict, n_samples):
+    '''
+    determines the search space for the number of clusters - at least the minimum number of processes, and at most the maximum number of processes for each sample product
+
+    processes_dict: dictionary of processes for all sample products
+    n_samples: number of processes that will be clustered
+
+    returns a sorted list of candidate numbers of clusters
+    '''
+    nums = [len(processes_dict[item]) for item in processes_dict]
+    # if the average number of processes in each product is 1 or less, we set the number of clusters to 1
+    if len(nums) == 0 or int(np.floor(np.mean(np.array(nums)))) <= 1:
+        return [1]
+    # a single cluster cannot be scored, and there cannot be more clusters than processes
+    candidates = [k for k in range(max(min(nums), 2), max(nums) + 1) if k <= n_samples]
+    return candidates if len(candidates) > 0 else [min(max(nums), n_samples)]
+
+# sklearn and scipy are imported on the first clustering rather than with the module, so that runs which never cluster start faster
+def _kmeans_partitions(encoded_processes, candidate_ks, sample_weight):
+    from sklearn.cluster import KMeans
+    for k in candidate_ks:
+        clustering_model = KMeans(n_clusters=k, random_state=0)
+        yield k, clustering_model.fit_predict(encoded_processes, sample_weight=sample_weight)
+
+def _agglomerative_partitions(encoded_processes, candidate_ks):
+    from scipy.cluster.hierarchy import linkage, fcluster
+    # a single ward linkage gives the partitions for every number of clusters by cutting the dendrogram
+    tree = linkage(encoded_processes, method='ward')
+    for k in candidate_ks:
+        yield k, fcluster(tree, t=k, criterion='maxclust') - 1
+
+def select_clusters(encoded_processes, candidate_ks, method='kmeans', sample_weight=None):
+    '''
+    fits every candidate number of clusters once and selects the one with the lowest davies bouldin score
+
+    encoded_processes: encoded processes to cluster
+    candidate_ks: candidate numbers of clusters
+    method: either 'kmeans', which fits each candidate independently, or 'agglomerative', which derives every candidate from a single dendrogram
+    sample_weight: optional weight of each process, used by the 'kmeans' fit (the davies bouldin score and the dendrogram are unweighted)
+
+    returns a dictionary with the selected number of clusters 'k', its cluster 'labels' and the davies bouldin 'scores' of each scored candidate
+    '''
+    if method not in CLUSTERING_METHODS:
+        raise ValueError(f"Unknown clustering method '{method}'")
+    n_samples = len(encoded_processes)
+    if n_samples <= 1 or list(candidate_ks) == [1]:
+        return dict({'k': 1, 'labels': np.zeros(n_samples, dtype=int), 'scores': dict({})})
+
+    if method == 'kmeans':
+        partitions = _kmeans_partitions(encoded_processes, candidate_ks, sample_weight)
+    else:
+        partitions = _agglomerative_partitions(encoded_processes, candidate_ks)
+
+    from sklearn.metrics import davies_bouldin_score
+    scores = dict({})
+    best = None
+    fallback = None
+    for k, labels in partitions:
+        n_labels = len(np.unique(labels))
+        # the davies bouldin index is only defined for 2 to n_samples - 1 clusters
+        if n_labels < 2 or n_labels >= n_samples:
+            fallback = fallback or (k, labels)
+            continue
+        scores[k] = float(davies_bouldin_score(encoded_processes, labels))
+        if best is None or scores[k] < scores[best[0]]:
+            best = (k, labels)
+    if best is None:
+        best = fallback
+    return dict({'k': best[0], 'labels': np.asarray(best[1]), 'scores': scores})
@@ -0,0 +1,91 @@
+import math
+import numpy as np
+'''
+Compact serialization of the process clusters of each life cycle module for the final PFG prompt.
+Each cluster is written as its medoid (the process most similar to the others), its number of occurrences across the sample
+products and a few of its other distinct names, so that the prompt grows with the number of clusters rather than with the
+number of sample products. Names are added to the clusters in turns until the estimated token budget is spent.
+'''
+
+# characters per token of the token estimate, a usual average for English text
+CHARACTERS_PER_TOKEN = 4
+
+def estimate_tokens(text):
+    '''
+    returns an estimate of the number of tokens of text
+    '''
+    return math.ceil(len(str(text)) / CHARACTERS_PER_TOKEN)
+
+def order_cluster(processes, embeddings, counts):
+    '''
+    orders the processes of a cluster with its medoid first, followed by the most frequent other processes
+
+    processes: distinct process names of the cluster
+    embeddings: normalized embeddings of processes
+    counts: number of occurrences of each process
+
+    returns the ordered processes
+    '''
+    if len(processes) <= 1:
+        return list(processes)
+    counts = np.asarray(counts, dtype=float)
+    # the medoid has the highest similarity to the other processes, weighted by how often they occur
+    medoid = int(np.argmax((embeddings @ embeddings.T) @ counts))
+    others = sorted((i for i in range(len(processes)) if i != medoid), key=lambda i: -counts[i])
+    return [processes[medoid]] + [processes[i] for i in others]
+
+def _cluster_line(number, processes, count, shown):
+    # repeated whitespace in generated names only costs tokens
+    processes = [' '.join(str(process).split()) for process in processes[:1 + shown]] + processes[1 + shown:]
+    line = f'{number}. {processes[0]} (x{count}'
+    if shown > 0:
+        line += '; also: ' + ', '.join(processes[1:1 + shown])
+    if len(processes) > 1 + shown:
+        line += f', +{len(processes) - 1 - shown} more' if shown > 0 else f'; +{len(processes) - 1} more'
+    return line + ')'
+
+def compact_cluster_summary(module_clusters, token_budget=4000, max_variants=5):
+    '''
+    writes the clusters of every module in a compact text format
+
+    module_clusters: dictionary of each module to a list of (ordered processes, number of occurrences) of each of its clusters,
+        with the processes ordered by order_cluster
+    token_budget: estimated number of tokens the summary should fit in, the medoid of every cluster is always included
+    max_variants: largest number of names shown for each cluster besides its medoid
+
+    returns the summary
+    '''
+    clusters = [(module, processes, count) for module, module_clusters in module_clusters.items() for processes, count in module_clusters]
+    shown = [0] * len(clusters)
+
+    def render():
+        lines = []
+        module = None
+        number = 0
+        for (cluster_module, processes, count), variants in zip(clusters, shown):
+            if cluster_module != module:
+                module = cluster_module
+                number = 0
+                lines.append(f'{module} Processes:')
+            number += 1
+            lines.append(_cluster_line(number, processes, count, variants))
+        return '\n'.join(lines)
+
+    budget = token_budget * CHARACTERS_PER_TOKEN
+    length = len(render())
+    # variants are added one per cluster in turns, so every cluster gets its first variants before any gets more
+    for _ in range(max_variants):
+        added = False
+        for i, (_, processes, count) in enumerate(clusters):
+            if shown[i] >= len(processes) - 1:
+                continue
+            before = len(_cluster_line(0, processes, count, shown[i]))
+            after = len(_cluster_line(0, processes, count, shown[i] + 1))
+            if length + after - before > budget:
+                continue
+            shown[i] += 1
+            length += after - before
+            added = True
+        if not added:
+            break
+    return render()
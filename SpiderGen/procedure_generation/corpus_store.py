@@ -0,0 +1,276 @@
+import os
+import json
+import time
+import sqlite3
+import argparse
+import threading
+import numpy as np
+from procedure_generation.spidergen_utils import LIFE_CYCLE_MODULES, canonicalize_process_name, collect_module_processes
+from procedure_generation.pfg_graph import CATEGORIES, as_pfg_graph
+from utils.embedding_cache import EmbeddingCache
+'''
+Persistent corpus of generated PFGs, for querying across many product categories without walking the trace folders.
+The final PFG, the clusters of each life cycle module and the sample product templates of a category are stored in SQLite,
+with every process name indexed by category, life cycle module and PFG stage. The process names are embedded once into a
+memory-mapped vector file, so that queries such as "every category whose C3 processes contain a process similar to X"
+scan the vectors with one matrix product and only read the matching rows from SQLite.
+Ingest the trace folders of previous runs from the SpiderGen folder with:
+    python -m procedure_generation.corpus_store --corpus corpus traces/spidergen/*
+'''
+
+# largest number of parameters in one SQLite statement, which is 999 on older versions
+MAX_SQL_PARAMETERS = 900
+
+def _cluster_pairs(clusters):
+    # clusters are checkpointed as [cluster id, processes] pairs, and returned by get_k_means_clustering as a dictionary
+    if isinstance(clusters, dict):
+        return list(clusters.items())
+    return [(cluster_id, processes) for cluster_id, processes in clusters or []]
+
+class CorpusStore:
+    '''
+    SQLite and memory-mapped vector store of the PFGs, clusters and sample product templates of many product categories.
+    Ingesting a category again replaces everything previously stored for it.
+    '''
+    def __init__(self, path, transformer_model, model_name):
+        '''
+        path: folder of the corpus
+        transformer_model: embedding model with a sentence transformers style encode method
+        model_name: identifier of the embedding model, the vectors of each model are stored separately
+        '''
+        self.path = path
+        self.transformer_model = transformer_model
+        os.makedirs(path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.embeddings = EmbeddingCache(os.path.join(path, 'embeddings'), model_name)
+        # process name of each row of the vectors, rebuilt when rows are added
+        self._row_names = []
+        self.connection = sqlite3.connect(os.path.join(path, 'corpus.sqlite'), check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # with the write-ahead log, NORMAL only risks losing the last ingested categories on a power loss, not corrupting the corpus
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(
+            'CREATE TABLE IF NOT EXISTS categories ('
+            'id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, description TEXT, pfg TEXT, updated REAL NOT NULL);'
+            'CREATE TABLE IF NOT EXISTS templates ('
+            'category_id INTEGER NOT NULL, product TEXT NOT NULL, template TEXT NOT NULL, PRIMARY KEY (category_id, product));'
+            'CREATE TABLE IF NOT EXISTS processes ('
+            'category_id INTEGER NOT NULL, source TEXT NOT NULL, module TEXT, stage TEXT, product TEXT, cluster_id INTEGER, '
+            'name TEXT NOT NULL, key TEXT NOT NULL);'
+            'CREATE INDEX IF NOT EXISTS processes_name ON processes (name, module);'
+            'CREATE INDEX IF NOT EXISTS processes_key ON processes (key, module);'
+            'CREATE INDEX IF NOT EXISTS processes_module ON processes (module, category_id);'
+            'CREATE INDEX IF NOT EXISTS processes_stage ON processes (stage, category_id);'
+            'CREATE INDEX IF NOT EXISTS processes_category ON processes (category_id, source);'
+        )
+        self.connection.commit()
+
+    def ingest(self, product_category_name, pfg, description=None, module_clusters=None, product_templates=None):
+        '''
+        stores the results of spidergen for a product category
+
+        product_category_name: name of the product category
+        pfg: final PFG of the category, or None
+        description: description of the product category
+        module_clusters: dictionary of the clusters of each life cycle module, as returned by get_k_means_clustering or checkpointed
+        product_templates: dictionary of the template of each sample product
+        '''
+        rows = []
+        if pfg:
+            graph = as_pfg_graph(pfg)
+            for i, name in enumerate(graph.names):
+                rows.append(('pfg', None, CATEGORIES[graph.categories[i]], None, None, name))
+        for module, clusters in (module_clusters or {}).items():
+            for cluster_id, processes in _cluster_pairs(clusters):
+                rows.extend(('cluster', module, None, None, int(cluster_id), process) for process in processes)
+        templates = {product: template for product, template in (product_templates or {}).items() if isinstance(template, dict)}
+        module_dicts, _ = collect_module_processes(templates)
+        for module in LIFE_CYCLE_MODULES:
+            for product, processes in module_dicts[module].items():
+                rows.extend(('template', module, None, product, None, process) for process in processes)
+
+        # the names are embedded before the rows are written, so every stored name has a vector
+        names = list(dict.fromkeys(row[-1] for row in rows))
+        if len(names) > 0:
+            self.embeddings.encode(self.transformer_model, names)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT INTO categories (name, description, pfg, updated) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (name) DO UPDATE SET description = COALESCE(excluded.description, description), pfg = excluded.pfg, updated = excluded.updated',
+                (product_category_name, description, json.dumps(pfg, ensure_ascii=False) if pfg else None, time.time())
+            )
+            category_id = self.connection.execute('SELECT id FROM categories WHERE name = ?', (product_category_name,)).fetchone()[0]
+            self.connection.execute('DELETE FROM processes WHERE category_id = ?', (category_id,))
+            self.connection.execute('DELETE FROM templates WHERE category_id = ?', (category_id,))
+            self.connection.executemany(
+                'INSERT INTO processes (category_id, source, module, stage, product, cluster_id, name, key) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(category_id, *row, canonicalize_process_name(row[-1])) for row in rows]
+            )
+            self.connection.executemany(
+                'INSERT INTO templates (category_id, product, template) VALUES (?, ?, ?)',
+                [(category_id, product, json.dumps(template, ensure_ascii=False)) for product, template in templates.items()]
+            )
+        return len(rows)
+
+    def ingest_trace_folder(self, trace_folder, product_category_name=None):
+        '''
+        stores the checkpoints of a product category traced by spidergen (i.e, ./traces/spidergen/Chairs)
+
+        product_category_name: name of the category, by default the name of the folder with underscores read as spaces
+
+        returns the number of process names stored, or None if the folder has no checkpoints
+        '''
+        def artifact(*path):
+            checkpoint = os.path.join(trace_folder, *path, 'checkpoint.json')
+            if not os.path.isfile(checkpoint):
+                return None
+            with open(checkpoint, 'r') as f:
+                return json.load(f).get('artifact')
+
+        pfg = artifact('final_pfg')
+        module_clusters = {module: artifact('clusters', module) for module in LIFE_CYCLE_MODULES}
+        module_clusters = {module: clusters for module, clusters in module_clusters.items() if clusters is not None}
+        templates_folder = os.path.join(trace_folder, 'sample_products_templates')
+        products = sorted(os.listdir(templates_folder)) if os.path.isdir(templates_folder) else []
+        product_templates = {product: artifact('sample_products_templates', product) for product in products}
+        if pfg is None and len(module_clusters) == 0 and not any(product_templates.values()):
+            return None
+        if product_category_name is None:
+            product_category_name = os.path.basename(os.path.normpath(trace_folder)).replace('_', ' ')
+        return self.ingest(product_category_name, pfg, module_clusters=module_clusters, product_templates=product_templates)
+
+    def _query(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def _filters(self, module=None, stage=None, source=None):
+        clauses, parameters = [], []
+        for column, value in [('p.module', module), ('p.stage', stage), ('p.source', source)]:
+            if value is not None:
+                clauses.append(f'{column} = ?')
+                parameters.append(value)
+        return clauses, parameters
+
+    def similar_processes(self, query, module=None, stage=None, source=None, threshold=0.8, limit=None):
+        '''
+        finds the stored processes whose name is similar to query
+
+        query: process name or description to search for
+        module: life cycle module (i.e, C3) the processes are in, or None for any module
+        stage: PFG stage (i.e, downstream) of the processes, or None for any stage
+        source: 'pfg', 'cluster' or 'template' to only search the processes of one origin
+        threshold: lowest cosine similarity of a match
+        limit: largest number of matches returned
+
+        returns a list of dictionaries with the 'category', 'source', 'module', 'stage', 'product', 'cluster_id',
+        'process' and 'similarity' of each match, most similar first
+        '''
+        encoded = np.asarray(self.transformer_model.encode(np.array([str(query)]), normalize_embeddings=True), dtype=np.float32)[0]
+        with self.embeddings.lock:
+            vectors = self.embeddings.vectors
+            if vectors is None or len(vectors) == 0:
+                return []
+            if len(self._row_names) != len(vectors):
+                self._row_names = sorted(self.embeddings.index, key=self.embeddings.index.get)[:len(vectors)]
+            similarities = np.asarray(vectors) @ encoded
+            rows = np.flatnonzero(similarities >= threshold)
+            similarity = {self._row_names[row]: float(similarities[row]) for row in rows}
+        clauses, parameters = self._filters(module, stage, source)
+        names = list(similarity)
+        matches = []
+        for start in range(0, len(names), MAX_SQL_PARAMETERS):
+            chunk = names[start:start + MAX_SQL_PARAMETERS]
+            where = ' AND '.join([f"p.name IN ({', '.join('?' * len(chunk))})"] + clauses)
+            for category, process_source, process_module, process_stage, product, cluster_id, name in self._query(
+                    'SELECT c.name, p.source, p.module, p.stage, p.product, p.cluster_id, p.name FROM processes p '
+                    f'JOIN categories c ON c.id = p.category_id WHERE {where}', [*chunk, *parameters]):
+                matches.append(dict({'category': category, 'source': process_source, 'module': process_module, 'stage': process_stage,
+                                     'product': product, 'cluster_id': cluster_id, 'process': name, 'similarity': similarity[name]}))
+        matches.sort(key=lambda match: -match['similarity'])
+        return matches[:limit] if limit is not None else matches
+
+    def categories_with_similar_process(self, query, module=None, stage=None, source=None, threshold=0.8):
+        '''
+        returns a dictionary of each category with a process similar to query to its most similar process and similarity,
+        most similar first, i.e every category whose C3 processes contain a process similar to query with module='C3'
+        '''
+        categories = dict({})
+        for match in self.similar_processes(query, module=module, stage=stage, source=source, threshold=threshold):
+            if match['category'] not in categories:
+                categories[match['category']] = (match['process'], match['similarity'])
+        return categories
+
+    def categories_with_process(self, process, module=None, stage=None, source=None):
+        '''
+        returns the names of the categories with a process of the same canonical name as process
+        '''
+        clauses, parameters = self._filters(module, stage, source)
+        where = ' AND '.join(['p.key = ?'] + clauses)
+        return [row[0] for row in self._query(
+            f'SELECT DISTINCT c.name FROM processes p JOIN categories c ON c.id = p.category_id WHERE {where} ORDER BY c.name',
+            [canonicalize_process_name(process), *parameters])]
+
+    def module_processes(self, product_category_name, module, source='cluster'):
+        '''
+        returns the distinct process names of a life cycle module of a category
+        '''
+        return [row[0] for row in self._query(
+            'SELECT DISTINCT p.name FROM processes p JOIN categories c ON c.id = p.category_id '
+            'WHERE c.name = ? AND p.module = ? AND p.source = ?', (product_category_name, module, source))]
+
+    def clusters(self, product_category_name, module):
+        '''
+        returns the clusters of a life cycle module of a category, as a dictionary of cluster id to process names
+        '''
+        clusters = dict({})
+        for cluster_id, name in self._query(
+                'SELECT p.cluster_id, p.name FROM processes p JOIN categories c ON c.id = p.category_id '
+                "WHERE c.name = ? AND p.module = ? AND p.source = 'cluster' ORDER BY p.rowid", (product_category_name, module)):
+            clusters.setdefault(cluster_id, []).append(name)
+        return clusters
+
+    def pfg(self, product_category_name):
+        '''
+        returns the final PFG of a category, or None if it has none
+        '''
+        rows = self._query('SELECT pfg FROM categories WHERE name = ?', (product_category_name,))
+        return json.loads(rows[0][0]) if rows and rows[0][0] is not None else None
+
+    def product_templates(self, product_category_name):
+        '''
+        returns a dictionary of the template of each sample product of a category
+        '''
+        return {product: json.loads(template) for product, template in self._query(
+            'SELECT t.product, t.template FROM templates t JOIN categories c ON c.id = t.category_id WHERE c.name = ? ORDER BY t.product',
+            (product_category_name,))}
+
+    def categories(self):
+        return [row[0] for row in self._query('SELECT name FROM categories ORDER BY name')]
+
+    def stats(self):
+        '''
+        returns the number of categories, stored process names and embedded distinct names
+        '''
+        categories = self._query('SELECT COUNT(*) FROM categories')[0][0]
+        processes = self._query('SELECT COUNT(*) FROM processes')[0][0]
+        return dict({'categories': categories, 'processes': processes, 'embedded_names': len(self.embeddings)})
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+if __name__ == '__main__':
+    from config import model_config
+    from utils.model_manager import ModelManager
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('trace_folders', nargs='+', help='trace folders of product categories')
+    parser.add_argument('--corpus', default='./corpus', help='folder of the corpus')
+    args = parser.parse_args()
+    model_manager = ModelManager()
+    model_manager.create_model_environ(sources=model_config['sources'], model_names=model_config['model_names'], roles=model_config['roles'])
+    store = CorpusStore(args.corpus, model_manager.models['embedding_transformer'], model_manager.embedding_model_id('embedding_transformer'))
+    for trace_folder in args.trace_folders:
+        stored = store.ingest_trace_folder(trace_folder)
+        print(f'{trace_folder}: {stored if stored is not None else "no checkpoints"}')
+    print(json.dumps(store.stats()))
+    store.close()
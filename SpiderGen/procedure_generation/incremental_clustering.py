@@ -0,0 +1,147 @@
+import os
+import json
+import numpy as np
+from procedure_generation.cluster_selection import candidate_cluster_counts
+'''
+Incremental clustering of the processes of a life cycle module.
+The state of a module keeps the cluster of every process name, the centroid of every cluster and the Davies-Bouldin
+score of the last full fit. When the processes of a module change, new names are assigned to the nearest centroid and
+removed names are dropped, and the module is only refitted from scratch if the score of the updated clusters degrades
+by more than a tolerance, or if the number of clusters falls outside the candidate numbers of clusters.
+'''
+
+STATE_FILE_NAME = 'cluster_state.json'
+
+def _davies_bouldin(encoded_processes, labels):
+    # the score is only defined for 2 to n_samples - 1 clusters
+    if len(np.unique(labels)) < 2 or len(np.unique(labels)) >= len(labels):
+        return None
+    from sklearn.metrics import davies_bouldin_score
+    return float(davies_bouldin_score(encoded_processes, labels))
+
+def cluster_state(encoded_processes, all_processes, clusters, method='kmeans', sample_weight=None, fit_score=None, model=None):
+    '''
+    builds the state of the clusters of a module
+
+    encoded_processes: embeddings of all_processes
+    all_processes: distinct process names of the module
+    clusters: dictionary of cluster id to process names, as returned by get_k_means_clustering
+    method: clustering method the clusters were fitted with
+    sample_weight: optional number of occurrences of each process, used to weight the centroids
+    fit_score: Davies-Bouldin score of the last full fit, by default the score of clusters, which are then a full fit
+    model: identifier of the embedding model of encoded_processes
+
+    returns a JSON serializable dictionary
+    '''
+    labels_of = {process: int(cluster_id) for cluster_id, processes in clusters.items() for process in processes}
+    labels = np.array([labels_of[process] for process in all_processes], dtype=int)
+    weights = np.ones(len(all_processes)) if sample_weight is None else np.asarray(sample_weight, dtype=float)
+    centroids = dict({})
+    for label in np.unique(labels):
+        members = labels == label
+        centroids[str(int(label))] = np.average(encoded_processes[members], axis=0, weights=weights[members]).tolist()
+    score = _davies_bouldin(encoded_processes, labels)
+    return dict({
+        'method': method,
+        'model': model,
+        'labels': {process: int(label) for process, label in zip(all_processes, labels)},
+        'centroids': centroids,
+        'score': score,
+        'fit_score': score if fit_score is None else fit_score,
+    })
+
+def incremental_clusters(state, encoded_processes, processes_dict, all_processes, method='kmeans', tolerance=0.1, model=None):
+    '''
+    updates the clusters of a module from its previous state, without refitting them
+
+    state: state of the module from cluster_state, or None
+    encoded_processes: embeddings of all_processes
+    processes_dict: dictionary of processes for all sample products
+    all_processes: distinct process names of the module
+    method: clustering method the module is clustered with
+    tolerance: largest relative increase of the Davies-Bouldin score over the last full fit that is accepted
+    model: identifier of the embedding model of encoded_processes
+
+    returns the clusters and the reason they were kept ('unchanged' or 'assigned'), or None and the reason the module
+    has to be refitted
+    '''
+    if state is None:
+        return None, 'no previous state'
+    if state.get('method') != method or state.get('model') != model:
+        return None, 'clustering method or embedding model changed'
+    previous = state['labels']
+    new = [i for i, process in enumerate(all_processes) if process not in previous]
+    if len(new) == 0 and len(all_processes) == len(previous):
+        labels = np.array([previous[process] for process in all_processes], dtype=int)
+        reason = 'unchanged'
+    else:
+        labels = np.array([previous.get(process, -1) for process in all_processes], dtype=int)
+        if len(new) > 0:
+            centroid_labels = np.array([int(label) for label in state['centroids']], dtype=int)
+            centroids = np.array([state['centroids'][str(label)] for label in centroid_labels], dtype=float)
+            distances = ((encoded_processes[new][:, None, :] - centroids[None, :, :]) ** 2).sum(axis=2)
+            labels[new] = centroid_labels[distances.argmin(axis=1)]
+        reason = 'assigned'
+        n_clusters = len(np.unique(labels))
+        if n_clusters not in candidate_cluster_counts(processes_dict, len(all_processes)):
+            return None, f'{n_clusters} clusters are not a candidate number of clusters'
+        score = _davies_bouldin(encoded_processes, labels)
+        fit_score = state.get('fit_score')
+        if (score is None) != (fit_score is None):
+            return None, 'the clusters can no longer be scored'
+        if score is not None and score > fit_score * (1 + tolerance):
+            return None, f'davies bouldin score degraded from {fit_score:.4f} to {score:.4f}'
+    clusters = dict({})
+    for process, label in zip(all_processes, labels):
+        clusters.setdefault(int(label), []).append(process)
+    return clusters, reason
+
+def recluster_modules(cluster_states, modules, module_jobs, refit, method='kmeans', tolerance=0.1, model=None):
+    '''
+    updates the clusters of modules from their previous states, and refits the modules which cannot be updated
+
+    cluster_states: dictionary of the state of each module, or None for modules without one, updated in place with the new states
+    modules: life cycle modules to cluster
+    module_jobs: encoded processes, processes dictionary, distinct processes and sample weights of each module, from module_clustering_job
+    refit: function clustering the modules at a list of indices from scratch, returning a list of their clusters
+    method: clustering method the modules are clustered with
+    tolerance: largest relative increase of the Davies-Bouldin score over the last full fit that is accepted
+    model: identifier of the embedding model of the encoded processes
+
+    returns the clusters of each module, and how each module was updated
+    '''
+    clusters_list = [None] * len(modules)
+    updates = [None] * len(modules)
+    for i, (module, (encoded_processes, processes_dict, all_processes, _)) in enumerate(zip(modules, module_jobs)):
+        clusters_list[i], updates[i] = incremental_clusters(cluster_states.get(module), encoded_processes, processes_dict, all_processes, method, tolerance, model)
+    refitted = [i for i in range(len(modules)) if clusters_list[i] is None]
+    if len(refitted) > 0:
+        for i, clusters in zip(refitted, refit(refitted)):
+            clusters_list[i] = clusters
+            updates[i] = f'refitted, {updates[i]}'
+    for i, (module, (encoded_processes, _, all_processes, sample_weight)) in enumerate(zip(modules, module_jobs)):
+        # updated clusters keep the score of the last full fit, which later updates are compared with
+        fit_score = None if i in refitted else cluster_states[module]['fit_score']
+        cluster_states[module] = cluster_state(encoded_processes, all_processes, clusters_list[i], method, sample_weight, fit_score=fit_score, model=model)
+    return clusters_list, updates
+
+def load_cluster_state(folder):
+    '''
+    returns the state saved in folder, or None if there is none
+    '''
+    path = os.path.join(folder, STATE_FILE_NAME)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_cluster_state(folder, state):
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, STATE_FILE_NAME)
+    # written under a temporary name and renamed, so it is never read half written
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
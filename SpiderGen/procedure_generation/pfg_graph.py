@@ -0,0 +1,304 @@
+import sys
+import json
+from array import array
+from collections import deque
+'''
+Compact, validated representation of a Process Flow Graph.
+Process names are interned and numbered in the order of the PFG, edges are kept as compressed sparse rows of process ids,
+and the category and kind of each process take one byte each, so that many PFGs can be held in memory for analysis.
+'''
+
+CATEGORIES = ['upstream', 'core', 'downstream', 'other']
+PROCESS_KINDS = ['process', 'subprocess', 'other']
+# the PFG prompt names the excluded processes with this spelling
+EXCLUDED_KEY = 'exlcluded_processes'
+
+def _code(value, values):
+    # the PFG prompt asks to "list either ..." so values are sometimes given as a list of one value
+    if isinstance(value, list) and len(value) == 1:
+        value = value[0]
+    if isinstance(value, str) and value.strip().lower() in values:
+        return values.index(value.strip().lower())
+    return None
+
+def _node_list(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [value]
+    return [node for node in value if isinstance(node, str)]
+
+def _compressed_rows(number_nodes, edges):
+    '''
+    returns the offsets and targets of the compressed sparse rows of (source, target) id pairs,
+    the targets of node i being targets[offsets[i]:offsets[i + 1]]
+    '''
+    edges = sorted(set(edges))
+    offsets = array('I', [0] * (number_nodes + 1))
+    for source, _ in edges:
+        offsets[source + 1] += 1
+    for i in range(number_nodes):
+        offsets[i + 1] += offsets[i]
+    return offsets, array('I', [target for _, target in edges])
+
+class PFGGraph:
+    '''
+    Process Flow Graph with interned process names, array-backed adjacency and per-process category and kind codes.
+    Build it with from_dict or from_json, which check the input and output nodes of every process and record any
+    inconsistency in issues.
+    '''
+    __slots__ = ('names', 'categories', 'kinds', 'descriptions', 'reasonings', 'offsets', 'targets', 'excluded', 'issues',
+                 '_index', '_in_offsets', '_sources')
+
+    def __init__(self, names, categories, kinds, descriptions, reasonings, edges, excluded=(), issues=()):
+        '''
+        names: process names
+        categories: index in CATEGORIES of the category of each process
+        kinds: index in PROCESS_KINDS of the kind of each process
+        descriptions: description of each process
+        reasonings: reasoning given for the category of each process, or None
+        edges: (source id, target id) pairs
+        excluded: names of the processes excluded from the PFG
+        issues: inconsistencies found while building the graph
+        '''
+        self.names = [sys.intern(name) for name in names]
+        self.categories = array('B', categories)
+        self.kinds = array('B', kinds)
+        self.descriptions = list(descriptions)
+        self.reasonings = list(reasonings)
+        self.offsets, self.targets = _compressed_rows(len(self.names), edges)
+        self.excluded = list(excluded)
+        self.issues = list(issues)
+        # the name index and the reverse adjacency are only built when they are used
+        self._index = None
+        self._in_offsets = None
+        self._sources = None
+
+    @classmethod
+    def from_dict(cls, data, strict=False):
+        '''
+        builds the graph of a PFG, as generated by spidergen
+
+        data: PFG dictionary with a 'processes' dictionary
+        strict: whether to raise a ValueError on the first inconsistency instead of recording it in issues
+
+        Edges to processes which are not in the PFG and self loops are dropped. An edge listed only in the output nodes
+        of its source, or only in the input nodes of its target, is kept. Unknown categories and kinds become 'other'.
+        '''
+        if not isinstance(data, dict) or not isinstance(data.get('processes'), dict):
+            raise ValueError("A PFG must have a 'processes' dictionary")
+        processes = data['processes']
+        names = list(processes)
+        index = {name: i for i, name in enumerate(names)}
+        issues = []
+
+        def issue(message):
+            if strict:
+                raise ValueError(message)
+            issues.append(message)
+
+        categories, kinds, descriptions, reasonings = [], [], [], []
+        outputs = set()
+        inputs = set()
+        for name in names:
+            process = processes[name]
+            if not isinstance(process, dict):
+                issue(f"process '{name}' is not an object")
+                process = dict({})
+            category = _code(process.get('process_category'), CATEGORIES)
+            if category is None:
+                issue(f"process '{name}' has an unknown category {process.get('process_category')!r}")
+                category = CATEGORIES.index('other')
+            kind = _code(process.get('is_subprocess'), PROCESS_KINDS)
+            if kind is None:
+                issue(f"process '{name}' has an unknown kind {process.get('is_subprocess')!r}")
+                kind = PROCESS_KINDS.index('other')
+            categories.append(category)
+            kinds.append(kind)
+            descriptions.append(str(process.get('description', '')))
+            reasonings.append(process.get('reasoning'))
+            for direction, nodes, edges in [('output', process.get('output_nodes'), outputs), ('input', process.get('input_nodes'), inputs)]:
+                for node in _node_list(nodes):
+                    if node not in index:
+                        issue(f"process '{name}' has an {direction} node '{node}' which is not a process")
+                    elif node == name:
+                        issue(f"process '{name}' is its own {direction} node")
+                    elif direction == 'output':
+                        edges.add((index[name], index[node]))
+                    else:
+                        edges.add((index[node], index[name]))
+        for source, target in sorted(outputs - inputs):
+            issue(f"'{names[target]}' is an output node of '{names[source]}', which is not one of its input nodes")
+        for source, target in sorted(inputs - outputs):
+            issue(f"'{names[source]}' is an input node of '{names[target]}', which is not one of its output nodes")
+        return cls(names, categories, kinds, descriptions, reasonings, outputs | inputs,
+                   excluded=_node_list(data.get(EXCLUDED_KEY, data.get('excluded_processes'))), issues=issues)
+
+    @classmethod
+    def from_json(cls, text, strict=False):
+        return cls.from_dict(json.loads(text), strict=strict)
+
+    def to_dict(self):
+        '''
+        returns the PFG in the format generated by spidergen, with consistent input and output nodes
+        '''
+        processes = dict({})
+        for i, name in enumerate(self.names):
+            process = dict({
+                'description': self.descriptions[i],
+                'process_category': CATEGORIES[self.categories[i]],
+                'is_subprocess': PROCESS_KINDS[self.kinds[i]],
+                'input_nodes': [self.names[source] for source in self.predecessor_ids(i)],
+                'output_nodes': [self.names[target] for target in self.successor_ids(i)],
+            })
+            if self.reasonings[i] is not None:
+                process['reasoning'] = self.reasonings[i]
+            processes[name] = process
+        return dict({EXCLUDED_KEY: list(self.excluded), 'processes': processes})
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), ensure_ascii=False, **kwargs)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __repr__(self):
+        return f'PFGGraph({len(self.names)} processes, {self.edge_count} edges, {len(self.issues)} issues)'
+
+    @property
+    def index(self):
+        '''
+        dictionary of process name to process id
+        '''
+        if self._index is None:
+            self._index = {name: i for i, name in enumerate(self.names)}
+        return self._index
+
+    @property
+    def edge_count(self):
+        return len(self.targets)
+
+    def successor_ids(self, i):
+        return self.targets[self.offsets[i]:self.offsets[i + 1]]
+
+    def predecessor_ids(self, i):
+        if self._in_offsets is None:
+            self._in_offsets, self._sources = _compressed_rows(len(self.names), [(target, source) for source, target in self.edge_ids()])
+        return self._sources[self._in_offsets[i]:self._in_offsets[i + 1]]
+
+    def successors(self, name):
+        return [self.names[target] for target in self.successor_ids(self.index[name])]
+
+    def predecessors(self, name):
+        return [self.names[source] for source in self.predecessor_ids(self.index[name])]
+
+    def edge_ids(self):
+        for source in range(len(self.names)):
+            for target in self.successor_ids(source):
+                yield source, target
+
+    def edges(self):
+        '''
+        yields the (source, target) name pairs of every edge
+        '''
+        for source, target in self.edge_ids():
+            yield self.names[source], self.names[target]
+
+    def category(self, name):
+        return CATEGORIES[self.categories[self.index[name]]]
+
+    def is_subprocess(self, name):
+        return PROCESS_KINDS[self.kinds[self.index[name]]] == 'subprocess'
+
+    def processes_in(self, category):
+        '''
+        returns the names of the processes of a category (i.e, upstream), in the order of the PFG
+        '''
+        code = CATEGORIES.index(category)
+        return [name for name, name_category in zip(self.names, self.categories) if name_category == code]
+
+    def topological_order(self):
+        '''
+        returns the process names ordered so that every edge goes from an earlier to a later process,
+        keeping the order of the PFG between unrelated processes
+
+        raises a ValueError if the PFG has a cycle
+        '''
+        indegree = array('I', [0] * len(self.names))
+        for target in self.targets:
+            indegree[target] += 1
+        queue = deque(i for i in range(len(self.names)) if indegree[i] == 0)
+        order = []
+        while queue:
+            node = queue.popleft()
+            order.append(node)
+            for target in self.successor_ids(node):
+                indegree[target] -= 1
+                if indegree[target] == 0:
+                    queue.append(target)
+        if len(order) < len(self.names):
+            cycle = [self.names[i] for i in range(len(self.names)) if indegree[i] > 0]
+            raise ValueError(f'PFG has a cycle through {cycle[:10]}')
+        return [self.names[i] for i in order]
+
+def as_pfg_graph(pfg):
+    '''
+    returns the PFGGraph of a PFG given as a PFGGraph, a dictionary or a JSON string
+    '''
+    if isinstance(pfg, PFGGraph):
+        return pfg
+    if isinstance(pfg, str):
+        return PFGGraph.from_json(pfg)
+    return PFGGraph.from_dict(pfg)
+
+def _merge_key(name):
+    return ' '.join(name.casefold().split())
+
+def merge_pfgs(pfgs):
+    '''
+    merges the PFGs of consecutive parts of a life cycle (i.e, upstream, core and end of life) into one PFG
+    pfgs: PFGs of each part, in the order of the life cycle, as PFGGraphs, dictionaries or JSON strings
+
+    Processes with the same name, ignoring case and whitespace, are merged into the process of the earliest part.
+    The parts are stitched with an edge from every last process of a part to every first process of the next part
+    that has processes, where the first and last processes of a part are the processes (not subprocesses) without
+    an input or output among its processes.
+
+    returns the merged PFGGraph
+    '''
+    subprocess = PROCESS_KINDS.index('subprocess')
+    names, categories, kinds, descriptions, reasonings, excluded, issues = [], [], [], [], [], [], []
+    index = dict({})
+    edges = set()
+    previous_sinks = []
+    for part, pfg in enumerate(pfgs):
+        graph = as_pfg_graph(pfg)
+        issues.extend(f'part {part}: {issue}' for issue in graph.issues)
+        excluded.extend(name for name in graph.excluded if name not in excluded)
+        ids = []
+        for i, name in enumerate(graph.names):
+            key = _merge_key(name)
+            if key in index:
+                issues.append(f"part {part}: process '{name}' is also in an earlier part, and is merged with it")
+            else:
+                index[key] = len(names)
+                names.append(name)
+                categories.append(graph.categories[i])
+                kinds.append(graph.kinds[i])
+                descriptions.append(graph.descriptions[i])
+                reasonings.append(graph.reasonings[i])
+            ids.append(index[key])
+        edges.update((ids[source], ids[target]) for source, target in graph.edge_ids() if ids[source] != ids[target])
+        if len(graph) == 0:
+            continue
+        # subprocesses feed into their process, so the flow of a part runs through its other processes
+        main = [i for i in range(len(graph)) if graph.kinds[i] != subprocess] or list(range(len(graph)))
+        main_set = set(main)
+        sources = [ids[i] for i in main if not any(source in main_set for source in graph.predecessor_ids(i))]
+        sinks = [ids[i] for i in main if not any(target in main_set for target in graph.successor_ids(i))]
+        edges.update((sink, source) for sink in previous_sinks for source in sources if sink != source)
+        previous_sinks = sinks
+    return PFGGraph(names, categories, kinds, descriptions, reasonings, edges, excluded=excluded, issues=issues)
@@ -0,0 +1,367 @@
+'''
+Layered layout and direct SVG and DOT rendering of Process Flow Graphs.
+The layout places the upstream, core and downstream processes in successive bands of layers, Sugiyama style:
+cycles are broken, each process is assigned a layer by longest path, edges spanning several layers are routed through
+dummy points, and the processes of each layer are ordered by barycenter sweeps to reduce edge crossings.
+Every step is linear in the number of processes and edges, so it scales to thousands of processes.
+Render a JSONL file of PFGs written by run_batch.py from the SpiderGen folder with:
+    python -m procedure_generation.pfg_render pfgs.jsonl --output-folder renders --formats svg dot
+'''
+import os
+import re
+import json
+import logging
+import argparse
+from collections import deque
+from xml.sax.saxutils import escape
+from concurrent.futures import ProcessPoolExecutor
+from procedure_generation.pfg_graph import CATEGORIES, as_pfg_graph
+
+logger = logging.getLogger(__name__)
+
+CATEGORY_ORDER = ['upstream', 'core', 'downstream', 'other']
+CATEGORY_COLORS = dict({
+    'upstream': '#87D9EB',
+    'core': '#FFD700',
+    'downstream': '#FB9A98',
+    'other': '#FFFFFF',
+})
+
+# size of the processes and spacing of the layers of the SVG, in pixels
+NODE_WIDTH = 160
+NODE_HEIGHT = 48
+X_SPACING = 190
+Y_SPACING = 110
+MARGIN = 40
+TITLE_HEIGHT = 40
+
+def wrap_label(name, width=20):
+    '''
+    splits a process name into lines of about width characters
+    '''
+    lines = []
+    line = []
+    for word in name.split():
+        line.append(word)
+        if len(' '.join(line)) > width:
+            lines.append(' '.join(line))
+            line = []
+    if line:
+        lines.append(' '.join(line))
+    return lines
+
+def pfg_graph(pfg):
+    '''
+    returns the process names, the category of each process, and the edges between processes of a PFG,
+    without the self loops and edges to processes which are not in the PFG, which PFGGraph drops
+    '''
+    graph = as_pfg_graph(pfg)
+    categories = {name: CATEGORIES[code] for name, code in zip(graph.names, graph.categories)}
+    return list(graph.names), categories, list(graph.edges())
+
+def break_cycles(names, edges):
+    '''
+    reverses the edges which close a cycle in a depth first search, so that the graph is acyclic
+
+    returns the edges of the acyclic graph, and the set of edges which were reversed
+    '''
+    successors = {name: [] for name in names}
+    for source, target in edges:
+        successors[source].append(target)
+    # 0: not visited, 1: on the current path, 2: done
+    state = dict.fromkeys(names, 0)
+    reversed_edges = set()
+    for root in names:
+        if state[root]:
+            continue
+        state[root] = 1
+        stack = [(root, iter(successors[root]))]
+        while stack:
+            node, children = stack[-1]
+            for child in children:
+                if state[child] == 1:
+                    reversed_edges.add((node, child))
+                elif state[child] == 0:
+                    state[child] = 1
+                    stack.append((child, iter(successors[child])))
+                    break
+            else:
+                state[node] = 2
+                stack.pop()
+    acyclic = [(target, source) if (source, target) in reversed_edges else (source, target) for source, target in edges]
+    return list(dict.fromkeys(acyclic)), reversed_edges
+
+def longest_path_ranks(names, edges):
+    '''
+    returns the rank of each process of an acyclic graph, which is the length of the longest path reaching it
+    '''
+    successors = {name: [] for name in names}
+    indegree = dict.fromkeys(names, 0)
+    for source, target in edges:
+        successors[source].append(target)
+        indegree[target] += 1
+    ranks = dict.fromkeys(names, 0)
+    queue = deque(name for name in names if indegree[name] == 0)
+    while queue:
+        node = queue.popleft()
+        for child in successors[node]:
+            ranks[child] = max(ranks[child], ranks[node] + 1)
+            indegree[child] -= 1
+            if indegree[child] == 0:
+                queue.append(child)
+    return ranks
+
+def assign_layers(names, categories, ranks):
+    '''
+    stacks the categories in bands of layers, in the order of CATEGORY_ORDER,
+    and numbers the distinct ranks of the processes of each category within its band
+    '''
+    layers = dict({})
+    offset = 0
+    for category in CATEGORY_ORDER:
+        members = [name for name in names if categories[name] == category]
+        distinct_ranks = {rank: index for index, rank in enumerate(sorted({ranks[name] for name in members}))}
+        for name in members:
+            layers[name] = offset + distinct_ranks[ranks[name]]
+        offset += len(distinct_ranks)
+    return layers
+
+def layered_layout(pfg, sweeps=4, max_dummy_span=8):
+    '''
+    computes a layered layout of a PFG
+
+    pfg: PFGGraph, dictionary or JSON string of the PFG
+    sweeps: number of down and up barycenter sweeps used to reduce edge crossings
+    max_dummy_span: longest edge, in layers, that is routed through dummy points; longer edges are drawn straight,
+        so that the number of dummy points stays proportional to the number of edges
+
+    returns a dictionary with the 'positions' (x, y) of each process, in units of the spacing between processes and
+    between layers, the 'layers' of process names from the top, the 'edges' as dictionaries of their 'source', 'target'
+    and the 'points' they are routed through, and the 'category' of each process
+    '''
+    names, categories, edges = pfg_graph(pfg)
+    acyclic, _ = break_cycles(names, edges)
+    layer_of = assign_layers(names, categories, longest_path_ranks(names, acyclic))
+
+    # processes and the dummy points of long edges are numbered, processes first
+    node_layer = [layer_of[name] for name in names]
+    index = {name: i for i, name in enumerate(names)}
+    up = [[] for _ in names]
+    down = [[] for _ in names]
+    routes = []
+    for source, target in edges:
+        top, bottom = sorted([index[source], index[target]], key=lambda node: node_layer[node])
+        chain = [top]
+        if node_layer[bottom] - node_layer[top] <= max_dummy_span:
+            for layer in range(node_layer[top] + 1, node_layer[bottom]):
+                node_layer.append(layer)
+                up.append([])
+                down.append([])
+                chain.append(len(node_layer) - 1)
+        chain.append(bottom)
+        if node_layer[top] != node_layer[bottom]:
+            for upper, lower in zip(chain, chain[1:]):
+                down[upper].append(lower)
+                up[lower].append(upper)
+        # the route is kept from source to target, whichever of them is higher
+        routes.append((source, target, chain if index[source] == top else chain[::-1]))
+
+    number_layers = max(node_layer, default=-1) + 1
+    layers = [[] for _ in range(number_layers)]
+    for node, layer in enumerate(node_layer):
+        layers[layer].append(node)
+    position = [0] * len(node_layer)
+    for layer in layers:
+        for i, node in enumerate(layer):
+            position[node] = i
+
+    def reorder(layer, neighbors):
+        def barycenter(node):
+            if not neighbors[node]:
+                return position[node]
+            return sum(position[neighbor] for neighbor in neighbors[node]) / len(neighbors[node])
+        layer.sort(key=barycenter)
+        for i, node in enumerate(layer):
+            position[node] = i
+
+    for _ in range(sweeps):
+        for layer in layers[1:]:
+            reorder(layer, up)
+        for layer in reversed(layers[:-1]):
+            reorder(layer, down)
+
+    coordinates = [None] * len(node_layer)
+    for layer_index, layer in enumerate(layers):
+        for i, node in enumerate(layer):
+            # each layer is centered on x = 0
+            coordinates[node] = (i - (len(layer) - 1) / 2.0, float(layer_index))
+    return dict({
+        'positions': {name: coordinates[index[name]] for name in names},
+        'layers': [[names[node] for node in layer if node < len(names)] for layer in layers],
+        'edges': [dict({'source': source, 'target': target, 'points': [coordinates[node] for node in chain]}) for source, target, chain in routes],
+        'category': categories,
+    })
+
+def _svg_point(point, min_x):
+    return (MARGIN + NODE_WIDTH / 2.0 + (point[0] - min_x) * X_SPACING, MARGIN + TITLE_HEIGHT + NODE_HEIGHT / 2.0 + point[1] * Y_SPACING)
+
+def _clip_to_box(center, toward):
+    # moves the end of an edge from the center of a process to the side of its box facing the next point of the edge
+    x, y = center
+    if toward[1] > y:
+        return (x, y + NODE_HEIGHT / 2.0)
+    if toward[1] < y:
+        return (x, y - NODE_HEIGHT / 2.0)
+    return (x + NODE_WIDTH / 2.0 if toward[0] > x else x - NODE_WIDTH / 2.0, y)
+
+def render_svg(pfg, output_file=None, layout=None, title='Process Flow Diagram'):
+    '''
+    renders a PFG as SVG, without matplotlib
+
+    pfg: PFGGraph, dictionary or JSON string of the PFG
+    output_file: file the SVG is written to, if any
+    layout: layout returned by layered_layout, computed if None
+
+    returns the SVG document
+    '''
+    graph = as_pfg_graph(pfg)
+    layout = layout or layered_layout(graph)
+    xs = [x for x, _ in layout['positions'].values()] + [x for edge in layout['edges'] for x, _ in edge['points']]
+    min_x, max_x = (min(xs), max(xs)) if xs else (0.0, 0.0)
+    width = int(2 * MARGIN + NODE_WIDTH + (max_x - min_x) * X_SPACING)
+    width = max(width, 2 * MARGIN + 150 * len(CATEGORY_ORDER))
+    height = int(2 * MARGIN + TITLE_HEIGHT + NODE_HEIGHT + max(len(layout['layers']) - 1, 0) * Y_SPACING + 30)
+
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" viewBox="0 0 {width} {height}" font-family="Helvetica, Arial, sans-serif">',
+        '<defs><marker id="arrow" viewBox="0 0 10 10" refX="10" refY="5" markerWidth="8" markerHeight="8" orient="auto-start-reverse">'
+        '<path d="M 0 0 L 10 5 L 0 10 z" fill="#808080"/></marker></defs>',
+        '<rect width="100%" height="100%" fill="white"/>',
+        f'<text x="{width / 2:.1f}" y="{MARGIN:.1f}" text-anchor="middle" font-size="18" font-weight="bold">{escape(title)}</text>',
+    ]
+    for edge in layout['edges']:
+        points = [_svg_point(point, min_x) for point in edge['points']]
+        points[0] = _clip_to_box(points[0], points[1])
+        points[-1] = _clip_to_box(points[-1], points[-2])
+        coordinates = ' '.join(f'{x:.1f},{y:.1f}' for x, y in points)
+        parts.append(f'<polyline points="{coordinates}" fill="none" stroke="#808080" stroke-width="1.5" stroke-opacity="0.7" marker-end="url(#arrow)"/>')
+    for name, point in layout['positions'].items():
+        x, y = _svg_point(point, min_x)
+        lines = wrap_label(name)
+        description = escape(graph.descriptions[graph.index[name]])
+        parts.append(f'<g><title>{escape(name)}: {description}</title>')
+        parts.append(f'<rect x="{x - NODE_WIDTH / 2:.1f}" y="{y - NODE_HEIGHT / 2:.1f}" width="{NODE_WIDTH}" height="{NODE_HEIGHT}" rx="10" '
+                     f'fill="{CATEGORY_COLORS[layout["category"][name]]}" stroke="black" stroke-width="1.5"/>')
+        first_line = y - (len(lines) - 1) * 6.0 + 4.0
+        spans = ''.join(f'<tspan x="{x:.1f}" y="{first_line + i * 12.0:.1f}">{escape(line)}</tspan>' for i, line in enumerate(lines))
+        parts.append(f'<text text-anchor="middle" font-size="10" font-weight="bold">{spans}</text></g>')
+    for i, category in enumerate(CATEGORY_ORDER):
+        x = MARGIN + i * 150
+        y = height - MARGIN / 2 - 12
+        parts.append(f'<rect x="{x}" y="{y:.1f}" width="14" height="14" fill="{CATEGORY_COLORS[category]}" stroke="black"/>'
+                     f'<text x="{x + 20}" y="{y + 12:.1f}" font-size="12">{category.capitalize()}</text>')
+    parts.append('</svg>')
+    svg = '\n'.join(parts)
+    if output_file:
+        with open(output_file, 'w', encoding='utf-8') as f:
+            f.write(svg)
+    return svg
+
+def _dot_string(value):
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+def render_dot(pfg, output_file=None, title='Process Flow Diagram'):
+    '''
+    renders a PFG as a Graphviz DOT graph, with a cluster per process category, to be laid out by dot
+
+    pfg: PFGGraph, dictionary or JSON string of the PFG
+    output_file: file the DOT graph is written to, if any
+
+    returns the DOT graph
+    '''
+    graph = as_pfg_graph(pfg)
+    names, categories, edges = pfg_graph(graph)
+    lines = [
+        'digraph pfg {',
+        f'    label={_dot_string(title)}; labelloc=t; fontsize=18; rankdir=TB;',
+        '    node [shape=box, style="rounded,filled", fontname="Helvetica", fontsize=10];',
+        '    edge [color="#808080"];',
+    ]
+    for category in CATEGORY_ORDER:
+        members = [name for name in names if categories[name] == category]
+        if not members:
+            continue
+        lines.append(f'    subgraph cluster_{category} {{')
+        lines.append(f'        label={_dot_string(category.capitalize())}; style=dashed;')
+        for name in members:
+            description = graph.descriptions[graph.index[name]]
+            lines.append(f'        {_dot_string(name)} [label={_dot_string(chr(10).join(wrap_label(name)))}, '
+                         f'fillcolor={_dot_string(CATEGORY_COLORS[category])}, tooltip={_dot_string(description)}];')
+        lines.append('    }')
+    for source, target in edges:
+        lines.append(f'    {_dot_string(source)} -> {_dot_string(target)};')
+    lines.append('}')
+    dot = '\n'.join(lines) + '\n'
+    if output_file:
+        with open(output_file, 'w', encoding='utf-8') as f:
+            f.write(dot)
+    return dot
+
+def render_file(pfg, output_file, title='Process Flow Diagram', dpi=150):
+    '''
+    renders a PFG to output_file, in the format of its extension: .svg and .dot are written directly,
+    and other formats (i.e, .png or .pdf) are drawn with matplotlib, without showing the figure
+    '''
+    extension = os.path.splitext(output_file)[1].lower()
+    if extension == '.svg':
+        render_svg(pfg, output_file, title=title)
+    elif extension in ('.dot', '.gv'):
+        render_dot(pfg, output_file, title=title)
+    else:
+        from procedure_generation.spidergen_utils import save_visualization
+        save_visualization(pfg, output_file, show=False, dpi=dpi)
+    return output_file
+
+def _render_record(record, output_folder, formats, dpi):
+    name = re.sub(r'[^A-Za-z0-9._-]+', '_', record['product_category_name'])
+    return [render_file(record['pfg'], os.path.join(output_folder, f'{name}.{extension}'), title=record['product_category_name'], dpi=dpi)
+            for extension in formats]
+
+def render_batch(pfgs_path, output_folder, formats=('svg',), max_workers=1, dpi=150):
+    '''
+    renders every PFG of a JSONL file written by run_batch.py, headless
+
+    pfgs_path: JSONL file with the product_category_name and pfg of each category
+    output_folder: folder the renders are written to, one file per category and format
+    formats: file extensions to render, such as 'svg', 'dot' or 'png'
+    max_workers: number of processes rendering at once
+
+    returns the paths of the rendered files
+    '''
+    if any(extension not in ('svg', 'dot', 'gv') for extension in formats):
+        # never open a window when rendering with matplotlib
+        import matplotlib
+        matplotlib.use('Agg')
+    os.makedirs(output_folder, exist_ok=True)
+    with open(pfgs_path, 'r', encoding='utf-8') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    records = [record for record in records if record.get('pfg', dict({})).get('processes')]
+    if max_workers > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            paths = list(executor.map(_render_record, records, [output_folder] * len(records), [formats] * len(records), [dpi] * len(records)))
+    else:
+        paths = [_render_record(record, output_folder, formats, dpi) for record in records]
+    logger.info(f'rendered {len(records)} PFGs to {output_folder}')
+    return [path for record_paths in paths for path in record_paths]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('pfgs', help='JSONL file of PFGs written by run_batch.py')
+    parser.add_argument('--output-folder', default='renders')
+    parser.add_argument('--formats', nargs='+', default=['svg'], help='svg and dot are written directly, other formats (png, pdf) with matplotlib')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes rendering at once')
+    parser.add_argument('--dpi', type=int, default=150, help='resolution of the formats rendered with matplotlib')
+    args = parser.parse_args()
+    logging.basicConfig(level='INFO', format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    render_batch(args.pfgs, args.output_folder, args.formats, args.workers, args.dpi)
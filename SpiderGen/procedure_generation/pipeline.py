@@ -0,0 +1,172 @@
+import os
+import json
+import hashlib
+import contextvars
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from utils.instrumentation import get_tracer
+'''
+Stage DAG with content-hash checkpoints, used to run the steps of the SpiderGen workflow.
+Each stage is keyed by a hash of its parameters (i.e, prompt and model configuration) and of the artifacts it depends on,
+so a resumed run loads every stage whose inputs are unchanged and only recomputes the others.
+Stages are started as soon as the stages they depend on are done.
+'''
+
+def _json_default(value):
+    if isinstance(value, np.ndarray):
+        return dict({'dtype': value.dtype.str, 'shape': list(value.shape), 'sha256': hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()})
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'Object of type {type(value).__name__} cannot be hashed')
+
+def content_hash(value):
+    '''
+    returns the hex digest of a JSON-like value, which may contain numpy arrays
+    '''
+    payload = json.dumps(value, sort_keys=True, ensure_ascii=False, default=_json_default)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class Stage:
+    '''
+    A step of a pipeline.
+
+    name: unique name of the stage
+    function: function called with a dictionary of the artifact of each input stage, which returns the artifact of the stage,
+        or None if it failed
+    inputs: names of the stages whose artifacts the stage uses
+    params: JSON-like value of everything else that determines the artifact, such as the prompt and the model configuration
+    checkpoint: folder the artifact is saved to and resumed from, or None to always compute it
+    depends: optional function of the input artifacts returning the part of them that the artifact depends on,
+        used in the key instead of the whole input artifacts
+    expand: optional function of the artifact returning new stages to add to the pipeline, for steps whose fan-out
+        is only known once the stage is done
+    '''
+    def __init__(self, name, function, inputs=(), params=None, checkpoint=None, depends=None, expand=None):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.params = params
+        self.checkpoint = checkpoint
+        self.depends = depends
+        self.expand = expand
+
+class CheckpointStore:
+    '''
+    Saves the artifact of a stage with its key in the checkpoint folder of the stage.
+    Arrays are saved as .npy files, and other artifacts as JSON.
+    '''
+    FILE_NAME = 'checkpoint.json'
+    ARRAY_FILE_NAME = 'checkpoint.npy'
+
+    def load(self, folder, key):
+        '''
+        returns (True, artifact) if folder has a checkpoint with key, and (False, None) otherwise
+        '''
+        path = os.path.join(folder, self.FILE_NAME)
+        if not os.path.isfile(path):
+            return False, None
+        try:
+            with open(path, 'r') as f:
+                checkpoint = json.load(f)
+            if checkpoint.get('key') != key:
+                return False, None
+            if checkpoint.get('array'):
+                return True, np.load(os.path.join(folder, self.ARRAY_FILE_NAME))
+            return True, checkpoint['artifact']
+        except (OSError, ValueError, KeyError):
+            # a checkpoint left incomplete by a killed run is recomputed
+            return False, None
+
+    def save(self, folder, key, artifact):
+        os.makedirs(folder, exist_ok=True)
+        if isinstance(artifact, np.ndarray):
+            with open(os.path.join(folder, self.ARRAY_FILE_NAME), 'wb') as f:
+                np.save(f, artifact)
+            checkpoint = dict({'key': key, 'array': True})
+        else:
+            checkpoint = dict({'key': key, 'artifact': artifact})
+        # the checkpoint is written under a temporary name and renamed, so it is never read half written
+        path = os.path.join(folder, self.FILE_NAME)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(checkpoint, f, indent=4, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+
+class Pipeline:
+    '''
+    Runs a DAG of stages on a pool of threads, starting each stage as soon as its inputs are ready.
+    '''
+    def __init__(self, stages, max_workers=1, store=None):
+        self.stages = dict({})
+        self.max_workers = max(1, max_workers)
+        self.store = store if store is not None else CheckpointStore()
+        self.artifacts = dict({})
+        self.hashes = dict({})
+        self.stats = dict({'computed': [], 'resumed': []})
+        for stage in stages:
+            self.add(stage)
+
+    def add(self, stage):
+        if stage.name in self.stages:
+            raise ValueError(f"Duplicate stage '{stage.name}'")
+        self.stages[stage.name] = stage
+
+    def stage_key(self, stage, inputs):
+        '''
+        returns the key of a stage, from its name, parameters and the content of its inputs
+        '''
+        if stage.depends is not None:
+            dependencies = content_hash(stage.depends(inputs))
+        else:
+            dependencies = dict({name: self.hashes[name] for name in stage.inputs})
+        return content_hash([stage.name, stage.params, dependencies])
+
+    def run_stage(self, stage):
+        with get_tracer().span(stage.name, kind='stage') as span:
+            inputs = dict({name: self.artifacts[name] for name in stage.inputs})
+            key = self.stage_key(stage, inputs)
+            if stage.checkpoint:
+                found, artifact = self.store.load(stage.checkpoint, key)
+                if found:
+                    span.set(resumed=True)
+                    return artifact, True
+            artifact = stage.function(inputs)
+            span.set(resumed=False, failed=artifact is None)
+            # stages return None when they fail, which is not checkpointed so that they are retried on the next run
+            if stage.checkpoint and artifact is not None:
+                self.store.save(stage.checkpoint, key, artifact)
+            return artifact, False
+
+    def run(self):
+        '''
+        runs every stage, including the stages added by expanded stages
+
+        returns a dictionary of the artifact of each stage
+        '''
+        running = dict({})
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                for name, stage in self.stages.items():
+                    if name in self.artifacts or name in running.values():
+                        continue
+                    missing = [input_name for input_name in stage.inputs if input_name not in self.stages]
+                    if missing:
+                        raise ValueError(f"Stage '{name}' depends on unknown stages {missing}")
+                    if all(input_name in self.artifacts for input_name in stage.inputs):
+                        # stages run in the context of the caller, so that their spans are nested under its current span
+                        running[executor.submit(contextvars.copy_context().run, self.run_stage, stage)] = name
+                if not running:
+                    break
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    artifact, resumed = future.result()
+                    self.artifacts[name] = artifact
+                    self.hashes[name] = content_hash(artifact)
+                    self.stats['resumed' if resumed else 'computed'].append(name)
+                    if self.stages[name].expand is not None:
+                        for stage in self.stages[name].expand(artifact):
+                            self.add(stage)
+        pending = [name for name in self.stages if name not in self.artifacts]
+        if pending:
+            raise ValueError(f'Stages {pending} could not be run, their inputs form a cycle')
+        return self.artifacts
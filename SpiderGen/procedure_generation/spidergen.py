@@ -1,77 +1,388 @@
 import os
-from procedure_generation.spidergen_utils import get_clusters_summary
-import json
-def spidergen(product_category_name, product_category_description, number_sample_products, model_manager, trace=True):
+import time
+import logging
+from procedure_generation.spidergen_utils import (LIFE_CYCLE_MODULES, collect_processes, all_process_names,
+                                                  embed_processes, module_clustering_job, summarize_clusters, compact_clusters, ModuleClusteringPool, timed_clustering)
+from procedure_generation.cluster_summary import estimate_tokens
+from procedure_generation.pipeline import Stage, Pipeline, content_hash
+from procedure_generation.pfg_graph import PFGGraph, merge_pfgs
+from procedure_generation.incremental_clustering import recluster_modules, load_cluster_state, save_cluster_state
+from utils.prompt_compiler import load_compiled_prompts
+from utils.model_manager import write_trace
+from utils.instrumentation import get_tracer, summarize_spans, current_span
+
+logger = logging.getLogger(__name__)
+
+PROMPTS_FOLDER = 'procedure_generation/prompts'
+PROMPT_FILES = dict({
+    'similar_products': 'prompt_for_similar_products.txt',
+    'sample_product_template': 'prompt_for_sample_product_template.txt',
+    'generating_pfg': 'prompt_for_generating_pfg.txt',
+    'generating_sub_pfg': 'prompt_for_generating_sub_pfg.txt',
+})
+# names of the inputs filled into the placeholders of each prompt, in the order they are passed to format
+PROMPT_FIELDS = dict({
+    'similar_products': ['PRODUCT_CATEGORY_NAME', 'UN_CPC_CODE_DESCRIPTIONS', 'NUMBER_OF_PRODUCTS'],
+    'sample_product_template': ['PRODUCT_NAME', 'PRODUCT_DESCRIPTION'],
+    'generating_pfg': ['PRODUCT_CATEGORIES', 'PROCESS_CLUSTERS', 'PRODUCT_CATEGORIES'],
+    'generating_sub_pfg': ['PRODUCT_CATEGORIES', 'LIFE_CYCLE_STAGE', 'PROCESS_CLUSTERS', 'PRODUCT_CATEGORIES'],
+})
+# parts of the life cycle whose PFGs are generated separately and merged in the 'map_reduce' final synthesis, in the order of the life cycle
+SYNTHESIS_PARTS = dict({
+    'upstream': dict({'modules': ['A1', 'A2', 'A3'],
+                      'stage': 'upstream processes, from raw material supply and transport to manufacturing (modules A1 to A3)'}),
+    'core': dict({'modules': ['A4', 'A5', 'B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7'],
+                  'stage': 'distribution, installation and use stage processes (modules A4, A5 and B1 to B7)'}),
+    'end_of_life': dict({'modules': ['C1', 'C2', 'C3', 'C4'],
+                         'stage': 'end of life processes, from deconstruction and waste transport to waste processing and disposal (modules C1 to C4)'}),
+})
+
+def load_prompts():
     """
-    Generates a Process Flow Graph for the given product category.
+    Loads the compiled prompts for each step of the SpiderGen workflow. The prompt files are read and compiled once per process.
+    Each prompt is formatted into a static prefix, which the LLM provider can cache across calls, followed by the values of its inputs.
+
+    Returns:
+        dict: The CompiledPrompt for the 'similar_products', 'sample_product_template', 'generating_pfg' and 'generating_sub_pfg' steps. """
+    return load_compiled_prompts(PROMPTS_FOLDER, PROMPT_FILES, PROMPT_FIELDS)
+
+def is_valid_template(template, product):
+    """
+    Checks that a generated sample product template contains processes, so that it can be clustered.
+
+    Args:
+        template: The generated template of the sample product.
+        product (str): The name of the sample product. """
+    if not isinstance(template, dict) or 'processes' not in template:
+        logger.warning(f'no processes were generated for {product}')
+        return False
+    return True
+
+def log_pfg_issues(product_category_name, pfg):
+    """
+    Logs the inconsistent nodes and edges of a generated PFG. The PFG is kept as generated, the inconsistencies are
+    dropped when it is loaded as a PFGGraph. """
+    try:
+        issues = PFGGraph.from_dict(pfg).issues
+    except ValueError as e:
+        issues = [str(e)]
+    if issues:
+        logger.warning(f'{product_category_name}: the PFG has {len(issues)} inconsistent nodes or edges, such as: {issues[0]}')
+
+def category_trace_folder(product_category_name):
+    """
+    Returns the folder that the traces and checkpoints of a product category are recorded in. """
+    return f"./traces/spidergen/{product_category_name.replace(' ', '_')}"
+
+def template_cache_scope(prompt_sample_product_template, model_manager):
+    """
+    Returns the scope of the templates in the template cache which can be reused with a template prompt and LLM. """
+    return content_hash([prompt_sample_product_template.prefix, model_manager.model_config('llm')])
+
+def reuse_sample_product_template(product, product_description, prompt_sample_product_template, model_manager, trace_folder=None):
+    """
+    Looks up the template of a product similar to the sample product in the template cache of the model manager.
+    The decision, with the product the template was generated for and its similarity, is recorded as a span and in the trace folder.
+
+    Args:
+        product (str): The name of the sample product.
+        product_description (str): The description of the sample product.
+        prompt_sample_product_template (CompiledPrompt): The compiled sample product template prompt.
+        model_manager (ModelManager): The model manager with the template cache.
+        trace_folder (str): The trace folder of the sample product, or None if tracing is disabled.
+
+    Returns:
+        dict: The reused template, or None if the cache is disabled or has no similar product. """
+    if model_manager.template_cache is None:
+        return None
+    with get_tracer().span(f'template_cache:{product}', kind='template_cache', product=product) as span:
+        match = model_manager.template_cache.lookup(product, product_description, template_cache_scope(prompt_sample_product_template, model_manager))
+        if match is not None and not is_valid_template(match['template'], product):
+            match = None
+        span.set(reused=match is not None)
+        decision = dict({'product': product, 'description': product_description, 'reused': match is not None,
+                         'threshold': model_manager.template_cache.threshold})
+        if match is not None:
+            span.set(reused_product=match['product'], reused_category=match['category'], similarity=match['similarity'])
+            decision.update({'reused_product': match['product'], 'reused_description': match['description'],
+                             'reused_category': match['category'], 'similarity': match['similarity']})
+            logger.info(f"reusing the template of {match['product']} ({match['category']}) for {product}, similarity {match['similarity']:.3f}")
+    if trace_folder:
+        write_trace(trace_folder, 'template_cache', decision)
+    return match['template'] if match is not None else None
+
+def generate_sample_product_template(product, product_description, prompt_sample_product_template, model_manager, trace_folder=None, product_category_name=None):
+    """
+    Generates the life cycle template for a single sample product, or reuses the template of a similar product if the
+    template cache of the model manager is enabled.
+
+    Args:
+        product (str): The name of the sample product.
+        product_description (str): The description of the sample product.
+        prompt_sample_product_template (CompiledPrompt): The compiled sample product template prompt.
+        model_manager (ModelManager): The model manager instance to use for generation.
+        trace_folder (str): The trace folder of the product category, or None if tracing is disabled.
+        product_category_name (str): The name of the product category, stored with the template in the template cache.
+
+    Returns:
+        dict: The template of the sample product, or None if no valid template could be generated. """
+    product_trace_folder = os.path.join(trace_folder, f"sample_products_templates/{product}") if trace_folder else None
+    template = reuse_sample_product_template(product, product_description, prompt_sample_product_template, model_manager, product_trace_folder)
+    if template is not None:
+        return template
+    prompt_sample_product = prompt_sample_product_template.format(product, product_description)
+    # isolate failures so one bad product does not end the run; failed products are skipped during clustering
+    try:
+        template = model_manager.generate_json('llm', prompt_sample_product, trace_folder=product_trace_folder)
+    except Exception as e:
+        logger.warning(f'failed to generate template for {product}: {e!r}')
+        return None
+    if not is_valid_template(template, product):
+        return None
+    if model_manager.template_cache is not None:
+        model_manager.template_cache.put(product, product_description, template, template_cache_scope(prompt_sample_product_template, model_manager), product_category_name)
+    return template
+
+def spidergen_stages(product_category_name, product_category_description, number_sample_products, model_manager, trace=True, clustering_method='kmeans', clustering_pool=None,
+                     incremental=False, refit_tolerance=0.1, cluster_summary='full', summary_token_budget=4000, final_synthesis='single'):
+    """
+    Builds the stages of the SpiderGen workflow for a product category:
+    similar products -> sample product templates -> process embeddings -> clusters of each life cycle module -> final PFG.
+    The template stages, and the stages which depend on them, are added once the similar products are generated.
 
     Args:
         product_category_name (str): The name of the product category.
         product_category_description (str): A description of the product category.
         number_sample_products (int): The number of sample products to generate.
-        model (ModelManager): The model manager instance to use for generation.
-        trace (bool): Whether to enable tracing for LCA transparency. """
-    
-    # Load prompts
-    with open('procedure_generation/prompts/prompt_for_similar_products.txt', 'r') as f:
-        prompt_similar_products_template = f.read().format(product_category_name, product_category_description, number_sample_products)
-    
-    with open('procedure_generation/prompts/prompt_for_sample_product_template.txt', 'r') as f:
-        prompt_sample_product_template = f.read()
-    
-    with open('procedure_generation/prompts/prompt_for_generating_pfg.txt', 'r') as f:
-        prompt_generating_clusters_template = f.read()
-
-    # If trace is enabled, each step of the generation process will be recorded in a folder
-    if trace:
-        trace_folder = f"./traces/spidergen/{product_category_name.replace(' ', '_')}"
-        os.makedirs(trace_folder, exist_ok=True)
-        os.makedirs(os.path.join(trace_folder, "similar_products"), exist_ok=True)
-        os.makedirs(os.path.join(trace_folder, "sample_products_templates"), exist_ok=True)
-        os.makedirs(os.path.join(trace_folder, "clusters"), exist_ok=True)
-        os.makedirs(os.path.join(trace_folder, "final_pfg"), exist_ok=True)
-    else:
-        trace_folder = None
-        
-    
-    # Generate similar products
-    if trace:
-        trace_path_similar_products = os.path.join(trace_folder, "similar_products")
-        print(trace_path_similar_products)
-        trace_file = os.path.join(trace_path_similar_products, "llm_response.json")
-        if os.path.isfile(trace_file) and trace:
-            with open(trace_file, "r") as f:
-                similar_products_response = json.load(f)
-        else: 
-            similar_products_response = model_manager.generate_json('llm',prompt_similar_products_template, trace_folder=trace_path_similar_products if trace else None)
-    else:
-        similar_products_response = model_manager.generate_json('llm',prompt_similar_products_template, trace_folder=trace_path_similar_products if trace else None)
-    #print("Similar Products Response:", similar_products_response)
-    #generate template for similar products
-    sample_product_response_list = dict({})
-    for product in similar_products_response['product']:
-        prompt_sample_product = prompt_sample_product_template.format(product, similar_products_response['product'][product]['description'])
-        if trace:
-            save_path_sample_product_template = os.path.join(trace_folder, f"sample_products_templates/{product}/llm_response.json")
-            if os.path.exists(save_path_sample_product_template) and trace:
-                with open(save_path_sample_product_template, 'r') as f:
-                    sample_product_response = json.load(f)
+        model_manager (ModelManager): The model manager instance to use for generation.
+        trace (bool): Whether to record the traces and checkpoints of each stage.
+        clustering_method (str): The method used to select the process clusters, either 'kmeans' or 'agglomerative'.
+        clustering_pool (ModuleClusteringPool): The pool of processes to cluster the life cycle modules in, or None to cluster them in the pipeline threads.
+        incremental (bool): Whether to update the clusters of each module from the state of the previous run, which requires tracing.
+        refit_tolerance (float): The largest relative increase of the Davies-Bouldin score of an updated module before it is refitted.
+        cluster_summary (str): The format of the clusters in the final PFG prompt, either 'full' or 'compact'.
+        summary_token_budget (int): The estimated number of tokens of the compact cluster summary.
+        final_synthesis (str): Either 'single', to generate the final PFG in one call, or 'map_reduce', to generate the PFG of
+            each part of SYNTHESIS_PARTS concurrently and merge them.
+
+    Returns:
+        list: The initial stages of the pipeline. """
+    if cluster_summary not in ('compact', 'full'):
+        raise ValueError(f"Unknown cluster summary format '{cluster_summary}'")
+    if final_synthesis not in ('single', 'map_reduce'):
+        raise ValueError(f"Unknown final synthesis '{final_synthesis}'")
+    if incremental and not trace:
+        logger.warning('incremental clustering keeps the state of each module in the trace folder, so it is disabled without tracing')
+        incremental = False
+    prompts = load_prompts()
+    trace_folder = category_trace_folder(product_category_name) if trace else None
+    def checkpoint(*path):
+        return os.path.join(trace_folder, *path) if trace else None
+    llm_config = model_manager.model_config('llm')
+    embedding_model = model_manager.embedding_model_id('embedding_transformer')
+    embedding_cache = model_manager.embedding_cache
+    if incremental and embedding_cache is None:
+        # the embeddings of the previous run are kept in the trace folder, so only new process names are embedded
+        from utils.embedding_cache import EmbeddingCache
+        embedding_cache = EmbeddingCache(checkpoint("embedding_cache"), embedding_model)
+
+    prompt_similar_products = prompts['similar_products'].format(product_category_name, product_category_description, number_sample_products)
+    def generate_similar_products(inputs):
+        response = model_manager.generate_json('llm', prompt_similar_products, trace_folder=checkpoint("similar_products"))
+        if not isinstance(response, dict) or not isinstance(response.get('product'), dict):
+            raise ValueError(f'no similar products were generated for {product_category_name}')
+        return response
+
+    def template_stage(product, product_description):
+        prompt = prompts['sample_product_template'].format(product, product_description)
+        return Stage(f'template:{product}',
+                     lambda inputs: generate_sample_product_template(product, product_description, prompts['sample_product_template'], model_manager, trace_folder, product_category_name),
+                     params=dict({'prompt': str(prompt), 'model': llm_config}),
+                     checkpoint=checkpoint("sample_products_templates", product))
+
+    def cluster_stage(module):
+        def cluster(inputs):
+            encoded_processes, processes_dict, all_processes, sample_weight = module_clustering_job(inputs['processes'], inputs['embeddings'], module)
+            if len(all_processes) == 0:
+                return []
+            job = (encoded_processes, processes_dict, all_processes, sample_weight)
+
+            def fit():
+                if clustering_pool is None:
+                    logger.debug(f'{module.lower()} clusters')
+                    return timed_clustering(encoded_processes, processes_dict, all_processes, method=clustering_method, sample_weight=sample_weight)
+                return clustering_pool.cluster(inputs['processes'], inputs['embeddings'], module, clustering_method)
+
+            update = None
+            if incremental:
+                started = time.perf_counter()
+                fit_seconds = []
+
+                def refit(indices):
+                    clusters, seconds = fit()
+                    fit_seconds.append(seconds)
+                    return [clusters]
+                states = dict({module: load_cluster_state(checkpoint("clusters", module))})
+                [clusters], [update] = recluster_modules(states, [module], [job], refit, clustering_method, refit_tolerance, embedding_model)
+                save_cluster_state(checkpoint("clusters", module), states[module])
+                seconds = fit_seconds[0] if fit_seconds else time.perf_counter() - started
+                logger.debug(f'{module}: {update}')
             else:
-                sample_product_response = model_manager.generate_json('llm', prompt_sample_product, trace_folder=os.path.join(trace_folder,f"sample_products_templates/{product}") if trace else None)
-        else:
-            sample_product_response = model_manager.generate_json('llm', prompt_sample_product, trace_folder=os.path.join(trace_folder,f"sample_products_templates/{product}") if trace else None)
-        sample_product_response_list[product] = sample_product_response
-    
-    # generate semantically similar clusters
-    #prompt_generating_clusters = prompt_generating_clusters_template.format(sample_product_response_list, model.embedding_model_name)
-    clusters_response = get_clusters_summary(sample_product_response_list, model_manager.models['embedding_transformer'])
-    
-    #prompt_generating_clusters = prompt_generating_clusters_template.format(clusters_response, product_category_description)
+                clusters, seconds = fit()
+            get_tracer().record(f'clustering:{module}', 'clustering', seconds, module=module, method=clustering_method, processes=len(all_processes), clusters=len(clusters),
+                                incremental=update)
+            # clusters are stored as [cluster id, processes] pairs, since JSON objects can only have string keys
+            return [[int(cluster_id), cluster_processes] for cluster_id, cluster_processes in clusters.items()]
+        return Stage(f'clusters:{module}', cluster, inputs=['processes', 'embeddings'],
+                     params=dict({'method': clustering_method, 'refit_tolerance': refit_tolerance}) if incremental else dict({'method': clustering_method}),
+                     checkpoint=checkpoint("clusters", module),
+                     depends=lambda inputs: module_clustering_job(inputs['processes'], inputs['embeddings'], module))
+
+    def clusters_summary(inputs, modules):
+        # modules outside of modules are left empty, and skipped by the summaries
+        module_clusters = [{cluster_id: cluster_processes for cluster_id, cluster_processes in inputs[f'clusters:{module}']} if module in modules else dict({})
+                           for module in LIFE_CYCLE_MODULES]
+        clusters_response = summarize_clusters(module_clusters)
+        if cluster_summary == 'compact':
+            full_tokens = estimate_tokens(clusters_response)
+            clusters_response = compact_clusters(module_clusters, inputs['processes'], inputs['embeddings'], token_budget=summary_token_budget)
+            current_span().set(summary_tokens=estimate_tokens(clusters_response), full_summary_tokens=full_tokens)
+            logger.info(f'{product_category_name}: the cluster summary takes about {estimate_tokens(clusters_response)} tokens instead of {full_tokens}')
+        return clusters_response
+
+    def generate_final_pfg(inputs):
+        prompt_generating_clusters = prompts['generating_pfg'].format(product_category_description, clusters_summary(inputs, LIFE_CYCLE_MODULES), product_category_description)
+        response = model_manager.generate_json('llm', prompt_generating_clusters, trace_folder=checkpoint("final_pfg"))
+        if response == {}:
+            return None
+        log_pfg_issues(product_category_name, response)
+        return response
+
+    def generate_sub_pfg(inputs, part):
+        modules = SYNTHESIS_PARTS[part]['modules']
+        if all(len(inputs[f'clusters:{module}']) == 0 for module in modules):
+            return dict({'exlcluded_processes': [], 'processes': dict({})})
+        prompt_generating_sub_pfg = prompts['generating_sub_pfg'].format(product_category_description, SYNTHESIS_PARTS[part]['stage'],
+                                                                         clusters_summary(inputs, modules), product_category_description)
+        response = model_manager.generate_json('llm', prompt_generating_sub_pfg, trace_folder=checkpoint("sub_pfgs", part))
+        if not isinstance(response, dict) or not isinstance(response.get('processes'), dict):
+            logger.warning(f'{product_category_name}: no PFG was generated for the {part} processes')
+            return None
+        return response
 
-    # Combine clusters into final Process Flow Graph
-    prompt_generating_clusters = prompt_generating_clusters_template.format(product_category_description,  clusters_response, product_category_description)
-    final_pfg_response = model_manager.generate_json('llm', prompt_generating_clusters, trace_folder=os.path.join(trace_folder, "final_pfg.json") if trace else None)
+    def merge_sub_pfgs(inputs):
+        # a part which failed is not checkpointed, so only that part is generated again on the next run
+        if any(inputs[f'sub_pfg:{part}'] is None for part in SYNTHESIS_PARTS):
+            return None
+        merged = merge_pfgs([inputs[f'sub_pfg:{part}'] for part in SYNTHESIS_PARTS])
+        if merged.issues:
+            logger.warning(f'{product_category_name}: the merged PFG has {len(merged.issues)} inconsistent nodes or edges, such as: {merged.issues[0]}')
+        return merged.to_dict()
 
-    return final_pfg_response
+    def final_pfg_stages():
+        inputs = dict({part: [f'clusters:{module}' for module in SYNTHESIS_PARTS[part]['modules']] for part in SYNTHESIS_PARTS})
+        inputs['final'] = [f'clusters:{module}' for module in LIFE_CYCLE_MODULES]
+        params = dict({'description': product_category_description, 'model': llm_config})
+        if cluster_summary == 'compact':
+            # the medoids and the numbers of occurrences of the compact summary come from the embeddings and processes
+            params['cluster_summary'] = dict({'format': cluster_summary, 'token_budget': summary_token_budget})
+            inputs = {name: stage_inputs + ['processes', 'embeddings'] for name, stage_inputs in inputs.items()}
+        if final_synthesis == 'single':
+            return [Stage('final_pfg', generate_final_pfg, inputs=inputs['final'], params=dict({'prompt': prompts['generating_pfg'].prefix, **params}),
+                          checkpoint=checkpoint("final_pfg"))]
+        stages = [Stage(f'sub_pfg:{part}', lambda stage_inputs, part=part: generate_sub_pfg(stage_inputs, part), inputs=inputs[part],
+                        params=dict({'prompt': prompts['generating_sub_pfg'].prefix, 'stage': SYNTHESIS_PARTS[part]['stage'], **params}),
+                        checkpoint=checkpoint("sub_pfgs", part))
+                  for part in SYNTHESIS_PARTS]
+        stages.append(Stage('final_pfg', merge_sub_pfgs, inputs=[f'sub_pfg:{part}' for part in SYNTHESIS_PARTS], params=dict({'final_synthesis': final_synthesis}),
+                            checkpoint=checkpoint("final_pfg")))
+        return stages
 
+    def expand(similar_products_response):
+        products = list(similar_products_response['product'])
+        template_names = [f'template:{product}' for product in products]
+        stages = [template_stage(product, similar_products_response['product'][product]['description']) for product in products]
+        # products without a valid template are passed to clustering as "null", and skipped
+        stages.append(Stage('processes',
+                            lambda inputs: collect_processes({product: inputs[name] if inputs[name] is not None else "null" for product, name in zip(products, template_names)}),
+                            inputs=template_names))
+        stages.append(Stage('embeddings',
+                            lambda inputs: embed_processes(inputs['processes'], model_manager.models['embedding_transformer'], embedding_cache),
+                            inputs=['processes'],
+                            params=dict({'model': embedding_model}),
+                            checkpoint=checkpoint("embeddings"),
+                            depends=lambda inputs: all_process_names(inputs['processes'])))
+        stages.extend(cluster_stage(module) for module in LIFE_CYCLE_MODULES)
+        stages.extend(final_pfg_stages())
+        return stages
+
+    return [Stage('similar_products', generate_similar_products,
+                  params=dict({'prompt': str(prompt_similar_products), 'model': llm_config}),
+                  checkpoint=checkpoint("similar_products"),
+                  expand=expand)]
+
+def spidergen(product_category_name, product_category_description, number_sample_products, model_manager, trace=True, max_concurrency=1, clustering_method='kmeans', clustering_jobs=1, corpus_store=None,
+              incremental=False, refit_tolerance=0.1, cluster_summary='full', summary_token_budget=4000, final_synthesis='single'):
+    """
+    Generates a Process Flow Graph for the given product category.
+    With tracing enabled, the output of each stage is checkpointed with a hash of its inputs, prompt and model configuration,
+    so a rerun only recomputes the stages whose inputs changed.
+    The timings, token usage and retries of every stage and LLM call are recorded as spans of one trace, which is
+    saved to instrumentation.json in the trace folder when tracing is enabled. The trace is then cleared from the tracer,
+    so metrics across categories should be collected with a hook such as SpanSummary.
+
+    Args:
+        product_category_name (str): The name of the product category.
+        product_category_description (str): A description of the product category.
+        number_sample_products (int): The number of sample products to generate.
+        model (ModelManager): The model manager instance to use for generation.
+        trace (bool): Whether to enable tracing for LCA transparency.
+        max_concurrency (int): The maximum number of stages, such as sample product templates, to run concurrently.
+        clustering_method (str): The method used to select the process clusters, either 'kmeans' or 'agglomerative'.
+        clustering_jobs (int): The number of processes used to cluster the life cycle modules in parallel.
+        corpus_store (CorpusStore): An optional corpus the PFG, clusters and sample product templates are stored in.
+        incremental (bool): Whether to recluster incrementally: only new process names are embedded, and are assigned to the
+            clusters of the previous run, unless the clusters of their module degrade by more than refit_tolerance. Requires tracing.
+        refit_tolerance (float): The largest relative increase of the Davies-Bouldin score of a module over its last full fit before it is refitted.
+        cluster_summary (str): The format of the clusters in the final PFG prompt: 'full' writes every process of every cluster, as in
+            the paper, and 'compact' writes the medoid, number of occurrences and a few other names of each cluster within summary_token_budget.
+        summary_token_budget (int): The estimated number of tokens (4 characters each) of the compact cluster summary.
+        final_synthesis (str): Either 'single', to generate the final PFG with one call, or 'map_reduce', to generate the PFGs of the
+            upstream (A1-A3), core (A4-A5, B1-B7) and end of life (C1-C4) processes concurrently and stitch them into one PFG. """
+
+    tracer = get_tracer()
+    clustering_pool = None
+    span = None
+    if clustering_jobs > 1:
+        clustering_pool = ModuleClusteringPool(clustering_jobs)
+    try:
+        with tracer.span('spidergen', kind='pipeline', product_category_name=product_category_name, clustering_method=clustering_method) as span:
+            stages = spidergen_stages(product_category_name, product_category_description, number_sample_products, model_manager,
+                                      trace=trace, clustering_method=clustering_method, clustering_pool=clustering_pool,
+                                      incremental=incremental, refit_tolerance=refit_tolerance, cluster_summary=cluster_summary,
+                                      summary_token_budget=summary_token_budget, final_synthesis=final_synthesis)
+            # the clustering stages wait on the pool of processes, so there are enough threads for every clustering job
+            pipeline = Pipeline(stages, max_workers=max(max_concurrency, clustering_jobs))
+            artifacts = pipeline.run()
+            span.set(resumed_stages=len(pipeline.stats['resumed']), computed_stages=len(pipeline.stats['computed']))
+        logger.info(f"{product_category_name}: {len(pipeline.stats['resumed'])} stages resumed from checkpoints, {len(pipeline.stats['computed'])} computed")
+        template_lookups = summarize_spans(tracer.spans(span.trace_id)).get('template_cache:template_cache')
+        if template_lookups is not None:
+            logger.info(f"{product_category_name}: {template_lookups['reused']} of {template_lookups['count']} sample product templates reused from the template cache")
+        logger.debug(f"{product_category_name}: {summarize_spans(tracer.spans(span.trace_id))}")
+        if trace:
+            tracer.export_json(os.path.join(category_trace_folder(product_category_name), 'instrumentation.json'), span.trace_id)
+    finally:
+        if clustering_pool is not None:
+            clustering_pool.shutdown()
+        # the spans were passed to the metrics hooks and exported, so they are not kept for the rest of the process,
+        # unless spidergen runs under a span of the caller, which owns the trace
+        if span is not None and span.parent_id is None:
+            tracer.clear(span.trace_id)
 
+    final_pfg_response = artifacts['final_pfg']
+    if corpus_store is not None and final_pfg_response is not None:
+        corpus_store.ingest(product_category_name, final_pfg_response, description=product_category_description,
+                            module_clusters={module: artifacts[f'clusters:{module}'] for module in LIFE_CYCLE_MODULES},
+                            product_templates={name[len('template:'):]: artifact for name, artifact in artifacts.items() if name.startswith('template:')})
+    return final_pfg_response if final_pfg_response is not None else {}
@@ -0,0 +1,167 @@
+import os
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from procedure_generation.spidergen import (load_prompts, is_valid_template, category_trace_folder, reuse_sample_product_template,
+                                             template_cache_scope)
+from procedure_generation.spidergen_utils import get_clusters_summary
+from utils.model_manager import safe_json_load, write_trace
+from utils.batch_api import run_batch
+from utils.instrumentation import get_tracer
+
+logger = logging.getLogger(__name__)
+
+def generate_json_batch(model_manager, name, prompts, transport, poll_interval=30.0, trace_folders=None, max_concurrency=16):
+    """
+    Generates JSON responses for many prompts with a single batch, reusing cached responses.
+    Requests that fail in the batch, or every request if there is no transport, are sent concurrently with synchronous calls.
+
+    Args:
+        model_manager (ModelManager): The model manager instance to use for generation.
+        name (str): The role of the model to use (i.e, llm).
+        prompts (dict): The prompt for each request, by key.
+        transport (BatchTransport): The transport to submit the batch with, or None if the model has no batch API.
+        poll_interval (float): The number of seconds between checks of the batch status.
+        trace_folders (dict): The trace folder for each request, by key, if tracing is enabled.
+        max_concurrency (int): The maximum number of synchronous calls in flight, which are also limited by the scheduler of the provider.
+
+    Returns:
+        dict: The parsed response for each request, by key. """
+    # custom ids are generated, since batch APIs restrict the characters that they can contain
+    keys = dict({})
+    pending = dict({})
+    responses = dict({})
+    for i, key in enumerate(prompts):
+        cached = model_manager.cached_response(name, prompts[key])
+        if cached is not None:
+            responses[key] = cached
+        else:
+            keys[f'request-{i}'] = key
+            pending[f'request-{i}'] = prompts[key]
+
+    results = run_batch(transport, pending, poll_interval=poll_interval) if transport is not None else dict({})
+    retried = []
+    for custom_id, key in keys.items():
+        response = safe_json_load(results[custom_id]['text']) if custom_id in results else {}
+        if custom_id in results:
+            model_manager.record_batch_call(name, results[custom_id]['usage'], parsed=response != {})
+        if response == {}:
+            retried.append(key)
+        else:
+            model_manager.cache_response(name, prompts[key], response)
+            responses[key] = response
+    if len(retried) > 0:
+        # requests that failed or could not be parsed are retried synchronously, in the context of the caller so their spans are nested under its span
+        with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(retried)))) as executor:
+            futures = {key: executor.submit(contextvars.copy_context().run, model_manager.generate_json, name, prompts[key]) for key in retried}
+        for key, future in futures.items():
+            try:
+                responses[key] = future.result()
+            except Exception as e:
+                # a request which still fails only fails its own category, which is retried when the run is resumed
+                logger.error(f'request {key!r} failed: {e!r}')
+                responses[key] = {}
+
+    if trace_folders:
+        for key, response in responses.items():
+            write_trace(trace_folders[key], name, response)
+    return responses
+
+def spidergen_batch(categories, model_manager, transport=None, number_sample_products=5, poll_interval=30.0, trace=True, clustering_method='kmeans', clustering_jobs=1,
+                    cluster_summary='full', summary_token_budget=4000):
+    """
+    Generates Process Flow Graphs for many product categories through the batch API of the LLM.
+    The similar products, sample product templates and final PFGs of every category are each submitted as one batch.
+
+    Args:
+        categories (list): The product_category_name, product_category_description and optionally number_sample_products of each category.
+        model_manager (ModelManager): The model manager instance to use for generation.
+        transport (BatchTransport): The transport to submit the batches with, by default the batch API of the 'llm' model,
+            or concurrent synchronous calls if it has none.
+        number_sample_products (int): The number of sample products for categories which do not set their own.
+        poll_interval (float): The number of seconds between checks of the batch status.
+        trace (bool): Whether to enable tracing for LCA transparency.
+        clustering_method (str): The method used to select the process clusters, either 'kmeans' or 'agglomerative'.
+        clustering_jobs (int): The number of processes used to cluster the life cycle modules in parallel.
+        cluster_summary (str): The format of the clusters in the final PFG prompts, either 'full' or 'compact'.
+        summary_token_budget (int): The estimated number of tokens of the compact cluster summary of each category.
+
+    Returns:
+        list: The PFG of each category, in the order of categories, or None for categories that could not be generated. """
+    tracer = get_tracer()
+    span = None
+    try:
+        with tracer.span('spidergen_batch', kind='pipeline', categories=len(categories), clustering_method=clustering_method) as span:
+            return _spidergen_batch(categories, model_manager, transport, number_sample_products, poll_interval, trace, clustering_method, clustering_jobs,
+                                    cluster_summary, summary_token_budget)
+    finally:
+        # the LLM calls, embeddings and clusterings of every category are nested under the span, and are not kept once they were passed to the metrics hooks
+        if span is not None and span.parent_id is None:
+            tracer.clear(span.trace_id)
+
+def _spidergen_batch(categories, model_manager, transport, number_sample_products, poll_interval, trace, clustering_method, clustering_jobs,
+                     cluster_summary, summary_token_budget):
+    if transport is None:
+        try:
+            transport = model_manager.batch_transport('llm')
+        except ValueError as e:
+            logger.warning(f'{e}, the requests are sent with concurrent synchronous calls instead')
+    prompts = load_prompts()
+    trace_roots = [category_trace_folder(category['product_category_name']) if trace else None for category in categories]
+
+    # Generate similar products for every category
+    similar_products_prompts = dict({})
+    for i, category in enumerate(categories):
+        similar_products_prompts[i] = prompts['similar_products'].format(
+            category['product_category_name'],
+            category['product_category_description'],
+            category.get('number_sample_products', number_sample_products))
+    similar_products = generate_json_batch(model_manager, 'llm', similar_products_prompts, transport, poll_interval,
+                                           {i: os.path.join(trace_roots[i], 'similar_products') for i in range(len(categories))} if trace else None)
+
+    # Generate the templates of the sample products of every category, except those reused from the template cache
+    template_prompts = dict({})
+    template_traces = dict({})
+    reused_templates = dict({})
+    product_descriptions = dict({})
+    for i in range(len(categories)):
+        products = similar_products[i].get('product', dict({})) if isinstance(similar_products[i], dict) else dict({})
+        for product in products:
+            product_descriptions[(i, product)] = products[product]['description']
+            template_trace = os.path.join(trace_roots[i], f"sample_products_templates/{product}") if trace else None
+            template = reuse_sample_product_template(product, products[product]['description'], prompts['sample_product_template'], model_manager, template_trace)
+            if template is not None:
+                reused_templates[(i, product)] = template
+                continue
+            template_prompts[(i, product)] = prompts['sample_product_template'].format(product, products[product]['description'])
+            if trace:
+                template_traces[(i, product)] = template_trace
+    generated_templates = generate_json_batch(model_manager, 'llm', template_prompts, transport, poll_interval, template_traces if trace else None)
+    if model_manager.template_cache is not None:
+        scope = template_cache_scope(prompts['sample_product_template'], model_manager)
+        for (i, product), template in generated_templates.items():
+            if isinstance(template, dict) and 'processes' in template:
+                model_manager.template_cache.put(product, product_descriptions[(i, product)], template, scope, categories[i]['product_category_name'])
+        logger.info(f"{len(reused_templates)} of {len(product_descriptions)} sample product templates reused from the template cache")
+    # the templates are kept in the order of the similar products, whether they were reused or generated
+    templates = {key: reused_templates[key] if key in reused_templates else generated_templates.get(key) for key in product_descriptions}
+
+    # Cluster the processes of each category locally, and generate the final PFGs
+    pfg_prompts = dict({})
+    for i, category in enumerate(categories):
+        sample_product_response_list = dict({})
+        for (j, product), template in templates.items():
+            if j == i:
+                sample_product_response_list[product] = template if is_valid_template(template, product) else "null"
+        if len(sample_product_response_list) == 0:
+            logger.warning(f"no sample products were generated for {category['product_category_name']}")
+            continue
+        clusters_response = get_clusters_summary(sample_product_response_list, model_manager.models['embedding_transformer'],
+                                                 embedding_cache=model_manager.embedding_cache, clustering_method=clustering_method, n_jobs=clustering_jobs,
+                                                 summary_format='compact' if cluster_summary == 'compact' else 'array', summary_token_budget=summary_token_budget)
+        pfg_prompts[i] = prompts['generating_pfg'].format(category['product_category_description'], clusters_response, category['product_category_description'])
+    final_pfgs = generate_json_batch(model_manager, 'llm', pfg_prompts, transport, poll_interval,
+                                     {i: os.path.join(trace_roots[i], 'final_pfg') for i in pfg_prompts} if trace else None)
+
+    # a final PFG that could not be parsed is returned as None, like a category without sample products
+    return [final_pfgs.get(i) or None for i in range(len(categories))]
@@ -1,341 +1,412 @@
 '''
 Supporting functions and utilities for SpiderGen proceedure generation
 '''
+import os
+import re
+import time
+import logging
+import threading
+import unicodedata
 import numpy as np
 import json
-from sklearn.cluster import KMeans
-from sklearn.metrics import davies_bouldin_score
-import json
-import networkx as nx
-import matplotlib.pyplot as plt
-from matplotlib.patches import FancyBboxPatch
-import matplotlib.patches as mpatches
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from procedure_generation.cluster_selection import candidate_cluster_counts, select_clusters
+from procedure_generation.incremental_clustering import recluster_modules
+from procedure_generation.cluster_summary import order_cluster, compact_cluster_summary
+from procedure_generation.pfg_graph import CATEGORIES, PROCESS_KINDS, as_pfg_graph
+from procedure_generation.pfg_render import layered_layout, render_svg, render_dot, wrap_label
+from utils.instrumentation import get_tracer
 '''
 Additional utilities needed to run spidergen, as well as tools to visualize spidergen results
 '''
-def get_k_means_clustering(encoded_processes, processes_dict, all_processes):
+logger = logging.getLogger(__name__)
+
+def get_k_means_clustering(encoded_processes, processes_dict, all_processes, method='kmeans', sample_weight=None):
     '''
     gets the clusters of related processes
 
     encoded_processes: encoded processes of sample products
     processes_dict: dictionary of processes for all sample products
     all_processes: list of all processes for for all sample products combined
+    method: method used to fit the candidate numbers of clusters, either 'kmeans' or 'agglomerative'
+    sample_weight: optional number of occurrences of each process, used to weight the kmeans fit
 
     returns a dictionary with the clustered processes for a life cycle stage
     '''
     
     # If no processes exist for this category of processes, return an empty dictionary
     if len(all_processes) == 0:
-        print('none of the processes')
+        logger.debug('none of the processes')
         return {}
-    
 
-    # Step 1: Determining the optimal number of clusters based on the similarity within each cluster
+    # Determining the optimal number of clusters based on the similarity within each cluster.
+    # Each candidate number of clusters is fitted once, and the labels of the lowest davies bouldin score are kept
+    candidate_ks = candidate_cluster_counts(processes_dict, len(all_processes))
+    selection = select_clusters(encoded_processes, candidate_ks, method=method, sample_weight=sample_weight)
+    for k, score in selection['scores'].items():
+        logger.debug(f'davies bouldin score for {k} clusters: {score:.4f}')
+    cluster_assignment = selection['labels']
+    
+    #formatting the clusters into a dictionary, using insertion ordered dictionaries as sets to drop repeated processes
+    cluster_sets = {}
+    for sentence, cluster_id in zip(all_processes, cluster_assignment):
+        cluster_sets.setdefault(cluster_id, dict({}))[sentence] = None
+    clusters = {cluster_id: list(cluster_sentences) for cluster_id, cluster_sentences in cluster_sets.items()}
+        
+    if logger.isEnabledFor(logging.DEBUG):
+        for cluster_id, cluster_sentences in clusters.items():
+            logger.debug(f"Cluster {cluster_id}:\n" + '\n'.join(f"  - {sent}" for sent in cluster_sentences))
+    return clusters
 
-    # Determining the search space for number of clusters - can be at least the minimum number of processes, and at most the maximum number of processes for each sample product 
-    nums = []
-    for item in processes_dict:
-        nums.append(len(processes_dict[item]))
-    n_clusters_num = int(np.floor(np.mean(np.array(nums))))
-    n_min_clusters_num = min(nums)
-    n_max_clusters_num = max(nums)
+def timed_clustering(encoded_processes, processes_dict, all_processes, method='kmeans', sample_weight=None):
+    '''
+    clusters the processes of a module with get_k_means_clustering, timing it where it runs, such as in a worker process
 
-    # if the average number of processes in each prodcut is 1 or less, we set the number of clusters to 1
-    if n_clusters_num <= 1:
-        n_clusters_num_arr = [1]
-    else:
-    
-    #otherwise, we set a range of potential numbers of clusters from min to max
-        n_clusters_num_arr = []
-        for i in range(n_min_clusters_num, n_max_clusters_num+1, 1):
-            if i == 0:
-                continue
-            else:
-                n_clusters_num_arr.append(i)
-    #we systematically test each number of clusters and compute the davies bouldin score to determine the best number of clusters
-    best_k = []
-    if n_clusters_num_arr == [1]:
-        best_val_k = 1
-        clustering_model = KMeans(n_clusters=best_val_k, random_state=0)
-        clustering_model.fit(encoded_processes)
-        cluster_assignment = clustering_model.labels_
+    returns the clusters and the seconds taken
+    '''
+    started = time.perf_counter()
+    clusters = get_k_means_clustering(encoded_processes, processes_dict, all_processes, method=method, sample_weight=sample_weight)
+    return clusters, time.perf_counter() - started
+
+LIFE_CYCLE_MODULES = ['A1', 'A2', 'A3', 'A4', 'A5', 'B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'C1', 'C2', 'C3', 'C4']
+
+def collect_module_processes(product_templates):
+    '''
+    collects the processes of all sample products for each life cycle module
+    product_templates: product templates for all sample products
+
+    returns: a dictionary of the processes of each sample product per module, and a list of all processes per module
+    '''
+    module_dicts = {module: dict({}) for module in LIFE_CYCLE_MODULES}
+    module_processes = {module: [] for module in LIFE_CYCLE_MODULES}
+    for item in product_templates:
+        logger.debug(f'processing item: {item}')
+        curr_product = product_templates[item]
+        if curr_product == "null":
+            logger.info(f'skipping nulled product {item}')
+            continue
+        if len(curr_product['processes']) == 0:
+            continue
+        for module in LIFE_CYCLE_MODULES:
+            module_dicts[module][item] = []
+            for process in curr_product['processes'].get(f'{module} Processes', {}):
+                if process != 'N/A':
+                    module_dicts[module][item].append(process)
+                    module_processes[module].append(process)
+    return module_dicts, module_processes
+
+def canonicalize_process_name(process):
+    '''
+    normalizes a process name so that names which only differ in case, whitespace or punctuation compare equal
+    '''
+    process = unicodedata.normalize('NFKC', str(process)).casefold()
+    process = re.sub(r'[^\w\s]', ' ', process)
+    return ' '.join(process.split())
+
+def canonicalize_processes(processes):
+    '''
+    collapses processes with the same canonical name
+    processes: list of process names, which may contain repeated or trivially different names
+
+    returns: a list with the first spelling of each distinct process, and the number of occurrences of each
+    '''
+    groups = dict({})
+    names = []
+    counts = []
+    for process in processes:
+        key = canonicalize_process_name(process)
+        if key not in groups:
+            groups[key] = len(names)
+            names.append(process)
+            counts.append(0)
+        counts[groups[key]] += 1
+    return names, counts
+
+def encode_unique(transformer_model, sentences, embedding_cache=None):
+    '''
+    encodes each distinct sentence once, in a single batch
+    transformer_model: embedding model to use for generating embeddings
+    sentences: list of sentences, which may contain duplicates
+    embedding_cache: optional EmbeddingCache used to skip sentences embedded in previous runs
+
+    returns: the embeddings of the distinct sentences, and a dictionary mapping each sentence to its row
+    '''
+    unique_sentences = list(dict.fromkeys(sentences))
+    if embedding_cache is not None:
+        embeddings = embedding_cache.encode(transformer_model, unique_sentences)
     else:
-        for j in set(nums):
-            if j == 0:
-                continue
-            if j == 1:
-                continue
-            clustering_model = KMeans(n_clusters=j, random_state=0)
-            score = davies_bouldin_score(encoded_processes, clustering_model.fit_predict(encoded_processes))
-            best_k.append(score)
-        
-        # we select the number of clusters that gives the lowest davies bouldin score, and create that number of clusters
-        best_val_k1 = n_clusters_num_arr[np.argmin(best_k)]
-        clustering_model = KMeans(n_clusters=best_val_k1, random_state=0)
-        clustering_model.fit(encoded_processes)
-        cluster_assignment = clustering_model.labels_
-    
-    #formatting the clusters into a dictionary
-    clusters = {}
-    for i, sentence in enumerate(np.array(all_processes)):
-        cluster_id = cluster_assignment[i]
-        if cluster_id not in clusters:
-            clusters[cluster_id] = []
-        if sentence not in clusters[cluster_id]:
-            clusters[cluster_id].append(sentence)
-        
-    for cluster_id, cluster_sentences in clusters.items():
-        print(f"\nCluster {cluster_id}:")
-        for sent in cluster_sentences:
-            print(f"  - {sent}")
-    return clusters
+        embeddings = transformer_model.encode(np.array(unique_sentences), normalize_embeddings=True)
+    return embeddings, {sentence: row for row, sentence in enumerate(unique_sentences)}
+
+def _init_clustering_worker(threads_per_worker):
+    # cap the BLAS and OpenMP threads of each worker so that the workers do not oversubscribe the cores
+    for variable in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[variable] = str(threads_per_worker)
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(limits=threads_per_worker)
+
+def _cluster_module_worker(shm_name, shape, dtype, start, end, processes_dict, all_processes, sample_weight, method):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    encoded_processes = None
+    try:
+        # the rows of the module are a contiguous block of the shared matrix, so this is a view rather than a copy
+        encoded_processes = np.ndarray(shape, dtype=dtype, buffer=shm.buf)[start:end]
+        return timed_clustering(encoded_processes, processes_dict, all_processes, method=method, sample_weight=sample_weight)
+    finally:
+        # the view has to be released before the shared memory can be closed
+        encoded_processes = None
+        shm.close()
+
+def clustering_process_pool(n_jobs):
+    '''
+    returns a pool of n_jobs processes for clustering, which share the cores between their BLAS threads
+    '''
+    threads_per_worker = max(1, (os.cpu_count() or 1) // n_jobs)
+    return ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_clustering_worker, initargs=(threads_per_worker,))
+
+class SharedModuleEmbeddings:
+    '''
+    Embeddings of several life cycle modules laid out back to back in one block of shared memory, so that a clustering
+    job sent to a worker process only pickles the bounds of its rows instead of its embeddings.
+    '''
+    def __init__(self, module_jobs):
+        '''
+        module_jobs: list of (encoded_processes, processes_dict, all_processes, sample_weight) for each module
+        '''
+        self.module_jobs = module_jobs
+        matrix = np.ascontiguousarray(np.concatenate([job[0] for job in module_jobs]))
+        self.shape = matrix.shape
+        self.dtype = matrix.dtype.str
+        self.shm = shared_memory.SharedMemory(create=True, size=max(matrix.nbytes, 1))
+        np.ndarray(matrix.shape, dtype=matrix.dtype, buffer=self.shm.buf)[:] = matrix
+        self.bounds = []
+        start = 0
+        for job in module_jobs:
+            self.bounds.append((start, start + len(job[0])))
+            start += len(job[0])
+
+    def submit(self, executor, i, clustering_method='kmeans'):
+        '''
+        submits the clustering of the module at index i of module_jobs to executor
+
+        returns a future of the clusters and the seconds taken
+        '''
+        _, processes_dict, all_processes, sample_weight = self.module_jobs[i]
+        start, end = self.bounds[i]
+        return executor.submit(_cluster_module_worker, self.shm.name, self.shape, self.dtype, start, end, processes_dict, all_processes, sample_weight, clustering_method)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+def cluster_modules_in_parallel(module_jobs, n_jobs, clustering_method='kmeans', modules=None):
+    '''
+    clusters the processes of several life cycle modules in a pool of processes
+    module_jobs: list of (encoded_processes, processes_dict, all_processes, sample_weight) for each module
+    n_jobs: number of worker processes
+    clustering_method: method used to select the clusters of each module
+    modules: names of the modules of module_jobs, used to label the clustering span of each module
+
+    returns: the clusters of each module, in the order of module_jobs
+    '''
+    shared_embeddings = SharedModuleEmbeddings(module_jobs)
+    try:
+        with clustering_process_pool(n_jobs) as executor:
+            futures = [shared_embeddings.submit(executor, i, clustering_method) for i in range(len(module_jobs))]
+            processes_list = []
+            for i, future in enumerate(futures):
+                clusters, seconds = future.result()
+                get_tracer().record(f'clustering:{modules[i] if modules else i}', 'clustering', seconds, module=modules[i] if modules else None,
+                                    method=clustering_method, processes=len(module_jobs[i][2]), clusters=len(clusters))
+                processes_list.append(clusters)
+            return processes_list
+    finally:
+        shared_embeddings.close()
+
+class ModuleClusteringPool:
+    '''
+    Pool of processes clustering the life cycle modules of the pipeline stages. The embeddings of every module are put
+    in one block of shared memory when the first module of a run is clustered, and reused by the other modules.
+    '''
+    def __init__(self, n_jobs):
+        self.executor = clustering_process_pool(n_jobs)
+        self.lock = threading.Lock()
+        self.embeddings = None
+        self.modules = []
+        self.shared_embeddings = None
+
+    def cluster(self, processes, embeddings, module, clustering_method='kmeans'):
+        '''
+        clusters the processes of module in a worker process
+        processes: processes collected by collect_processes
+        embeddings: embeddings returned by embed_processes
+
+        returns the clusters and the seconds taken
+        '''
+        with self.lock:
+            if self.embeddings is not embeddings:
+                if self.shared_embeddings is not None:
+                    self.shared_embeddings.close()
+                self.modules = [name for name in LIFE_CYCLE_MODULES if len(processes['module_names'][name]) > 0]
+                self.shared_embeddings = SharedModuleEmbeddings([module_clustering_job(processes, embeddings, name) for name in self.modules])
+                self.embeddings = embeddings
+            shared_embeddings = self.shared_embeddings
+        return shared_embeddings.submit(self.executor, self.modules.index(module), clustering_method).result()
+
+    def shutdown(self):
+        self.executor.shutdown()
+        if self.shared_embeddings is not None:
+            self.shared_embeddings.close()
+            self.shared_embeddings = None
 
-def get_clusters_summary(product_templates, transformer_model):
+def collect_processes(product_templates):
+    '''
+    collects the distinct processes of each life cycle module, collapsing repeated and trivially different process names
+    product_templates: product templates for all sample products
+
+    returns: a dictionary with the processes of each sample product per module ('module_dicts'), and the distinct process
+    names ('module_names') and their number of occurrences ('module_counts') per module
+    '''
+    module_dicts, module_processes = collect_module_processes(product_templates)
+    module_names = dict({})
+    module_counts = dict({})
+    for module in LIFE_CYCLE_MODULES:
+        module_names[module], module_counts[module] = canonicalize_processes(module_processes[module])
+    return dict({'module_dicts': module_dicts, 'module_names': module_names, 'module_counts': module_counts})
+
+def all_process_names(processes):
+    '''
+    returns the distinct process names of every module, in the order of the rows of their embeddings
+    '''
+    return list(dict.fromkeys(process for module in LIFE_CYCLE_MODULES for process in processes['module_names'][module]))
+
+def embed_processes(processes, transformer_model, embedding_cache=None):
+    '''
+    embeds the distinct processes of every module in one batch
+    processes: processes collected by collect_processes
+    transformer_model: embedding model to use for generating embeddings
+    embedding_cache: optional EmbeddingCache used to skip processes embedded in previous runs
+
+    returns: the embeddings, with one row per name of all_process_names
+    '''
+    names = all_process_names(processes)
+    if len(names) == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+    # the processes of every module are embedded in one batch, so the batch reports the number of processes of each module
+    module_rows = {module: len(processes['module_names'][module]) for module in LIFE_CYCLE_MODULES}
+    with get_tracer().span('embeddings', kind='embedding', processes=len(names), module_processes=module_rows, cached=embedding_cache is not None):
+        embeddings, _ = encode_unique(transformer_model, names, embedding_cache)
+    return np.asarray(embeddings)
+
+def module_clustering_job(processes, embeddings, module):
+    '''
+    slices the embeddings of one module out of the embeddings of all processes
+    processes: processes collected by collect_processes
+    embeddings: embeddings returned by embed_processes
+
+    returns: (encoded_processes, processes_dict, all_processes, sample_weight) for get_k_means_clustering
+    '''
+    rows = {process: row for row, process in enumerate(all_process_names(processes))}
+    names = processes['module_names'][module]
+    encoded_processes = embeddings[[rows[process] for process in names]] if len(names) > 0 else np.zeros((0, 0), dtype=np.float32)
+    return encoded_processes, processes['module_dicts'][module], names, np.array(processes['module_counts'][module], dtype=float)
+
+def summarize_clusters(module_clusters):
+    '''
+    combines the clusters of every module which has processes, for the final PFG prompt
+    module_clusters: list of the clusters of each module, in the order of LIFE_CYCLE_MODULES
+    '''
+    return np.array([clusters for clusters in module_clusters if len(clusters) > 0]).flatten()
+
+def compact_clusters(module_clusters, processes, embeddings, token_budget=4000, max_variants=5):
+    '''
+    writes the clusters of every module compactly for the final PFG prompt, with the medoid, number of occurrences
+    and a few other names of each cluster
+    module_clusters: list of the clusters of each module, in the order of LIFE_CYCLE_MODULES
+    processes: processes collected by collect_processes
+    embeddings: embeddings returned by embed_processes
+    token_budget: estimated number of tokens the summary should fit in
+    max_variants: largest number of names shown for each cluster besides its medoid
+    '''
+    rows = {process: row for row, process in enumerate(all_process_names(processes))}
+    summary = dict({})
+    for module, clusters in zip(LIFE_CYCLE_MODULES, module_clusters):
+        if len(clusters) == 0:
+            continue
+        counts = dict(zip(processes['module_names'][module], processes['module_counts'][module]))
+        summary[module] = []
+        for cluster_processes in clusters.values():
+            cluster_counts = [counts.get(process, 1) for process in cluster_processes]
+            summary[module].append((order_cluster(cluster_processes, embeddings[[rows[process] for process in cluster_processes]], cluster_counts),
+                                    int(sum(cluster_counts))))
+    return compact_cluster_summary(summary, token_budget=token_budget, max_variants=max_variants)
+
+def get_clusters_summary(product_templates, transformer_model, embedding_cache=None, clustering_method='kmeans', n_jobs=1, cluster_states=None, refit_tolerance=0.1,
+                         summary_format='array', summary_token_budget=4000):
     '''
     generating clusters for all processes in all parts of the life cycle, based on EPD International guidelines for processes
     product_templates: product templates for all sample products
     transformer_model: embedding model to use for generating embeddings
+    embedding_cache: optional EmbeddingCache used to skip processes embedded in previous runs
+    clustering_method: method used to select the clusters of each module, either 'kmeans' or 'agglomerative'
+    n_jobs: number of processes to cluster the modules with, the modules are clustered serially if this is 1
+    cluster_states: optional dictionary of the cluster state of each module from a previous call, which is updated in place,
+        so that only the modules whose clusters degrade by more than refit_tolerance are refitted
+    refit_tolerance: largest relative increase of the davies bouldin score of an updated module over its last full fit
+    summary_format: 'array' to return the clusters as an array, or 'compact' to return the text of compact_clusters
+    summary_token_budget: estimated number of tokens of the compact summary
 
     returns: clusters for all processes in all parts of the life cycle
     '''
+    # collapse repeated and trivially different process names, keeping their number of occurrences as weights
+    processes = collect_processes(product_templates)
+    if len(all_process_names(processes)) == 0:
+        return np.array([]).flatten() if summary_format == 'array' else ''
+    embeddings = embed_processes(processes, transformer_model, embedding_cache)
 
-    A1_dict = dict({})
-    A2_dict = dict({})
-    A3_dict = dict({})
-    A4_dict = dict({})
-    A5_dict = dict({})
-
-    B1_dict = dict({})
-    B2_dict = dict({})
-    B3_dict = dict({})
-    B4_dict = dict({})
-    B5_dict = dict({})
-    B6_dict = dict({})
-    B7_dict = dict({})
-
-    C1_dict = dict({})
-    C2_dict = dict({})
-    C3_dict = dict({})
-    C4_dict = dict({})
-
-    all_A1 = []
-    all_A2 = []
-    all_A3 = []
-    all_A4 = []
-    all_A5 = []
-    all_B1 = []
-    all_B2 = []
-    all_B3 = []
-    all_B4 = []
-    all_B5 = []
-    all_B6 = []
-    all_B7 = []
-    all_C1 = []
-    all_C2 = []
-    all_C3 = []
-    all_C4 = []
-    for item in product_templates:
-        print('processing item:', item)
-        print(product_templates)
-        curr_product = product_templates[item]
-        print(item)
-        if curr_product == "null":
-            print('skipping nulled product')
-            continue
-        for process in curr_product['processes']:
-            #print(process)
-            A1_dict[item] = []
-            for a1 in curr_product['processes']['A1 Processes']:
-                if a1 != 'N/A':
-                    A1_dict[item].append(a1)
-                    all_A1.append(a1)
-            A2_dict[item] = []
-            for a2 in curr_product['processes']['A2 Processes']:
-                if a2 != 'N/A':
-                    A2_dict[item].append(a2)
-                    all_A2.append(a2)
-            A3_dict[item] = []
-            for a3 in curr_product['processes']['A3 Processes']:
-                if a3 != 'N/A':
-                    A3_dict[item].append(a3)
-                    all_A3.append(a3)
-            A4_dict[item] = []
-            for a4 in curr_product['processes']['A4 Processes']:
-                if a4 != 'N/A':
-                    A4_dict[item].append(a4)
-                    all_A4.append(a4)
-            A5_dict[item] = []
-            for a5 in curr_product['processes']['A5 Processes']:
-                if a5 != 'N/A':
-                    A5_dict[item].append(a5)
-                    all_A5.append(a5)
-            B1_dict[item] = []
-            for b1 in curr_product['processes']['B1 Processes']:
-                if b1 != 'N/A':
-                    B1_dict[item].append(b1)
-                    all_B1.append(b1)
-            B2_dict[item] = []
-            for b2 in curr_product['processes']['B2 Processes']:
-                if b2 != 'N/A':
-                    B2_dict[item].append(b2)
-                    all_B2.append(b2)
-            B3_dict[item] = []
-            for b3 in curr_product['processes']['B3 Processes']:
-                if b3 != 'N/A':
-                    B3_dict[item].append(b3)
-                    all_B3.append(b3)
-            B4_dict[item] = []
-            for b4 in curr_product['processes']['B4 Processes']:
-                if b4 != 'N/A':
-                    B4_dict[item].append(b4)
-                    all_B4.append(b4)
-            B5_dict[item] = []
-            for b5 in curr_product['processes']['B5 Processes']:
-                if b5 != 'N/A':
-                    B5_dict[item].append(b5)
-                    all_B5.append(b5)
-            B6_dict[item] = []
-            for b6 in curr_product['processes']['B6 Processes']:
-                if b6 != 'N/A':
-                    B6_dict[item].append(b6)
-                    all_B6.append(b6)
-            B7_dict[item] = []
-            for b7 in curr_product['processes']['B7 Processes']:
-                if b7 != 'N/A':
-                    B7_dict[item].append(b7)
-                    all_B7.append(b7)
-            C1_dict[item] = []
-            for c1 in curr_product['processes']['C1 Processes']:
-                if c1 != 'N/A':
-                    C1_dict[item].append(c1)
-                    all_C1.append(c1)
-            C2_dict[item] = []
-            for c2 in curr_product['processes']['C2 Processes']:
-                if c2 != 'N/A':
-                    C2_dict[item].append(c2)
-                    all_C2.append(c2)
-            C3_dict[item] = []
-            for c3 in curr_product['processes']['C3 Processes']:
-                if c3 != 'N/A':
-                    C3_dict[item].append(c3)
-                    all_C3.append(c3)
-            C4_dict[item] = []
-            for c4 in curr_product['processes']['C4 Processes']:
-                if c4 != 'N/A':
-                    C4_dict[item].append(c4)
-                    all_C4.append(c4)
-            
-    print('start clustering within dictionaries')
-    processes_list = []
-    if len(all_A1) > 0:
-        encoded_processes_a1 = transformer_model.encode(np.array(all_A1), normalize_embeddings=True)
-        print('a1 clusters')
-        a1_clusters = get_k_means_clustering(encoded_processes_a1, A1_dict, all_A1)
-        processes_list.append(a1_clusters)
-    
-    if len(all_A2) > 0:
-        encoded_processes_a2 = transformer_model.encode(np.array(all_A2), normalize_embeddings=True)
-        print('a2 clusters')
-        a2_clusters = get_k_means_clustering(encoded_processes_a2, A2_dict, all_A2)
-        processes_list.append(a2_clusters)
-    
-    if len(all_A3) > 0:
-        encoded_processes_a3 = transformer_model.encode(np.array(all_A3), normalize_embeddings=True)
-        print('a3 clusters')
-        a3_clusters = get_k_means_clustering(encoded_processes_a3, A3_dict, all_A3)
-        processes_list.append(a3_clusters)
-
-    if len(all_A4) > 0:
-        encoded_processes_a4 = transformer_model.encode(np.array(all_A4), normalize_embeddings=True)
-        print('a4 clusters')
-        a4_clusters = get_k_means_clustering(encoded_processes_a4, A4_dict, all_A4)
-        processes_list.append(a4_clusters)
-    if len(all_A5) > 0:
-        encoded_processes_a5 = transformer_model.encode(np.array(all_A5), normalize_embeddings=True)
-        print('a5 clusters')
-        a5_clusters = get_k_means_clustering(encoded_processes_a5, A5_dict, all_A5)
-        processes_list.append(a5_clusters)
-    
-    if len(all_B1) > 0:
-        encoded_processes_b1 = transformer_model.encode(np.array(all_B1), normalize_embeddings=True)
-        print('b1 clusters')
-        b1_clusters = get_k_means_clustering(encoded_processes_b1, B1_dict, all_B1)
-        processes_list.append(b1_clusters)
-    
-    if len(all_B2) > 0:
-        encoded_processes_b2 = transformer_model.encode(np.array(all_B2), normalize_embeddings=True)
-        print('b2 clusters')
-        b2_clusters = get_k_means_clustering(encoded_processes_b2, B2_dict, all_B2)
-        processes_list.append(b2_clusters)
-    
-    if len(all_B3) > 0:
-        encoded_processes_b3 = transformer_model.encode(np.array(all_B3), normalize_embeddings=True)
-        print('b3 clusters')
-        b3_clusters = get_k_means_clustering(encoded_processes_b3, B3_dict, all_B3)
-        processes_list.append(b3_clusters)
-    
-    if len(all_B4) > 0:
-        encoded_processes_b4 = transformer_model.encode(np.array(all_B4), normalize_embeddings=True)
-        print('b1 clusters')
-        b4_clusters = get_k_means_clustering(encoded_processes_b4, B4_dict, all_B4)
-        processes_list.append(b4_clusters)
-    
-    if len(all_B5) > 0:
-        encoded_processes_b5 = transformer_model.encode(np.array(all_B5), normalize_embeddings=True)
-        print('b5 clusters')
-        b5_clusters = get_k_means_clustering(encoded_processes_b5, B5_dict, all_B5)
-        processes_list.append(b5_clusters)
-    
-    if len(all_B6) > 0:
-        encoded_processes_b6 = transformer_model.encode(np.array(all_B6), normalize_embeddings=True)
-        print('b6 clusters')
-        b6_clusters = get_k_means_clustering(encoded_processes_b6, B6_dict, all_B6)
-        processes_list.append(b6_clusters)
-    
-    if len(all_B7) > 0:
-        encoded_processes_b7 = transformer_model.encode(np.array(all_B7), normalize_embeddings=True)
-        print('b7 clusters')
-        b7_clusters = get_k_means_clustering(encoded_processes_b7, B7_dict, all_B7)
-        processes_list.append(b7_clusters)
-    
-    if len(all_C1) > 0:
-        encoded_processes_c1 = transformer_model.encode(np.array(all_C1), normalize_embeddings=True)
-        print('c1 clusters')
-        c1_clusters = get_k_means_clustering(encoded_processes_c1, C1_dict, all_C1)
-        processes_list.append(c1_clusters)
-    
-    if len(all_C2) > 0:
-        encoded_processes_c2 = transformer_model.encode(np.array(all_C2), normalize_embeddings=True)
-        print('c2 clusters')
-        c2_clusters = get_k_means_clustering(encoded_processes_c2, C2_dict, all_C2)
-        processes_list.append(c2_clusters)
-    
-    if len(all_C3) > 0:
-        encoded_processes_c3 = transformer_model.encode(np.array(all_C3), normalize_embeddings=True)
-        print('c3 clusters')
-        c3_clusters = get_k_means_clustering(encoded_processes_c3, C3_dict, all_C3)
-        processes_list.append(c3_clusters)
-    
-    if len(all_C4) > 0:
-        encoded_processes_c4 = transformer_model.encode(np.array(all_C4), normalize_embeddings=True)
-        print('c4 clusters')
-        c4_clusters = get_k_means_clustering(encoded_processes_c4, C4_dict, all_C4)
-        processes_list.append(c4_clusters)
-    
-    return np.array(processes_list).flatten()
+    logger.debug('start clustering within dictionaries')
+    modules = [module for module in LIFE_CYCLE_MODULES if len(processes['module_names'][module]) > 0]
+    module_jobs = [module_clustering_job(processes, embeddings, module) for module in modules]
+
+    def refit(indices):
+        if n_jobs > 1 and len(indices) > 1:
+            return cluster_modules_in_parallel([module_jobs[i] for i in indices], min(n_jobs, len(indices)), clustering_method, [modules[i] for i in indices])
+        refitted = []
+        for i in indices:
+            encoded_processes, processes_dict, all_processes, sample_weight = module_jobs[i]
+            logger.debug(f'{modules[i].lower()} clusters')
+            with get_tracer().span(f'clustering:{modules[i]}', kind='clustering', module=modules[i], method=clustering_method, processes=len(all_processes)) as span:
+                refitted.append(get_k_means_clustering(encoded_processes, processes_dict, all_processes, method=clustering_method, sample_weight=sample_weight))
+                span.set(clusters=len(refitted[-1]))
+        return refitted
+
+    if cluster_states is not None:
+        processes_list, updates = recluster_modules(cluster_states, modules, module_jobs, refit, clustering_method, refit_tolerance)
+        for module, update in zip(modules, updates):
+            logger.debug(f'{module}: {update}')
+    else:
+        processes_list = refit(list(range(len(modules))))
+
+    if summary_format == 'compact':
+        module_clusters = {module: clusters for module, clusters in zip(modules, processes_list)}
+        return compact_clusters([module_clusters.get(module, {}) for module in LIFE_CYCLE_MODULES], processes, embeddings, token_budget=summary_token_budget)
+    return summarize_clusters(processes_list)
 
 def visualize_process_flow(json_data):
     """
     Visualize a process flow graph from JSON data.
     
     Args:
-        json_data: Either a JSON string or a dictionary containing process flow data
+        json_data: Either a JSON string, a dictionary containing process flow data or a PFGGraph
     """
-    # Parse JSON if string is provided
-    if isinstance(json_data, str):
-        data = json.loads(json_data)
-    else:
-        data = json_data
+    # the plotting libraries are only imported by runs which visualize, as they are slow to import
+    import networkx as nx
+    import matplotlib.pyplot as plt
+    import matplotlib.patches as mpatches
+
+    # Parse and validate the PFG, dropping edges to processes which are not in it
+    graph = as_pfg_graph(json_data)
     
     # Create directed graph
     G = nx.DiGraph()
@@ -349,39 +420,33 @@ def visualize_process_flow(json_data):
     }
     
     # Add nodes with attributes
-    for process_name, process_info in data['processes'].items():
+    for i, process_name in enumerate(graph.names):
         G.add_node(process_name,
-                   category=process_info.get('process_category', 'other'),
-                   is_subprocess=process_info.get('is_subprocess', 'other'),
-                   description=process_info.get('description', 'other'))
-    
-    # Add edges
-    for process_name, process_info in data['processes'].items():
-        for output in process_info['output_nodes']:
-            G.add_edge(process_name, output)
-    
-    # Create figure
-    fig, ax = plt.subplots(figsize=(20, 14))
-    
-    # Use hierarchical layout
-    pos = nx.spring_layout(G, k=3, iterations=50, seed=42)
-    
-    # Try to organize by category vertically
-    categories = ['downstream', 'core', 'upstream']
-    y_positions = {cat: i * 2 for i, cat in enumerate(categories)}
-    
-    # Adjust positions based on category
-    for node in G.nodes():
-        category = G.nodes[node]['category']
-        pos[node] = (pos[node][0], pos[node][1] + y_positions[category])
+                   category=CATEGORIES[graph.categories[i]],
+                   is_subprocess=PROCESS_KINDS[graph.kinds[i]],
+                   description=graph.descriptions[i])
+    G.add_edges_from(graph.edges())
+    
+    # Use a layered layout, with the upstream, core and downstream processes in successive bands from the top
+    layout = layered_layout(graph)
+    pos = {node: (x, -y) for node, (x, y) in layout['positions'].items()}
+    
+    # Create figure, growing with the widest layer and the number of layers up to a size matplotlib can still save,
+    # and shrinking the processes and labels when they no longer fit
+    widest = max([len(layer) for layer in layout['layers']] + [1])
+    width = min(max(20, 2.2 * widest), 100)
+    height = min(max(14, 1.6 * len(layout['layers'])), 100)
+    fig, ax = plt.subplots(figsize=(width, height))
+    scale = min(1.0, width / (2.2 * widest), height / (1.6 * max(len(layout['layers']), 1)))
+    categories = ['downstream', 'core', 'upstream', 'other']
     
     # Draw edges
     nx.draw_networkx_edges(G, pos, ax=ax, 
                           edge_color='gray', 
                           arrows=True,
-                          arrowsize=20,
+                          arrowsize=max(5, 20 * scale),
                           arrowstyle='-|>',
-                          width=2,
+                          width=max(0.5, 2 * scale),
                           alpha=0.6,
                           connectionstyle='arc3,rad=0.1')
     
@@ -395,7 +460,7 @@ def visualize_process_flow(json_data):
                                   nodelist=nodelist,
                                   node_color=category_colors[category],
                                   node_shape='o',
-                                  node_size=3000,
+                                  node_size=3000 * scale ** 2,
                                   edgecolors='black',
                                   linewidths=2,
                                   ax=ax)
@@ -404,20 +469,10 @@ def visualize_process_flow(json_data):
     labels = {}
     for node in G.nodes():
         # Wrap long labels
-        words = node.split()
-        wrapped = []
-        line = []
-        for word in words:
-            line.append(word)
-            if len(' '.join(line)) > 20:
-                wrapped.append(' '.join(line))
-                line = []
-        if line:
-            wrapped.append(' '.join(line))
-        labels[node] = '\n'.join(wrapped)
+        labels[node] = '\n'.join(wrap_label(node))
     
     nx.draw_networkx_labels(G, pos, labels, 
-                           font_size=8,
+                           font_size=max(2, 8 * scale),
                            font_weight='bold',
                            ax=ax)
     
@@ -442,16 +497,28 @@ def visualize_process_flow(json_data):
     
     return fig, ax
 
-def save_visualization(data, output_file='process_flow.png'):
+def save_visualization(data, output_file='process_flow.png', show=True, dpi=300):
     """
     Load JSON from file and save visualization.
+    .svg and .dot files are written directly from the layered layout, without matplotlib.
     
     Args:
         data: dictionary representation of pfg
         output_file: Output image file path
+        show: Whether to show the figure, which is closed instead for headless and batch rendering
+        dpi: Resolution of the image
     """
-    
-    fig, ax = visualize_process_flow(data)
-    plt.savefig(output_file, dpi=300, bbox_inches='tight')
-    print(f"Visualization saved to {output_file}")
-    plt.show()
\ No newline at end of file
+    extension = os.path.splitext(output_file)[1].lower()
+    if extension == '.svg':
+        render_svg(data, output_file)
+    elif extension in ('.dot', '.gv'):
+        render_dot(data, output_file)
+    else:
+        import matplotlib.pyplot as plt
+        fig, ax = visualize_process_flow(data)
+        fig.savefig(output_file, dpi=dpi, bbox_inches='tight')
+        if show:
+            plt.show()
+        else:
+            plt.close(fig)
+    logger.info(f"Visualization saved to {output_file}")
\ No newline at end of file
@@ -0,0 +1,244 @@
+'''
+Batch runner to generate Process Flow Graphs for many product categories with a single ModelManager.
+Run from the SpiderGen folder with:
+    python run_batch.py --manifest categories.csv --output pfgs.jsonl
+
+The manifest is a CSV or JSONL file with product_category_name and product_category_description for each
+category, and optionally number_sample_products. Finished PFGs are appended to the output JSONL as they complete,
+so a killed run resumes by skipping every category that is already in the output.
+With --batch-api, the LLM requests of all categories are submitted through the provider batch API instead.
+'''
+import os
+import csv
+import json
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import model_config
+from utils.model_manager import ModelManager
+from utils.scheduler import get_scheduler
+from utils.instrumentation import get_tracer, JSONLinesExporter, SpanSummary
+from procedure_generation.spidergen import spidergen
+from procedure_generation.spidergen_batch import spidergen_batch
+
+logger = logging.getLogger(__name__)
+
+def read_manifest(path):
+    '''
+    reads the product categories of a CSV or JSONL manifest
+
+    path: path to the manifest
+
+    returns a list of dictionaries with the arguments of spidergen for each category
+    '''
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if path.endswith('.jsonl'):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+    categories = []
+    for row in rows:
+        category = dict({
+            'product_category_name': row['product_category_name'],
+            'product_category_description': row['product_category_description'],
+        })
+        if row.get('number_sample_products') not in (None, ''):
+            category['number_sample_products'] = int(row['number_sample_products'])
+        categories.append(category)
+    return categories
+
+def completed_categories(output_path):
+    '''
+    returns the names of the categories which already have a PFG in the output file
+    '''
+    completed = set()
+    if not os.path.isfile(output_path):
+        return completed
+    with open(output_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                completed.add(json.loads(line)['product_category_name'])
+            except (json.JSONDecodeError, KeyError):
+                # a partially written last line from a killed run is skipped, and its category is regenerated
+                continue
+    return completed
+
+def run_batch(categories, model_manager, output_path, concurrency=4, number_sample_products=5, product_concurrency=4, clustering_method='kmeans', trace=True, corpus_store=None, final_synthesis='single',
+              cluster_summary='full'):
+    '''
+    generates the PFGs of categories concurrently, appending each finished PFG to output_path
+
+    categories: list of dictionaries with the arguments of spidergen for each category
+    model_manager: model manager shared by every category
+    output_path: JSONL file the PFGs are written to
+    concurrency: number of categories generated at once
+    number_sample_products: number of sample products for categories which do not set their own
+    product_concurrency: number of sample product templates generated at once within a category
+    trace: whether to record the traces and checkpoints of each category, so that a rerun resumes its finished stages
+    corpus_store: optional CorpusStore each finished category is stored in
+    final_synthesis: 'single' to generate each final PFG in one call, or 'map_reduce' to generate and merge the PFGs of its upstream, core and end of life processes
+    cluster_summary: 'full' to list every process of every cluster in the final PFG prompts, or 'compact' to list the medoid and a few other names of each cluster
+
+    returns the number of categories generated and the number that failed
+    '''
+    completed = completed_categories(output_path)
+    pending = [category for category in categories if category['product_category_name'] not in completed]
+    logger.info(f'{len(completed)} categories already generated, {len(pending)} remaining')
+    write_lock = threading.Lock()
+    errors_path = output_path + '.errors.jsonl'
+
+    def write_line(path, record):
+        with write_lock:
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                f.flush()
+
+    def generate(category):
+        started = time.perf_counter()
+        try:
+            pfg = spidergen(
+                category['product_category_name'],
+                category['product_category_description'],
+                category.get('number_sample_products', number_sample_products),
+                model_manager,
+                trace=trace,
+                max_concurrency=product_concurrency,
+                clustering_method=clustering_method,
+                corpus_store=corpus_store,
+                final_synthesis=final_synthesis,
+                cluster_summary=cluster_summary,
+            )
+        except Exception as e:
+            pfg, error = None, repr(e)
+        else:
+            # spidergen returns an empty PFG when the final PFG could not be generated
+            error = None if pfg else 'no final PFG was generated'
+        if error is not None:
+            # failed categories are not written to the output, so that they are retried when the run is resumed
+            logger.error(f"failed to generate {category['product_category_name']}: {error}")
+            write_line(errors_path, dict({'product_category_name': category['product_category_name'], 'error': error}))
+            return False
+        write_line(output_path, dict({
+            'product_category_name': category['product_category_name'],
+            'product_category_description': category['product_category_description'],
+            'elapsed_seconds': time.perf_counter() - started,
+            'pfg': pfg,
+        }))
+        return True
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        results = list(executor.map(generate, pending))
+    return sum(results), len(results) - sum(results)
+
+def run_batch_api(categories, model_manager, output_path, number_sample_products=5, poll_interval=30.0, clustering_method='kmeans', trace=True, cluster_summary='full'):
+    '''
+    generates the PFGs of categories with the batch API of the LLM, appending them to output_path
+
+    returns the number of categories generated and the number that failed
+    '''
+    completed = completed_categories(output_path)
+    pending = [category for category in categories if category['product_category_name'] not in completed]
+    logger.info(f'{len(completed)} categories already generated, {len(pending)} remaining')
+    pfgs = spidergen_batch(pending, model_manager, number_sample_products=number_sample_products, poll_interval=poll_interval, trace=trace, clustering_method=clustering_method,
+                           cluster_summary=cluster_summary)
+    generated = 0
+    with open(output_path, 'a', encoding='utf-8') as f, open(output_path + '.errors.jsonl', 'a', encoding='utf-8') as errors:
+        for category, pfg in zip(pending, pfgs):
+            if not pfg:
+                # failed categories are not written to the output, so that they are retried when the run is resumed
+                logger.error(f"failed to generate {category['product_category_name']}: no final PFG was generated")
+                errors.write(json.dumps(dict({'product_category_name': category['product_category_name'], 'error': 'no final PFG was generated'}), ensure_ascii=False) + '\n')
+                continue
+            f.write(json.dumps(dict({
+                'product_category_name': category['product_category_name'],
+                'product_category_description': category['product_category_description'],
+                'pfg': pfg,
+            }), ensure_ascii=False) + '\n')
+            generated += 1
+    return generated, len(pending) - generated
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate Process Flow Graphs for every product category in a manifest.')
+    parser.add_argument('--manifest', required=True, help='CSV or JSONL file of product categories')
+    parser.add_argument('--output', required=True, help='JSONL file the generated PFGs are appended to')
+    parser.add_argument('--concurrency', type=int, default=4, help='number of categories generated at once')
+    parser.add_argument('--product-concurrency', type=int, default=4, help='number of sample product templates generated at once per category')
+    parser.add_argument('--llm-concurrency', type=int, default=None, help='maximum number of LLM requests in flight across all categories')
+    parser.add_argument('--number-sample-products', type=int, default=5, help='number of sample products for categories which do not set their own')
+    parser.add_argument('--clustering-method', default='kmeans', choices=['kmeans', 'agglomerative'])
+    parser.add_argument('--cache', default=None, help='folder for the LLM response and embedding caches')
+    parser.add_argument('--reuse-templates', type=float, default=None, metavar='THRESHOLD',
+                        help='reuse the sample product template of a product whose name and description have at least this cosine similarity, instead of generating it')
+    parser.add_argument('--corpus', default=None, help='folder of a corpus store the PFG, clusters and templates of each category are added to, without --batch-api')
+    parser.add_argument('--final-synthesis', default='single', choices=['single', 'map_reduce'],
+                        help='generate each final PFG in one call, or its upstream, core and end of life parts concurrently, without --batch-api')
+    parser.add_argument('--cluster-summary', default='full', choices=['full', 'compact'],
+                        help='list every process of every cluster in the final PFG prompts, or only the medoid, count and a few other names of each cluster')
+    parser.add_argument('--no-trace', action='store_true', help='do not record the traces and checkpoints of each category')
+    parser.add_argument('--metrics-output', default=None, help='JSONL file every finished span (stage, LLM call, embedding, clustering) is appended to')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--batch-api', action='store_true', help='submit the LLM requests through the provider batch API')
+    parser.add_argument('--poll-interval', type=float, default=60.0, help='seconds between checks of the status of a batch')
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    if args.metrics_output:
+        get_tracer().add_hook(JSONLinesExporter(args.metrics_output))
+    # the spans of each category are cleared once it is generated, so the summary of the run is added up as they finish
+    span_summary = get_tracer().add_hook(SpanSummary())
+
+    # the models, including the sentence transformer, are loaded once and shared by every category
+    model_manager = ModelManager()
+    model_manager.create_model_environ(
+        sources=model_config['sources'],
+        model_names=model_config['model_names'],
+        roles=model_config['roles']
+    )
+    if args.cache:
+        model_manager.enable_cache(os.path.join(args.cache, 'llm_responses.sqlite'))
+        model_manager.enable_embedding_cache(os.path.join(args.cache, 'embeddings'))
+    if args.reuse_templates is not None:
+        model_manager.enable_template_cache(os.path.join(args.cache or './cache', 'templates'), threshold=args.reuse_templates)
+    corpus_store = None
+    if args.corpus and not args.batch_api:
+        from procedure_generation.corpus_store import CorpusStore
+        corpus_store = CorpusStore(args.corpus, model_manager.models['embedding_transformer'], model_manager.embedding_model_id('embedding_transformer'))
+    if args.llm_concurrency:
+        scheduler = get_scheduler(model_manager.model_source['llm'])
+        scheduler.max_concurrency = args.llm_concurrency
+        scheduler.concurrency_limit = float(args.llm_concurrency)
+
+    if args.batch_api:
+        generated, failed = run_batch_api(
+            read_manifest(args.manifest),
+            model_manager,
+            args.output,
+            number_sample_products=args.number_sample_products,
+            poll_interval=args.poll_interval,
+            clustering_method=args.clustering_method,
+            trace=not args.no_trace,
+            cluster_summary=args.cluster_summary,
+        )
+    else:
+        generated, failed = run_batch(
+            read_manifest(args.manifest),
+            model_manager,
+            args.output,
+            concurrency=args.concurrency,
+            number_sample_products=args.number_sample_products,
+            product_concurrency=args.product_concurrency,
+            clustering_method=args.clustering_method,
+            trace=not args.no_trace,
+            corpus_store=corpus_store,
+            final_synthesis=args.final_synthesis,
+            cluster_summary=args.cluster_summary,
+        )
+    logger.info(f'generated {generated} categories, {failed} failed')
+    if model_manager.template_cache is not None:
+        logger.info(f'template cache: {json.dumps(model_manager.template_cache.stats())}')
+    for group, entry in span_summary.summary().items():
+        logger.info(f'{group}: {json.dumps(entry)}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+import json
+import anthropic
+from openai import OpenAI
+from utils.batch_api import OpenAIBatchTransport, AnthropicBatchTransport, run_batch
+from utils.fake_llm_server import FakeLLMServer
+from utils.model_manager import ModelManager
+from procedure_generation.spidergen_batch import generate_json_batch
+'''
+Batches run through the fake OpenAI and Anthropic batch APIs: a batch is submitted, polled until it ends and its results parsed,
+and a request which fails in a batch only fails its own key.
+'''
+
+PFG = json.dumps({'processes': {'Extraction': {'input_nodes': [], 'output_nodes': ['Manufacturing']},
+                                'Manufacturing': {'input_nodes': ['Extraction'], 'output_nodes': []}}})
+
+def openai_transport(server):
+    return OpenAIBatchTransport(OpenAI(api_key='fake', base_url=server.url + '/v1', max_retries=0), 'o3')
+
+def anthropic_transport(server):
+    return AnthropicBatchTransport(anthropic.Anthropic(api_key='fake', base_url=server.url, max_retries=0), 'claude', 1024)
+
+def test_openai_batch_is_polled_and_parsed():
+    with FakeLLMServer([PFG], batch_delay=0.3) as server:
+        results = run_batch(openai_transport(server), {'request-0': 'first prompt', 'request-1': 'second prompt'}, poll_interval=0.05)
+    assert set(results) == {'request-0', 'request-1'}
+    assert json.loads(results['request-0']['text']) == json.loads(PFG)
+    assert results['request-1']['usage']['output_tokens'] == len(PFG) // 4
+
+def test_anthropic_batch_is_polled_and_parsed():
+    with FakeLLMServer([PFG], batch_delay=0.3) as server:
+        results = run_batch(anthropic_transport(server), {'request-0': 'first prompt', 'request-1': 'second prompt'}, poll_interval=0.05)
+    assert set(results) == {'request-0', 'request-1'}
+    assert json.loads(results['request-0']['text']) == json.loads(PFG)
+    assert results['request-1']['usage']['output_tokens'] == len(PFG) // 4
+
+def test_failed_line_is_left_out_of_the_results():
+    for transport in [openai_transport, anthropic_transport]:
+        with FakeLLMServer([PFG, None, PFG]) as server:
+            results = run_batch(transport(server), {'request-0': 'a', 'request-1': 'b', 'request-2': 'c'}, poll_interval=0.05)
+        assert set(results) == {'request-0', 'request-2'}
+
+def test_failed_line_only_fails_its_key():
+    # the failed request is retried synchronously, and its retries cannot be parsed either
+    responses = iter([PFG, None, PFG])
+    with FakeLLMServer(lambda prompt: next(responses, 'no JSON here')) as server:
+        model_manager = ModelManager()
+        model_manager.use_scheduler = False
+        model_manager.register_model('llm', 'openai', 'o3', OpenAI(api_key='fake', base_url=server.url + '/v1', max_retries=0))
+        results = generate_json_batch(model_manager, 'llm', {'a': 'first', 'b': 'second', 'c': 'third'}, openai_transport(server), poll_interval=0.05)
+    assert results == {'a': json.loads(PFG), 'b': {}, 'c': json.loads(PFG)}
+    assert len([call_info for call_info in model_manager.call_stats if call_info.get('batch')]) == 2
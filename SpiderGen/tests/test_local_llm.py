@@ -0,0 +1,51 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils.fake_llm_server import FakeLLMServer
+from utils.local_llm import LocalLLM
+from utils.model_manager import ModelManager
+'''
+Generation through a local OpenAI-compatible server: the prompts of concurrent callers are coalesced into one
+/v1/completions request, and servers which reject a list of prompts are sent one chat request per prompt.
+'''
+
+PFG = json.dumps({'processes': {'Extraction': {'input_nodes': [], 'output_nodes': ['Manufacturing']},
+                                'Manufacturing': {'input_nodes': ['Extraction'], 'output_nodes': []}}})
+
+def local_model_manager(server, max_batch_size=8):
+    model_manager = ModelManager()
+    model_manager.use_scheduler = False
+    # the first prompt waits long enough for the others to join its batch
+    model_manager.register_model('llm', 'local', 'fake', LocalLLM('fake', server.url + '/v1', max_batch_size=max_batch_size, max_wait=0.5))
+    return model_manager
+
+def generate_concurrently(model_manager, prompts):
+    barrier = threading.Barrier(len(prompts))
+    def generate(prompt):
+        barrier.wait()
+        return model_manager.generate_json('llm', prompt)
+    with ThreadPoolExecutor(max_workers=len(prompts)) as executor:
+        return list(executor.map(generate, prompts))
+
+def test_concurrent_calls_are_coalesced():
+    with FakeLLMServer([PFG]) as server:
+        model_manager = local_model_manager(server)
+        responses = generate_concurrently(model_manager, [f'prompt {i}' for i in range(4)])
+    assert responses == [json.loads(PFG)] * 4
+    assert server.completion_batches == [4]
+    assert [call_info['batch_size'] for call_info in model_manager.call_stats] == [4] * 4
+
+def test_batches_are_split_at_max_batch_size():
+    with FakeLLMServer([PFG]) as server:
+        model_manager = local_model_manager(server, max_batch_size=2)
+        responses = generate_concurrently(model_manager, [f'prompt {i}' for i in range(4)])
+    assert responses == [json.loads(PFG)] * 4
+    assert server.completion_batches == [2, 2]
+
+def test_server_without_batches_gets_one_chat_request_per_prompt():
+    with FakeLLMServer([PFG], batch_prompts=False) as server:
+        model_manager = local_model_manager(server)
+        responses = generate_concurrently(model_manager, [f'prompt {i}' for i in range(3)])
+    assert responses == [json.loads(PFG)] * 3
+    assert server.completion_batches == []
+    assert model_manager.models['llm'].batching is False
@@ -0,0 +1,49 @@
+import json
+import anthropic
+from openai import OpenAI
+from utils.fake_llm_server import FakeLLMServer
+from utils.model_manager import ModelManager
+'''
+Streamed generation through the fake OpenAI server: an attempt which can no longer produce a JSON object is aborted
+before the rest of it is read, and a short preamble before the object is accepted.
+'''
+
+PFG = json.dumps({'processes': {'Extraction': {'input_nodes': [], 'output_nodes': ['Manufacturing']},
+                                'Manufacturing': {'input_nodes': ['Extraction'], 'output_nodes': []}}})
+
+def streaming_model_manager(server):
+    model_manager = ModelManager()
+    model_manager.streaming = True
+    model_manager.use_scheduler = False
+    model_manager.register_model('llm', 'openai', 'o3', OpenAI(api_key='fake', base_url=server.url + '/v1', max_retries=0))
+    return model_manager
+
+def test_stream_with_preamble_is_parsed():
+    with FakeLLMServer([f'Here is the JSON:\n{PFG}']) as server:
+        model_manager = streaming_model_manager(server)
+        assert model_manager.generate_json('llm', 'prompt') == json.loads(PFG)
+    attempts = model_manager.call_stats[-1]['attempts']
+    assert len(attempts) == 1
+    assert 'abort_reason' not in attempts[0]
+
+def test_stream_with_prose_is_aborted_early():
+    prose = 'This product category has many processes. ' * 100 + PFG
+    with FakeLLMServer([prose, PFG], chunk_size=16) as server:
+        model_manager = streaming_model_manager(server)
+        assert model_manager.generate_json('llm', 'prompt') == json.loads(PFG)
+    attempts = model_manager.call_stats[-1]['attempts']
+    assert len(attempts) == 2
+    assert 'prose before the JSON object' in attempts[0]['abort_reason']
+    # the attempt is aborted once the preamble is too long, long before the end of the response
+    assert attempts[0]['chars'] < len(prose) / 2
+    assert 'time_to_complete' in attempts[1]
+
+def test_anthropic_stream_records_output_tokens():
+    # the output tokens are only sent in the message_delta event after the last text
+    with FakeLLMServer([PFG]) as server:
+        model_manager = ModelManager()
+        model_manager.streaming = True
+        model_manager.use_scheduler = False
+        model_manager.register_model('llm', 'anthropic', 'claude', anthropic.Anthropic(api_key='fake', base_url=server.url, max_retries=0))
+        assert model_manager.generate_json('llm', 'prompt') == json.loads(PFG)
+    assert model_manager.call_stats[-1]['output_tokens'] == len(PFG) // 4
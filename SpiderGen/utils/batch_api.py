@@ -0,0 +1,124 @@
+import io
+import json
+import time
+import logging
+from utils.prompt_compiler import anthropic_content
+from utils.model_manager import openai_usage, anthropic_usage
+'''
+Transports for submitting many prompts at once through provider batch APIs (OpenAI Batch and Anthropic Message Batches).
+Batched requests are cheaper than synchronous ones, in exchange for completing asynchronously within hours.
+Every transport has the same interface, so that a batch can be run against any provider or a local stand-in server.
+'''
+
+logger = logging.getLogger(__name__)
+
+class BatchTransport:
+    '''
+    Interface of a batch transport.
+    submit sends a dictionary of custom id to prompt and returns a batch id, is_done reports whether the batch
+    has ended, and results returns a dictionary of custom id to the response 'text' and token 'usage' of the requests
+    which succeeded, with the usage in the format of openai_usage and anthropic_usage.
+    '''
+    def submit(self, prompts):
+        raise NotImplementedError
+
+    def is_done(self, batch_id):
+        raise NotImplementedError
+
+    def results(self, batch_id):
+        raise NotImplementedError
+
+class OpenAIBatchTransport(BatchTransport):
+    '''
+    Transport for the OpenAI Batch API, which runs chat completion requests uploaded as a JSONL file.
+    '''
+    def __init__(self, client, model_name):
+        self.client = client
+        self.model_name = model_name
+
+    def submit(self, prompts):
+        lines = []
+        for custom_id, prompt in prompts.items():
+            lines.append(json.dumps(dict({
+                'custom_id': custom_id,
+                'method': 'POST',
+                'url': '/v1/chat/completions',
+                'body': {'model': self.model_name, 'messages': [{'role': 'user', 'content': prompt}]},
+            }), ensure_ascii=False))
+        batch_file = self.client.files.create(file=('batch.jsonl', io.BytesIO('\n'.join(lines).encode('utf-8'))), purpose='batch')
+        batch = self.client.batches.create(input_file_id=batch_file.id, endpoint='/v1/chat/completions', completion_window='24h')
+        return batch.id
+
+    def is_done(self, batch_id):
+        return self.client.batches.retrieve(batch_id).status in ['completed', 'failed', 'expired', 'cancelled']
+
+    def results(self, batch_id):
+        batch = self.client.batches.retrieve(batch_id)
+        responses = dict({})
+        if not batch.output_file_id:
+            return responses
+        for line in self.client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            response = entry.get('response') or dict({})
+            if response.get('status_code') == 200:
+                from openai.types import CompletionUsage
+                usage = response['body'].get('usage')
+                responses[entry['custom_id']] = dict({
+                    'text': response['body']['choices'][0]['message']['content'],
+                    'usage': openai_usage(CompletionUsage.model_validate(usage)) if usage else None,
+                })
+        return responses
+
+class AnthropicBatchTransport(BatchTransport):
+    '''
+    Transport for the Anthropic Message Batches API.
+    '''
+    def __init__(self, client, model_name, max_tokens):
+        self.client = client
+        self.model_name = model_name
+        self.max_tokens = max_tokens
+
+    def submit(self, prompts):
+        requests = []
+        for custom_id, prompt in prompts.items():
+            requests.append(dict({
+                'custom_id': custom_id,
+                'params': {'model': self.model_name, 'max_tokens': self.max_tokens, 'messages': [{'role': 'user', 'content': anthropic_content(prompt)}]},
+            }))
+        return self.client.messages.batches.create(requests=requests).id
+
+    def is_done(self, batch_id):
+        return self.client.messages.batches.retrieve(batch_id).processing_status == 'ended'
+
+    def results(self, batch_id):
+        responses = dict({})
+        for entry in self.client.messages.batches.results(batch_id):
+            if entry.result.type == 'succeeded':
+                responses[entry.custom_id] = dict({'text': entry.result.message.content[0].text, 'usage': anthropic_usage(entry.result.message.usage)})
+        return responses
+
+def run_batch(transport, prompts, poll_interval=30.0, timeout=None):
+    '''
+    submits prompts as one batch and waits for it to end
+
+    transport: BatchTransport to submit the batch with
+    prompts: dictionary of custom id to prompt
+    poll_interval: seconds between checks of the batch status
+    timeout: seconds after which to stop waiting, or None to wait until the batch ends
+
+    returns a dictionary of custom id to the response text and usage of the requests which succeeded
+    '''
+    if len(prompts) == 0:
+        return dict({})
+    batch_id = transport.submit(prompts)
+    logger.info(f'submitted batch {batch_id} with {len(prompts)} requests')
+    started = time.monotonic()
+    while not transport.is_done(batch_id):
+        if timeout is not None and time.monotonic() - started > timeout:
+            raise TimeoutError(f'batch {batch_id} did not end within {timeout} seconds')
+        time.sleep(poll_interval)
+    responses = transport.results(batch_id)
+    logger.info(f'batch {batch_id} ended, {len(responses)} of {len(prompts)} requests succeeded')
+    return responses
@@ -0,0 +1,132 @@
+import os
+import json
+import threading
+from contextlib import contextmanager
+import numpy as np
+try:
+    import fcntl
+except ImportError:
+    # file locks are only used on POSIX systems, elsewhere a folder should not be shared by several processes
+    fcntl = None
+'''
+Persistent string to vector cache for sentence embeddings.
+Vectors are stored in a memory-mapped float32 file, with an append-only index of the embedded strings,
+so that process names which repeat across runs are only ever embedded once per model.
+Appends are serialized across processes (i.e, run_batch workers and a CorpusStore sharing a folder) with a lock file.
+'''
+
+class EmbeddingCache:
+    '''
+    Memory-mapped embedding store for a single embedding model.
+    Row i of the vector file is the embedding of line i of the index file.
+    '''
+    def __init__(self, path, model_name):
+        self.folder = os.path.join(path, model_name.replace('/', '_'))
+        self.vectors_path = os.path.join(self.folder, 'vectors.f32')
+        self.index_path = os.path.join(self.folder, 'index.jsonl')
+        self.meta_path = os.path.join(self.folder, 'meta.json')
+        self.lock_path = os.path.join(self.folder, 'lock')
+        self.lock = threading.Lock()
+        self.index = dict({})
+        self.dim = None
+        self.vectors = None
+        # size of the indexed lines of the index file, which differs from the size of the file if it has stale lines
+        # or if another process appended rows since it was read
+        self._index_size = 0
+        os.makedirs(self.folder, exist_ok=True)
+        self._load()
+
+    @contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load(self):
+        if os.path.isfile(self.meta_path):
+            with open(self.meta_path, 'r') as f:
+                self.dim = json.load(f)['dim']
+        if self.dim is None or not os.path.isfile(self.index_path):
+            return
+        sentences = []
+        # end of each line in bytes, so the size of the index file can be compared with the size of its indexed rows
+        ends = [0]
+        with open(self.index_path, 'rb') as f:
+            for line in f:
+                # an interrupted write leaves a partial last line, and the lines after an undecodable one cannot be matched to their rows
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    sentences.append(json.loads(line))
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    break
+                ends.append(ends[-1] + len(line))
+        # an interrupted write can leave the index ahead of the vectors, so only rows present in both are used
+        n_rows = min(len(sentences), os.path.getsize(self.vectors_path) // (4 * self.dim) if os.path.isfile(self.vectors_path) else 0)
+        self._index_size = ends[n_rows]
+        self.index = {sentence: row for row, sentence in enumerate(sentences[:n_rows])}
+        self._map(n_rows)
+
+    def _map(self, n_rows):
+        if n_rows == 0:
+            self.vectors = np.zeros((0, self.dim), dtype=np.float32)
+        else:
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(n_rows, self.dim))
+
+    def _append(self, sentences, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self.dim is None:
+            self.dim = int(vectors.shape[1])
+            with open(self.meta_path, 'w') as f:
+                json.dump({'dim': self.dim}, f)
+        n_rows = len(self.index)
+        # release the current mapping before the file is resized
+        self.vectors = None
+        # truncate anything beyond the indexed rows left behind by an interrupted write
+        with open(self.vectors_path, 'ab') as f:
+            f.truncate(n_rows * 4 * self.dim)
+            f.write(vectors.tobytes())
+        if os.path.isfile(self.index_path) and os.path.getsize(self.index_path) != self._index_size:
+            # the index has stale or partial lines beyond the indexed rows, which are rewritten so new lines match their rows
+            with open(self.index_path + '.tmp', 'w', encoding='utf-8') as f:
+                for sentence in sorted(self.index, key=self.index.get):
+                    f.write(json.dumps(sentence, ensure_ascii=False) + '\n')
+            os.replace(self.index_path + '.tmp', self.index_path)
+        with open(self.index_path, 'a', encoding='utf-8') as f:
+            for sentence in sentences:
+                f.write(json.dumps(sentence, ensure_ascii=False) + '\n')
+        self._index_size = os.path.getsize(self.index_path)
+        for i, sentence in enumerate(sentences):
+            self.index[sentence] = n_rows + i
+        self._map(len(self.index))
+
+    def encode(self, transformer_model, sentences):
+        '''
+        returns normalized embeddings for sentences, only running transformer_model on sentences that are not cached
+
+        transformer_model: embedding model with a sentence transformers style encode method
+        sentences: list of unique strings to embed
+        '''
+        with self.lock:
+            missing = [sentence for sentence in sentences if sentence not in self.index]
+            if len(missing) > 0:
+                encoded = transformer_model.encode(np.array(missing), normalize_embeddings=True)
+                with self._file_lock():
+                    if os.path.isfile(self.index_path) and os.path.getsize(self.index_path) != self._index_size:
+                        # another process appended rows since the index was read, which must not be truncated
+                        self._load()
+                    new = [i for i, sentence in enumerate(missing) if sentence not in self.index]
+                    if len(new) > 0:
+                        self._append([missing[i] for i in new], np.asarray(encoded)[new])
+            if len(sentences) == 0:
+                return np.zeros((0, self.dim or 0), dtype=np.float32)
+            return np.asarray(self.vectors[[self.index[sentence] for sentence in sentences]])
+
+    def __len__(self):
+        return len(self.index)
@@ -0,0 +1,226 @@
+import json
+import time
+import random
+import hashlib
+import threading
+import numpy as np
+from utils.prompt_compiler import INPUTS_HEADER
+'''
+Deterministic stand-ins for the LLM and embedding models, used to run and benchmark SpiderGen without API keys.
+The fake LLM replays recorded responses, or generates synthetic responses for each of the SpiderGen prompts,
+after a configurable latency. The fake embedding model hashes the words of each sentence into a fixed random vector,
+so sentences sharing words are close to each other, as with a real sentence transformer.
+'''
+
+# vocabulary the synthetic process names of each module are drawn from
+MODULE_ACTIVITIES = dict({
+    'A1': ['extraction', 'mining', 'harvesting', 'refining', 'processing'],
+    'A2': ['transport', 'shipping', 'rail freight', 'trucking', 'delivery'],
+    'A3': ['manufacturing', 'assembly', 'molding', 'machining', 'finishing'],
+    'A4': ['distribution', 'transport to site', 'warehousing', 'shipping', 'logistics'],
+    'A5': ['installation', 'construction', 'site preparation', 'fitting', 'commissioning'],
+    'B1': ['use', 'operation', 'emissions', 'service life', 'handling'],
+    'B2': ['maintenance', 'cleaning', 'inspection', 'servicing', 'lubrication'],
+    'B3': ['repair', 'patching', 'part replacement', 'fixing', 'restoration'],
+    'B4': ['replacement', 'exchange', 'renewal', 'substitution', 'swap'],
+    'B5': ['refurbishment', 'renovation', 'upgrade', 'overhaul', 'retrofit'],
+    'B6': ['energy use', 'electricity consumption', 'heating', 'cooling', 'power draw'],
+    'B7': ['water use', 'water consumption', 'rinsing', 'irrigation', 'washing'],
+    'C1': ['deconstruction', 'demolition', 'dismantling', 'removal', 'disassembly'],
+    'C2': ['waste transport', 'collection', 'hauling', 'waste shipping', 'pickup'],
+    'C3': ['recycling', 'sorting', 'shredding', 'waste processing', 'recovery'],
+    'C4': ['landfill', 'disposal', 'incineration', 'dumping', 'final disposal'],
+})
+LIFE_CYCLE_MODULES = list(MODULE_ACTIVITIES)
+MATERIALS = ['steel', 'aluminium', 'plastic', 'glass', 'timber', 'concrete', 'copper', 'paper', 'rubber', 'textile']
+# trivially different spellings of the same process name, which are collapsed by canonicalization
+SPELLINGS = [lambda name: name, lambda name: name.title(), lambda name: name.upper(), lambda name: name + '.', lambda name: name.replace(' ', '  ')]
+
+def synthetic_process_name(rng, module, name_variety=1, variants=True):
+    '''
+    returns a random process name of module, out of len(MATERIALS) * len(MODULE_ACTIVITIES[module]) * name_variety distinct names
+    '''
+    name = f'{rng.choice(MATERIALS)} {rng.choice(MODULE_ACTIVITIES[module])}'
+    if name_variety > 1:
+        name = f'{name} type {rng.randrange(name_variety)}'
+    return rng.choice(SPELLINGS)(name) if variants else name
+
+def synthetic_product_template(product, processes_per_module=3, seed=0, name_variety=1):
+    '''
+    returns a sample product template with processes_per_module processes for every life cycle module, deterministic for product and seed
+    '''
+    rng = random.Random(f'{seed}:{product}')
+    processes = dict({})
+    for module in LIFE_CYCLE_MODULES:
+        module_processes = dict({})
+        for _ in range(processes_per_module):
+            module_processes[synthetic_process_name(rng, module, name_variety)] = dict({
+                'description': f'{module} process of {product}',
+                'rationale': 'synthetic',
+                'link': 'https://example.com',
+            })
+        processes[f'{module} Processes'] = module_processes
+    return dict({'product': product, 'processes': processes})
+
+def synthetic_product_templates(number_products, processes_per_module=3, seed=0, name_variety=1):
+    '''
+    returns the templates of number_products synthetic sample products, keyed by product name
+    '''
+    return {f'Product {i}': synthetic_product_template(f'Product {i}', processes_per_module, seed, name_variety) for i in range(number_products)}
+
+def synthetic_similar_products(number_products):
+    return dict({'product': {f'Product {i}': dict({'description': f'Synthetic product {i}', 'url': 'https://example.com'}) for i in range(number_products)}})
+
+def synthetic_pfg(number_processes, seed=0, name_prefix='Process'):
+    '''
+    returns a synthetic PFG of number_processes processes named name_prefix and their number, in sequence with random subprocess edges
+    '''
+    rng = random.Random(seed)
+    names = [f'{name_prefix} {i}' for i in range(number_processes)]
+    processes = dict({})
+    for i, name in enumerate(names):
+        category = 'upstream' if i < number_processes // 3 else 'core' if i < 2 * number_processes // 3 else 'downstream'
+        output_nodes = [names[i + 1]] if i + 1 < number_processes else []
+        if i + 2 < number_processes and rng.random() < 0.2:
+            output_nodes.append(names[rng.randrange(i + 2, number_processes)])
+        processes[name] = dict({
+            'description': f'synthetic process {i}',
+            'process_category': category,
+            'is_subprocess': 'process',
+            'input_nodes': [names[i - 1]] if i > 0 else [],
+            'output_nodes': output_nodes,
+        })
+    return dict({'exlcluded_processes': [], 'processes': processes})
+
+def prompt_inputs(prompt):
+    '''
+    returns the named inputs appended to a compiled prompt, i.e {'PRODUCT_NAME': ...}
+    '''
+    prompt = str(prompt)
+    if INPUTS_HEADER not in prompt:
+        return dict({})
+    inputs = dict({})
+    field = None
+    for line in prompt.rsplit(INPUTS_HEADER, 1)[1].split('\n'):
+        name, separator, value = line.partition(': ')
+        if separator and name.isupper() and name.replace('_', '').isalpha():
+            field = name
+            inputs[field] = value
+        elif field is not None:
+            # values spanning several lines continue until the next input
+            inputs[field] += '\n' + line
+    return inputs
+
+class SyntheticResponder:
+    '''
+    Generates a synthetic JSON response for each of the SpiderGen prompts, deterministic for the prompt and seed.
+    '''
+    def __init__(self, processes_per_module=3, pfg_processes=12, seed=0, name_variety=1):
+        self.processes_per_module = processes_per_module
+        self.pfg_processes = pfg_processes
+        self.seed = seed
+        self.name_variety = name_variety
+
+    def __call__(self, prompt):
+        inputs = prompt_inputs(prompt)
+        if 'PRODUCT_NAME' in inputs:
+            return json.dumps(synthetic_product_template(inputs['PRODUCT_NAME'], self.processes_per_module, self.seed, self.name_variety))
+        if 'NUMBER_OF_PRODUCTS' in inputs:
+            return json.dumps(synthetic_similar_products(int(inputs['NUMBER_OF_PRODUCTS'])))
+        if 'LIFE_CYCLE_STAGE' in inputs:
+            # the PFG of one part of the life cycle, with names that differ between the parts
+            return json.dumps(synthetic_pfg(max(1, self.pfg_processes // 3), self.seed, name_prefix=inputs['LIFE_CYCLE_STAGE'].split()[0].strip(',').title()))
+        if 'PROCESS_CLUSTERS' in inputs:
+            return json.dumps(synthetic_pfg(self.pfg_processes, self.seed))
+        raise ValueError('Prompt is not one of the SpiderGen prompts')
+
+def prompt_hash(prompt):
+    return hashlib.sha256(str(prompt).encode('utf-8')).hexdigest()
+
+class RecordedResponder:
+    '''
+    Replays the responses recorded with ModelManager.enable_recording, by prompt.
+    Prompts without a recorded response are answered by fallback, or raise a KeyError if there is none.
+    '''
+    def __init__(self, path, fallback=None):
+        self.responses = dict({})
+        self.fallback = fallback
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self.responses[record['prompt_sha256']] = record['response']
+
+    def __call__(self, prompt):
+        key = prompt_hash(prompt)
+        if key in self.responses:
+            response = self.responses[key]
+            return response if isinstance(response, str) else json.dumps(response)
+        if self.fallback is None:
+            raise KeyError(f'No recorded response for prompt {key}')
+        return self.fallback(prompt)
+
+class ResponseRecorder:
+    '''
+    Appends the prompt hash and response of each LLM call to a JSONL file, for replay with RecordedResponder.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, prompt, response):
+        line = json.dumps(dict({'prompt_sha256': prompt_hash(prompt), 'response': response}), ensure_ascii=False)
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+class FakeLLM:
+    '''
+    LLM which answers each prompt with responder(prompt) after latency seconds, plus a uniform jitter of up to jitter seconds.
+    '''
+    def __init__(self, responder=None, latency=0.0, jitter=0.0, seed=0):
+        self.responder = responder if responder is not None else SyntheticResponder(seed=seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def complete(self, prompt):
+        with self.lock:
+            self.calls += 1
+            delay = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay:
+            time.sleep(delay)
+        return self.responder(prompt)
+
+class FakeEmbedding:
+    '''
+    Embedding model with the encode interface of a sentence transformer.
+    Each word is mapped to a fixed random vector seeded by its hash, and a sentence is the normalized sum of its words.
+    '''
+    def __init__(self, dimension=384, latency_per_sentence=0.0):
+        self.dimension = dimension
+        self.latency_per_sentence = latency_per_sentence
+        self.word_vectors = dict({})
+        self.lock = threading.Lock()
+
+    def word_vector(self, word):
+        with self.lock:
+            if word not in self.word_vectors:
+                seed = int(hashlib.md5(word.encode('utf-8')).hexdigest()[:8], 16)
+                self.word_vectors[word] = np.random.default_rng(seed).standard_normal(self.dimension).astype(np.float32)
+            return self.word_vectors[word]
+
+    def encode(self, sentences, normalize_embeddings=True, **kwargs):
+        sentences = [str(sentence) for sentence in sentences]
+        if self.latency_per_sentence:
+            time.sleep(self.latency_per_sentence * len(sentences))
+        embeddings = np.zeros((len(sentences), self.dimension), dtype=np.float32)
+        for row, sentence in enumerate(sentences):
+            for word in sentence.lower().split():
+                embeddings[row] += self.word_vector(word.strip('.,;:'))
+        if normalize_embeddings:
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings /= np.where(norms == 0, 1.0, norms)
+        return embeddings
@@ -0,0 +1,395 @@
+import json
+import time
+import threading
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+'''
+Local stand-in for the OpenAI and Anthropic HTTP APIs, used to exercise ModelManager without API keys.
+Serves /v1/chat/completions and /v1/messages, both with and without streaming, /v1/completions with a list of prompts
+as served by local inference servers,
+as well as the OpenAI Batch (/v1/files, /v1/batches) and Anthropic Message Batches (/v1/messages/batches) APIs.
+Prompt caching is emulated in the reported usage, at four characters per token: OpenAI prompts reuse the longest prefix
+shared with an earlier prompt, and Anthropic prompts reuse the content blocks up to a cache_control breakpoint seen before.
+Point a client at it with openai_base_url = server.url + '/v1' or anthropic_base_url = server.url in config.py.
+'''
+
+def prompt_text(content):
+    '''
+    returns the text of a message content, which is either a string or a list of content blocks
+    '''
+    if isinstance(content, str):
+        return content
+    return ''.join(block.get('text', '') for block in content)
+
+def common_prefix_length(a, b):
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+class FakeLLMServer:
+    '''
+    HTTP server that answers every request with the next of responses, or with responses(prompt) if it is callable.
+    Streamed responses are sent in chunks of chunk_size characters, chunk_delay seconds apart.
+    The first requests are answered with the HTTP status codes in error_statuses, sent with a retry_after header, if any.
+    Batches end batch_delay seconds after they are submitted, and a request of a batch answered with None fails in its results.
+    Prefixes shorter than min_cache_tokens are not cached, as with the providers.
+    /v1/completions requests with a list of prompts are rejected with a 400 status if batch_prompts is False,
+    as by servers which do not support batches, and take completion_delay seconds whatever their number of prompts.
+    '''
+    def __init__(self, responses, chunk_size=16, chunk_delay=0.0, error_statuses=(), retry_after=None, batch_delay=0.0, min_cache_tokens=1024,
+                 batch_prompts=True, completion_delay=0.0, host='127.0.0.1', port=0):
+        self.responses = responses
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.error_statuses = list(error_statuses)
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.disconnects = 0
+        self.connections = 0
+        self.prompts = []
+        self.batch_delay = batch_delay
+        self.files = dict({})
+        self.batches = dict({})
+        self.min_cache_tokens = min_cache_tokens
+        self.cached_prefixes = set()
+        self.batch_prompts = batch_prompts
+        self.completion_delay = completion_delay
+        # number of prompts of each /v1/completions request
+        self.completion_batches = []
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def next_error(self):
+        with self.lock:
+            if self.error_statuses:
+                return self.error_statuses.pop(0)
+        return None
+
+    def next_response(self, prompt):
+        with self.lock:
+            index = self.request_count
+            self.request_count += 1
+            self.prompts.append(prompt)
+        if callable(self.responses):
+            return self.responses(prompt)
+        return self.responses[index % len(self.responses)]
+
+    def create_batch(self, kind, requests):
+        '''
+        answers every request of a batch up front, and returns the id of the batch
+        '''
+        with self.lock:
+            batch_id = f'{kind}_batch_{len(self.batches)}'
+        responses = dict({})
+        input_tokens = dict({})
+        for custom_id, prompt in requests:
+            responses[custom_id] = self.next_response(prompt)
+            input_tokens[custom_id] = len(prompt) // 4
+        with self.lock:
+            self.batches[batch_id] = dict({'ends_at': time.monotonic() + self.batch_delay, 'responses': responses, 'input_tokens': input_tokens})
+        return batch_id
+
+    def batch_done(self, batch_id):
+        return time.monotonic() >= self.batches[batch_id]['ends_at']
+
+    def openai_usage(self, prompt):
+        '''
+        returns the prompt tokens and cached tokens of an OpenAI prompt, which is cached in increments of 128 tokens
+        '''
+        with self.lock:
+            # self.prompts already holds prompt, as the last element
+            shared = max([common_prefix_length(prompt, earlier) for earlier in self.prompts[:-1]] + [0])
+        cached = shared // 4
+        cached = cached - (cached - self.min_cache_tokens) % 128 if cached >= self.min_cache_tokens else 0
+        return len(prompt) // 4, cached
+
+    def anthropic_usage(self, content):
+        '''
+        returns the uncached input tokens, cache read tokens and cache write tokens of an Anthropic message content
+        '''
+        if isinstance(content, str):
+            return len(content) // 4, 0, 0
+        text = ''
+        prefix = ''
+        for block in content:
+            text += block.get('text', '')
+            if block.get('cache_control'):
+                prefix = text
+        if len(prefix) // 4 < self.min_cache_tokens:
+            return len(text) // 4, 0, 0
+        with self.lock:
+            hit = prefix in self.cached_prefixes
+            self.cached_prefixes.add(prefix)
+        if hit:
+            return (len(text) - len(prefix)) // 4, len(prefix) // 4, 0
+        return (len(text) - len(prefix)) // 4, 0, len(prefix) // 4
+
+    def chunks(self, text):
+        for i in range(0, len(text), self.chunk_size):
+            if self.chunk_delay:
+                time.sleep(self.chunk_delay)
+            yield text[i:i + self.chunk_size]
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive connections, so that clients can reuse pooled connections
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                with fake.lock:
+                    fake.connections += 1
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, payload):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_events(self, events):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                try:
+                    for event, payload in events:
+                        data = payload if isinstance(payload, str) else json.dumps(payload)
+                        prefix = f'event: {event}\n' if event else ''
+                        self.wfile.write(f'{prefix}data: {data}\n\n'.encode('utf-8'))
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    with fake.lock:
+                        fake.disconnects += 1
+                self.close_connection = True
+
+            def send_error_status(self, status):
+                body = json.dumps({'error': {'type': 'rate_limit_error', 'message': f'fake error {status}'}}).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                if fake.retry_after is not None:
+                    self.send_header('retry-after', str(fake.retry_after))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                status = fake.next_error()
+                if status is not None:
+                    self.send_error_status(status)
+                    return
+                path = self.path.split('?')[0].rstrip('/')
+                if path.endswith('/files'):
+                    self.upload_file(body)
+                    return
+                request = json.loads(body or b'{}')
+                if path.endswith('/messages/batches'):
+                    requests = [(entry['custom_id'], prompt_text(entry['params']['messages'][-1]['content'])) for entry in request['requests']]
+                    self.send_json(self.anthropic_batch(fake.create_batch('msgbatch', requests)))
+                elif path.endswith('/batches'):
+                    lines = fake.files[request['input_file_id']].decode('utf-8').splitlines()
+                    entries = [json.loads(line) for line in lines if line.strip()]
+                    requests = [(entry['custom_id'], prompt_text(entry['body']['messages'][-1]['content'])) for entry in entries]
+                    self.send_json(self.openai_batch(fake.create_batch('batch', requests), request['input_file_id']))
+                elif path.endswith('/chat/completions'):
+                    self.chat_completion(request)
+                elif path.endswith('/completions'):
+                    self.completion(request)
+                elif path.endswith('/messages'):
+                    self.message(request)
+                else:
+                    self.send_error(404)
+
+            def do_GET(self):
+                path = self.path.split('?')[0].rstrip('/')
+                parts = path.split('/')
+                if path.endswith('/results') and '/messages/batches/' in path:
+                    batch_id = parts[-2]
+                    lines = []
+                    for custom_id, text in fake.batches[batch_id]['responses'].items():
+                        if text is None:
+                            lines.append(json.dumps({'custom_id': custom_id, 'result': {'type': 'errored', 'error': {'type': 'error', 'error': {'type': 'api_error', 'message': 'fake error'}}}}))
+                            continue
+                        input_tokens = (fake.batches[batch_id]['input_tokens'][custom_id], 0, 0)
+                        lines.append(json.dumps({'custom_id': custom_id, 'result': {'type': 'succeeded', 'message': self.anthropic_message('fake', text, input_tokens, len(text) // 4)}}))
+                    body = '\n'.join(lines).encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/binary')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                elif '/messages/batches/' in path:
+                    self.send_json(self.anthropic_batch(parts[-1]))
+                elif '/batches/' in path:
+                    self.send_json(self.openai_batch(parts[-1], None))
+                elif path.endswith('/content') and '/files/' in path:
+                    body = fake.files[parts[-2]]
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/octet-stream')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                else:
+                    self.send_error(404)
+
+            def upload_file(self, body):
+                message = BytesParser(policy=default_policy).parsebytes(
+                    b'Content-Type: ' + self.headers['Content-Type'].encode('utf-8') + b'\r\n\r\n' + body)
+                content = b''
+                for part in message.iter_parts():
+                    if part.get_param('name', header='content-disposition') == 'file':
+                        content = part.get_payload(decode=True)
+                with fake.lock:
+                    file_id = f'file-{len(fake.files)}'
+                    fake.files[file_id] = content
+                self.send_json({'id': file_id, 'object': 'file', 'bytes': len(content), 'created_at': 0,
+                                'filename': 'batch.jsonl', 'purpose': 'batch', 'status': 'processed'})
+
+            def openai_batch(self, batch_id, input_file_id):
+                done = fake.batch_done(batch_id)
+                output_file_id = None
+                if done:
+                    output_file_id = f'file-{batch_id}-output'
+                    if output_file_id not in fake.files:
+                        lines = []
+                        for custom_id, text in fake.batches[batch_id]['responses'].items():
+                            if text is None:
+                                lines.append(json.dumps({'id': f'response-{custom_id}', 'custom_id': custom_id, 'error': None, 'response': {
+                                    'status_code': 500, 'request_id': custom_id, 'body': {'error': {'message': 'fake error', 'type': 'server_error'}}}}))
+                                continue
+                            input_tokens = (fake.batches[batch_id]['input_tokens'][custom_id], 0)
+                            lines.append(json.dumps({'id': f'response-{custom_id}', 'custom_id': custom_id, 'error': None, 'response': {
+                                'status_code': 200, 'request_id': custom_id, 'body': self.openai_completion('fake', text, input_tokens, len(text) // 4)}}))
+                        with fake.lock:
+                            fake.files[output_file_id] = '\n'.join(lines).encode('utf-8')
+                count = len(fake.batches[batch_id]['responses'])
+                return {'id': batch_id, 'object': 'batch', 'endpoint': '/v1/chat/completions', 'input_file_id': input_file_id or 'file-input',
+                        'completion_window': '24h', 'status': 'completed' if done else 'in_progress', 'created_at': 0,
+                        'output_file_id': output_file_id, 'error_file_id': None,
+                        'request_counts': {'total': count, 'completed': count if done else 0, 'failed': 0}}
+
+            def anthropic_batch(self, batch_id):
+                done = fake.batch_done(batch_id)
+                count = len(fake.batches[batch_id]['responses'])
+                host, port = fake.server.server_address[:2]
+                return {'id': batch_id, 'type': 'message_batch', 'processing_status': 'ended' if done else 'in_progress',
+                        'request_counts': {'processing': 0 if done else count, 'succeeded': count if done else 0, 'errored': 0, 'canceled': 0, 'expired': 0},
+                        'created_at': '2025-01-01T00:00:00Z', 'expires_at': '2025-01-02T00:00:00Z',
+                        'ended_at': '2025-01-01T00:00:00Z' if done else None, 'cancel_initiated_at': None, 'archived_at': None,
+                        'results_url': f'http://{host}:{port}/v1/messages/batches/{batch_id}/results' if done else None}
+
+            def openai_usage(self, input_tokens, output_tokens):
+                prompt_tokens, cached_tokens = input_tokens
+                return {'prompt_tokens': prompt_tokens, 'completion_tokens': output_tokens, 'total_tokens': prompt_tokens + output_tokens,
+                        'prompt_tokens_details': {'cached_tokens': cached_tokens}}
+
+            def anthropic_usage(self, input_tokens, output_tokens):
+                uncached, cache_read, cache_creation = input_tokens
+                return {'input_tokens': uncached, 'cache_read_input_tokens': cache_read, 'cache_creation_input_tokens': cache_creation,
+                        'output_tokens': output_tokens}
+
+            def openai_completion(self, model, text, input_tokens, output_tokens):
+                return {'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': 0, 'model': model,
+                        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+                        'usage': self.openai_usage(input_tokens, output_tokens)}
+
+            def anthropic_message(self, model, text, input_tokens, output_tokens):
+                return {'id': 'msg_fake', 'type': 'message', 'role': 'assistant', 'model': model,
+                        'content': [{'type': 'text', 'text': text}],
+                        'stop_reason': 'end_turn', 'stop_sequence': None,
+                        'usage': self.anthropic_usage(input_tokens, output_tokens)}
+
+            def chat_completion(self, request):
+                prompt = prompt_text(request['messages'][-1]['content'])
+                text = fake.next_response(prompt)
+                model = request.get('model', 'fake')
+                input_tokens = fake.openai_usage(prompt)
+                if request.get('stream'):
+                    include_usage = (request.get('stream_options') or {}).get('include_usage', False)
+                    self.send_events(self.openai_events(model, text, input_tokens if include_usage else None, len(text) // 4))
+                else:
+                    self.send_json(self.openai_completion(model, text, input_tokens, len(text) // 4))
+
+            def completion(self, request):
+                prompts = request['prompt']
+                if isinstance(prompts, list) and not fake.batch_prompts:
+                    self.send_error_status(400)
+                    return
+                prompts = prompts if isinstance(prompts, list) else [prompts]
+                with fake.lock:
+                    fake.completion_batches.append(len(prompts))
+                if fake.completion_delay:
+                    time.sleep(fake.completion_delay)
+                texts = [fake.next_response(prompt) for prompt in prompts]
+                input_tokens = sum(len(prompt) // 4 for prompt in prompts)
+                output_tokens = sum(len(text) // 4 for text in texts)
+                self.send_json({'id': 'cmpl-fake', 'object': 'text_completion', 'created': 0, 'model': request.get('model', 'fake'),
+                                'choices': [{'index': i, 'text': text, 'finish_reason': 'stop'} for i, text in enumerate(texts)],
+                                'usage': self.openai_usage((input_tokens, 0), output_tokens)})
+
+            def message(self, request):
+                content = request['messages'][-1]['content']
+                text = fake.next_response(prompt_text(content))
+                model = request.get('model', 'fake')
+                input_tokens = fake.anthropic_usage(content)
+                if request.get('stream'):
+                    self.send_events(self.anthropic_events(model, text, input_tokens, len(text) // 4))
+                else:
+                    self.send_json(self.anthropic_message(model, text, input_tokens, len(text) // 4))
+
+            def openai_events(self, model, text, input_tokens, output_tokens):
+                for chunk in fake.chunks(text):
+                    yield None, {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': 0, 'model': model,
+                                 'choices': [{'index': 0, 'delta': {'content': chunk}, 'finish_reason': None}]}
+                yield None, {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': 0, 'model': model,
+                             'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}
+                if input_tokens is not None:
+                    yield None, {'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': 0, 'model': model,
+                                 'choices': [], 'usage': self.openai_usage(input_tokens, output_tokens)}
+                yield None, '[DONE]'
+
+            def anthropic_events(self, model, text, input_tokens, output_tokens):
+                yield 'message_start', {'type': 'message_start', 'message': {
+                    'id': 'msg_fake', 'type': 'message', 'role': 'assistant', 'model': model, 'content': [],
+                    'stop_reason': None, 'stop_sequence': None, 'usage': self.anthropic_usage(input_tokens, 0)}}
+                yield 'content_block_start', {'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}}
+                for chunk in fake.chunks(text):
+                    yield 'content_block_delta', {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': chunk}}
+                yield 'content_block_stop', {'type': 'content_block_stop', 'index': 0}
+                yield 'message_delta', {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None}, 'usage': {'output_tokens': output_tokens}}
+                yield 'message_stop', {'type': 'message_stop'}
+
+        return Handler
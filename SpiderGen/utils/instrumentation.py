@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+'''
+Structured instrumentation of the SpiderGen workflow.
+Spans record the wall time and attributes (i.e, tokens, retries, number of processes) of pipeline stages, LLM calls,
+embedding batches and the clustering of each life cycle module. Finished spans are passed to the metrics hooks
+added to the tracer, and can be exported as a JSON trace.
+'''
+
+logger = logging.getLogger(__name__)
+
+# attributes that are added up across spans in summaries
+SUMMED_ATTRIBUTES = ['input_tokens', 'cached_input_tokens', 'uncached_input_tokens', 'cache_write_input_tokens', 'output_tokens',
+                     'queue_time', 'retries', 'parse_failures', 'cost', 'reused',
+                     'summary_tokens', 'full_summary_tokens']
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+class Span:
+    '''
+    A timed operation, nested under the span that was current when it started.
+    '''
+    def __init__(self, name, kind, trace_id, parent_id, attributes):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.attributes = dict(attributes)
+        self.start_time = time.time()
+        self.started = time.perf_counter()
+        self.duration = None
+        self.status = 'ok'
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self):
+        return dict({
+            'id': self.id,
+            'name': self.name,
+            'kind': self.kind,
+            'trace_id': self.trace_id,
+            'parent_id': self.parent_id,
+            'start_time': self.start_time,
+            'duration': self.duration,
+            'status': self.status,
+            'error': self.error,
+            'attributes': self.attributes,
+        })
+
+class Tracer:
+    '''
+    Collects finished spans, grouped by trace, and passes each of them to the metrics hooks.
+    A hook is any function taking a Span, such as JSONLinesExporter or a client of a metrics service.
+    '''
+    def __init__(self):
+        self.hooks = []
+        self.traces = dict({})
+        self.lock = threading.Lock()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def _new_span(self, name, kind, attributes):
+        parent = _current_span.get()
+        if parent is None:
+            return Span(name, kind, uuid.uuid4().hex[:16], None, attributes)
+        return Span(name, kind, parent.trace_id, parent.id, attributes)
+
+    @contextmanager
+    def span(self, name, kind='internal', **attributes):
+        '''
+        times the block as a span, which is a child of the current span, or the root of a new trace if there is none
+
+        name: name of the span (i.e, a stage name)
+        kind: kind of operation, such as 'stage', 'llm_call', 'embedding' or 'clustering'
+        attributes: initial attributes of the span, more can be added with span.set
+        '''
+        span = self._new_span(name, kind, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.status = 'error'
+            span.error = repr(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.duration = time.perf_counter() - span.started
+            self.finish(span)
+
+    def record(self, name, kind, duration, **attributes):
+        '''
+        records a span that was timed elsewhere (i.e, in a worker process) as a child of the current span
+        '''
+        span = self._new_span(name, kind, attributes)
+        span.start_time -= duration
+        span.duration = duration
+        self.finish(span)
+        return span
+
+    def finish(self, span):
+        with self.lock:
+            self.traces.setdefault(span.trace_id, []).append(span)
+        for hook in list(self.hooks):
+            try:
+                hook(span)
+            except Exception as e:
+                # a failing metrics hook must not end the run
+                logger.warning(f'metrics hook {hook!r} failed: {e!r}')
+
+    def spans(self, trace_id=None):
+        '''
+        returns the finished spans of a trace, or of every trace if trace_id is None
+        '''
+        with self.lock:
+            if trace_id is not None:
+                return list(self.traces.get(trace_id, []))
+            return [span for spans in self.traces.values() for span in spans]
+
+    def clear(self, trace_id=None):
+        with self.lock:
+            if trace_id is not None:
+                self.traces.pop(trace_id, None)
+            else:
+                self.traces.clear()
+
+    def export_json(self, path, trace_id=None):
+        '''
+        writes the spans of a trace, or of every trace, and their summary to a JSON file
+        '''
+        spans = self.spans(trace_id)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(dict({'spans': [span.to_dict() for span in spans], 'summary': summarize_spans(spans)}), f, indent=4, default=str)
+
+def _add_to_summary(summary, span):
+    # stages and module clusterings are grouped by their kind of stage rather than one entry per product or module
+    group = f"{span.kind}:{span.name.split(':')[0]}"
+    entry = summary.setdefault(group, dict({'count': 0, 'seconds': 0.0}))
+    entry['count'] += 1
+    entry['seconds'] += span.duration or 0.0
+    for attribute in SUMMED_ATTRIBUTES:
+        if isinstance(span.attributes.get(attribute), (int, float)):
+            entry[attribute] = entry.get(attribute, 0) + span.attributes[attribute]
+
+def summarize_spans(spans):
+    '''
+    returns the number, total duration and summed token, retry and cost attributes of the spans of each kind and name
+    '''
+    summary = dict({})
+    for span in spans:
+        _add_to_summary(summary, span)
+    return summary
+
+class SpanSummary:
+    '''
+    Metrics hook adding up every finished span as summarize_spans does, so that the summary of a long run
+    is kept after the spans of each trace are cleared.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._summary = dict({})
+
+    def __call__(self, span):
+        with self.lock:
+            _add_to_summary(self._summary, span)
+
+    def summary(self):
+        with self.lock:
+            return {group: dict(entry) for group, entry in self._summary.items()}
+
+class JSONLinesExporter:
+    '''
+    Metrics hook appending each finished span as a line of a JSONL file.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def __call__(self, span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+def call_cost(model_name, usage, batch=False):
+    '''
+    returns the cost of the tokens of a call from token_prices in config.py, or None if the model has no price
+
+    batch: whether the call was made through a batch API, whose tokens cost the 'batch' fraction of the price, half by default
+    '''
+    try:
+        import config
+        prices = getattr(config, 'token_prices', dict({})).get(model_name)
+    except ImportError:
+        prices = None
+    if not prices or 'input_tokens' not in usage:
+        return None
+    cached = usage.get('cached_input_tokens', 0)
+    cost = (usage['input_tokens'] - cached) * prices.get('input', 0.0)
+    cost += cached * prices.get('cached_input', prices.get('input', 0.0))
+    cost += usage.get('cache_write_input_tokens', 0) * (prices.get('cache_write_input', prices.get('input', 0.0)) - prices.get('input', 0.0))
+    cost += usage.get('output_tokens', 0) * prices.get('output', 0.0)
+    if batch:
+        cost *= prices.get('batch', 0.5)
+    return cost / 1e6
+
+_tracer = Tracer()
+
+def get_tracer():
+    '''
+    returns the tracer shared by every caller in this process
+    '''
+    return _tracer
+
+def current_span():
+    return _current_span.get()
@@ -0,0 +1,147 @@
+import re
+import json
+from json.decoder import scanstring
+'''
+Single pass parser for the JSON-like objects returned by LLMs.
+Accepts code fences and prose around the object, single quoted and typographic quoted strings,
+Python literals (True, False, None), unquoted keys and trailing commas.
+Parse failures raise json.JSONDecodeError, which carries the position, line and column of the error.
+'''
+
+WHITESPACE = re.compile(r'\s*')
+NUMBER = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+BARE_WORD = re.compile(r'[A-Za-z_$][\w$\-]*')
+SINGLE_QUOTED = re.compile(r"'([^'\\]*(?:\\.[^'\\]*)*)'", re.DOTALL)
+UNESCAPED_DOUBLE_QUOTE = re.compile(r'(?<!\\)"')
+LITERALS = dict({
+    'true': True, 'True': True,
+    'false': False, 'False': False,
+    'null': None, 'None': None,
+})
+# typographic quotes are treated as string delimiters, closing on their matching quote
+TYPOGRAPHIC_QUOTES = dict({'“': '”', '‘': '’'})
+
+_decoder = json.JSONDecoder(strict=False)
+
+class _LenientParser:
+    def __init__(self, text):
+        self.text = text
+        self.length = len(text)
+
+    def error(self, message, pos):
+        return json.JSONDecodeError(message, self.text, pos)
+
+    def skip(self, pos):
+        if pos < self.length and self.text[pos] not in ' \t\n\r':
+            return pos
+        return WHITESPACE.match(self.text, pos).end()
+
+    def value(self, pos):
+        pos = self.skip(pos)
+        if pos >= self.length:
+            raise self.error('Unexpected end of input, expecting a value', pos)
+        char = self.text[pos]
+        if char == '{':
+            return self.object(pos)
+        if char == '[':
+            return self.array(pos)
+        if char == '"' or char == "'" or char in TYPOGRAPHIC_QUOTES:
+            return self.string(pos)
+        match = NUMBER.match(self.text, pos)
+        if match:
+            number = match.group()
+            if number[0] == '+':
+                number = number[1:]
+            if '.' in number or 'e' in number or 'E' in number:
+                return float(number), match.end()
+            return int(number), match.end()
+        match = BARE_WORD.match(self.text, pos)
+        if match and match.group() in LITERALS:
+            return LITERALS[match.group()], match.end()
+        raise self.error('Expecting value', pos)
+
+    def string(self, pos):
+        char = self.text[pos]
+        if char == '"':
+            return scanstring(self.text, pos + 1, False)
+        if char == "'":
+            match = SINGLE_QUOTED.match(self.text, pos)
+            if match is None:
+                raise self.error('Unterminated string starting at', pos)
+            body = match.group(1)
+            if '\\' not in body:
+                return body, match.end()
+            # rewrite the single quoted body as a double quoted JSON string so escapes are decoded the same way
+            body = UNESCAPED_DOUBLE_QUOTE.sub('\\"', body.replace("\\'", "'"))
+            try:
+                return scanstring('"' + body + '"', 1, False)[0], match.end()
+            except json.JSONDecodeError:
+                return match.group(1), match.end()
+        end = self.text.find(TYPOGRAPHIC_QUOTES[char], pos + 1)
+        if end == -1:
+            raise self.error('Unterminated string starting at', pos)
+        return self.text[pos + 1:end], end + 1
+
+    def key(self, pos):
+        char = self.text[pos]
+        if char == '"' or char == "'" or char in TYPOGRAPHIC_QUOTES:
+            return self.string(pos)
+        match = BARE_WORD.match(self.text, pos)
+        if match is None:
+            raise self.error('Expecting property name', pos)
+        return match.group(), match.end()
+
+    def object(self, pos):
+        result = dict({})
+        pos = self.skip(pos + 1)
+        while True:
+            if pos >= self.length:
+                raise self.error("Unexpected end of input, expecting '}'", pos)
+            if self.text[pos] == '}':
+                return result, pos + 1
+            key, pos = self.key(pos)
+            pos = self.skip(pos)
+            if pos >= self.length or self.text[pos] != ':':
+                raise self.error("Expecting ':' delimiter", pos)
+            value, pos = self.value(pos + 1)
+            result[key] = value
+            pos = self.skip(pos)
+            if pos < self.length and self.text[pos] == ',':
+                # a trailing comma is consumed here and the closing brace is handled at the top of the loop
+                pos = self.skip(pos + 1)
+            elif pos < self.length and self.text[pos] != '}':
+                raise self.error("Expecting ',' delimiter", pos)
+
+    def array(self, pos):
+        result = []
+        pos = self.skip(pos + 1)
+        while True:
+            if pos >= self.length:
+                raise self.error("Unexpected end of input, expecting ']'", pos)
+            if self.text[pos] == ']':
+                return result, pos + 1
+            value, pos = self.value(pos)
+            result.append(value)
+            pos = self.skip(pos)
+            if pos < self.length and self.text[pos] == ',':
+                pos = self.skip(pos + 1)
+            elif pos < self.length and self.text[pos] != ']':
+                raise self.error("Expecting ',' delimiter", pos)
+
+def loads_lenient(text):
+    '''
+    parses the first balanced JSON-like object in text
+
+    text: LLM response which contains a JSON object, possibly wrapped in code fences or prose
+
+    returns the parsed object, or raises json.JSONDecodeError with the position of the first error
+    '''
+    start = text.find('{')
+    if start == -1:
+        raise json.JSONDecodeError('No JSON object found', text, 0)
+    # well formed JSON is decoded by the C scanner, which also stops at the end of the first object
+    try:
+        return _decoder.raw_decode(text, start)[0]
+    except json.JSONDecodeError:
+        pass
+    return _LenientParser(text).object(start)[0]
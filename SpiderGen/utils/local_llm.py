@@ -0,0 +1,167 @@
+import time
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+'''
+Client for a local OpenAI-compatible inference server (i.e, vLLM, llama.cpp or Ollama), used by the 'local' model source.
+Connections are kept in a pool shared by every thread, and the prompts of concurrent callers are coalesced into
+batched requests to /v1/completions, which takes a list of prompts, on servers that support it. Servers which reject
+a list of prompts are sent one /v1/chat/completions request per prompt instead.
+'''
+
+logger = logging.getLogger(__name__)
+
+# statuses of a server which does not accept a list of prompts
+UNSUPPORTED_BATCH_STATUS_CODES = [400, 404, 422]
+
+class RequestCoalescer:
+    '''
+    Groups the prompts submitted by concurrent callers into batches of up to max_batch_size prompts,
+    waiting up to max_wait seconds after the first prompt of a batch for others to arrive.
+    send_batch is called with a list of prompts and returns one result per prompt, in order.
+    '''
+    def __init__(self, send_batch, max_batch_size=8, max_wait=0.01, max_batches_in_flight=4):
+        self.send_batch = send_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending = []
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=max_batches_in_flight)
+        self.thread = None
+        self.stats = dict({'prompts': 0, 'batches': 0})
+
+    def submit(self, prompt):
+        '''
+        blocks until the batch containing prompt is answered, and returns the result of prompt
+        '''
+        future = Future()
+        with self.condition:
+            self.pending.append((prompt, future))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._dispatch, daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+        return future.result()
+
+    def _dispatch(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                deadline = time.monotonic() + self.max_wait
+                while len(self.pending) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch = self.pending[:self.max_batch_size]
+                del self.pending[:self.max_batch_size]
+                self.stats['prompts'] += len(batch)
+                self.stats['batches'] += 1
+            self.executor.submit(self._send, batch)
+
+    def _send(self, batch):
+        try:
+            results = self.send_batch([prompt for prompt, _ in batch])
+        except BaseException as e:
+            # every caller of a failed batch gets the error, and retries through its scheduler
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+
+class LocalLLM:
+    '''
+    LLM served by a local OpenAI-compatible server at base_url (i.e, http://localhost:8000/v1).
+    complete returns a dictionary with the 'text' of the response, its 'usage' when it was not part of a larger batch,
+    and the 'batch_size' of the request it was sent in.
+    '''
+    def __init__(self, model_name, base_url, batching=True, max_batch_size=8, max_wait=0.01, pool_size=16, timeout=600.0,
+                 max_tokens=4096, prompt_format='{prompt}'):
+        '''
+        model_name: name of the model on the server
+        base_url: URL of the OpenAI-compatible API of the server
+        batching: whether to coalesce concurrent prompts into batched /v1/completions requests
+        max_batch_size: largest number of prompts sent in one request
+        max_wait: seconds to wait for more prompts once a batch has its first prompt
+        pool_size: number of connections kept open to the server
+        timeout: seconds to wait for a response
+        max_tokens: largest number of tokens generated per prompt
+        prompt_format: format of the raw prompts sent to /v1/completions, which do not go through the chat template of the model
+        '''
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.model_name = model_name
+        self.base_url = base_url.rstrip('/')
+        self.batching = batching
+        self.timeout = timeout
+        self.max_tokens = max_tokens
+        self.prompt_format = prompt_format
+        self.session = requests.Session()
+        # retries are left to the scheduler of the 'local' source
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.coalescer = RequestCoalescer(self.send_batch, max_batch_size, max_wait, max(1, pool_size // max(1, max_batch_size)))
+
+    def post(self, path, payload):
+        response = self.session.post(f'{self.base_url}{path}', json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def chat(self, prompt):
+        completion = self.post('/chat/completions', dict({
+            'model': self.model_name,
+            'messages': [{'role': 'user', 'content': str(prompt)}],
+            'max_tokens': self.max_tokens,
+        }))
+        return dict({'text': completion['choices'][0]['message']['content'], 'usage': completion_usage(completion), 'batch_size': 1})
+
+    def send_batch(self, prompts):
+        '''
+        sends prompts in one /v1/completions request, or one chat request each if the server does not support batches
+        '''
+        import requests
+        if not self.batching:
+            return [self.chat(prompt) for prompt in prompts]
+        try:
+            completion = self.post('/completions', dict({
+                'model': self.model_name,
+                'prompt': [self.prompt_format.format(prompt=str(prompt)) for prompt in prompts],
+                'max_tokens': self.max_tokens,
+            }))
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code not in UNSUPPORTED_BATCH_STATUS_CODES:
+                raise
+            logger.warning(f'{self.base_url} does not accept batches of prompts ({e.response.status_code}), sending one request per prompt')
+            self.batching = False
+            return [self.chat(prompt) for prompt in prompts]
+        texts = [None] * len(prompts)
+        for choice in completion['choices']:
+            texts[choice['index']] = choice['text']
+        # the usage of a batch covers every prompt of it, so it is only attributed to a prompt sent on its own
+        usage = completion_usage(completion) if len(prompts) == 1 else None
+        return [dict({'text': text, 'usage': usage, 'batch_size': len(prompts)}) for text in texts]
+
+    def complete(self, prompt):
+        if not self.batching:
+            return self.chat(prompt)
+        return self.coalescer.submit(prompt)
+
+    def close(self):
+        self.session.close()
+
+def completion_usage(completion):
+    '''
+    returns the input and output tokens reported in the usage of a completion, in the format of record_usage
+    '''
+    usage = completion.get('usage')
+    if not usage:
+        return None
+    return dict({
+        'input_tokens': usage.get('prompt_tokens') or 0,
+        'cached_input_tokens': ((usage.get('prompt_tokens_details') or {}).get('cached_tokens') or 0),
+        'cache_write_input_tokens': 0,
+        'output_tokens': usage.get('completion_tokens') or 0,
+    })
@@ -1,87 +1,110 @@
 import os
 import json
-import ast
-import re
+import time
+import logging
+import threading
+import collections
+from utils.lenient_json import loads_lenient
+from utils.response_cache import ResponseCache, response_cache_key
+from utils.streaming import consume_json_stream
+from utils.scheduler import get_scheduler, estimate_tokens
+from utils.prompt_compiler import anthropic_content
+from utils.instrumentation import get_tracer, call_cost
 '''
 ModelManager class to handle multiple LLM and embedding models from different sources.
-Supports OpenAI, Anthropic and Sentence Transformers.
+Supports OpenAI, Anthropic, local OpenAI-compatible servers ('local') and Sentence Transformers, including ONNX and int8 exports of Sentence Transformers
+('onnx' and 'onnx_int8') for CPU inference, as well as deterministic fake models ('fake' and 'fake_embedding')
+for running and benchmarking the workflow offline.
 '''
 
+logger = logging.getLogger(__name__)
+
+ANTHROPIC_MAX_TOKENS = 8192
+
+# number of recent calls kept in call_stats, so that a long run does not keep every attempt of every call in memory
+MAX_CALL_STATS = 10000
+
+# token counts added up across every call by prompt_cache_summary
+CACHE_SUMMARY_KEYS = ['input_tokens', 'cached_input_tokens', 'uncached_input_tokens', 'cache_write_input_tokens']
+
 def safe_json_load(response_content):
     if isinstance(response_content, dict):
-        print('in here')
+        logger.debug('response is already a dictionary')
         return json.dumps(response_content, ensure_ascii=False)
 
     if not isinstance(response_content, str):
         response_content = str(response_content)
 
-    response_content = re.sub(r"^```[a-zA-Z]*\n?", "", response_content.strip())
-    response_content = re.sub(r"```$", "", response_content.strip())
-    response_content = response_content.replace('"', '"').replace('"', '"')
-    response_content = response_content.replace("'", "'").replace("'", "'")
-
-    if '{' in response_content:
-        start = response_content.find('{')
-        
-        # Find the MATCHING closing brace, not just the last one
-        brace_count = 0
-        end = start
-        for i in range(start, len(response_content)):
-            if response_content[i] == '{':
-                brace_count += 1
-            elif response_content[i] == '}':
-                brace_count -= 1
-                if brace_count == 0:
-                    end = i + 1
-                    break
-        
-        if end > start:
-            response_content = response_content[start:end]
-
     try:
-        python_obj = ast.literal_eval(response_content)
-        return python_obj
-    except Exception:
-        pass
+        return loads_lenient(response_content)
+    except json.JSONDecodeError as e:
+        logger.warning(f"Failed to parse JSON-like string: {e.msg} at line {e.lineno} column {e.colno} (char {e.pos})")
+        logger.debug(f"Offending text: {response_content[max(e.pos - 80, 0):e.pos + 80]}")
+        return {}
 
-    try:
-        python_obj = json.loads(response_content)
-        return python_obj
-    except Exception:
-        pass
-
-    fixed_val = (
-        response_content
-        .replace(" None", " null")
-        .replace(" True", " true")
-        .replace(" False", " false")
-    )
-    
-    fixed_val = re.sub(r',(\s*[}\]])', r'\1', fixed_val)
 
-    fixed_val = re.sub(
-        r"(?<=\{|,)\s*'([^']+)'\s*:",
-        lambda m: f'"{m.group(1)}":',
-        fixed_val
-    )
-    fixed_val = re.sub(
-        r"'([^']*)'",
-        lambda m: '"' + m.group(1).replace('"', '\\"') + '"',
-        fixed_val
-    )
+def write_trace(trace_folder, name, response):
+    '''
+    records the response of the model registered under name in trace_folder
+    '''
+    os.makedirs(trace_folder, exist_ok=True)
+    with open(os.path.join(trace_folder, f"{name}_response.json"), 'w') as f:
+        json.dump(response, f, indent=4)
 
-    try:
-        python_obj = json.loads(fixed_val)
-        return python_obj
-    except Exception as e:
-        print("Failed to parse JSON-like string:", e)
-        print("Offending text:", response_content)
-        return {}
+def openai_usage(usage):
+    '''
+    returns the input, cached input and output tokens reported by an OpenAI usage object
+    '''
+    if usage is None:
+        return None
+    details = getattr(usage, 'prompt_tokens_details', None)
+    return dict({
+        'input_tokens': usage.prompt_tokens or 0,
+        'cached_input_tokens': (getattr(details, 'cached_tokens', None) or 0) if details is not None else 0,
+        'cache_write_input_tokens': 0,
+        'output_tokens': usage.completion_tokens or 0,
+    })
+
+def anthropic_usage(usage):
+    '''
+    returns the input, cached input and output tokens reported by an Anthropic usage object
+    '''
+    if usage is None:
+        return None
+    # input_tokens only counts the tokens after the last cache breakpoint
+    cached = getattr(usage, 'cache_read_input_tokens', None) or 0
+    written = getattr(usage, 'cache_creation_input_tokens', None) or 0
+    return dict({
+        'input_tokens': (usage.input_tokens or 0) + cached + written,
+        'cached_input_tokens': cached,
+        'cache_write_input_tokens': written,
+        'output_tokens': usage.output_tokens or 0,
+    })
+
+def record_usage(call_info, usage):
+    '''
+    adds the tokens of one attempt to call_info, along with the input tokens which were not read from the prompt cache
+    '''
+    if call_info is None or usage is None:
+        return
+    for key, value in usage.items():
+        call_info[key] = call_info.get(key, 0) + value
+    call_info['uncached_input_tokens'] = call_info['input_tokens'] - call_info['cached_input_tokens']
 
+def record_parse_failure(call_info):
+    if call_info is not None:
+        call_info['parse_failures'] = call_info.get('parse_failures', 0) + 1
 
-def generate_json_openai(prompt, client, model_name, max_retry):
+def _send(request, scheduler, estimated_tokens, call_info, usage=None, max_output_tokens=None):
+    # requests go through the shared scheduler of the provider, if there is one, so that they respect its rate limits,
+    # and the tokens reserved for them are settled with the usage function applied to their result
+    if scheduler is None:
+        return request()
+    return scheduler.call(request, estimated_tokens, call_info, usage=usage, max_output_tokens=max_output_tokens)
+
+def generate_json_openai(prompt, client, model_name, max_retry, scheduler=None, call_info=None):
     for attempt in range(max_retry):
-        completion = client.chat.completions.create(
+        completion = _send(lambda: client.chat.completions.create(
             model = model_name,
             #seed = 42,
             messages=[
@@ -90,88 +113,417 @@ def generate_json_openai(prompt, client, model_name, max_retry):
                     "content":prompt
                 }
             ]
-        )
+        ), scheduler, estimate_tokens(prompt), call_info, usage=lambda completion: openai_usage(completion.usage))
+        record_usage(call_info, openai_usage(completion.usage))
         llm_response = safe_json_load(completion.choices[0].message.content)
         if llm_response == {}:
+            record_parse_failure(call_info)
             continue
         else:
             return llm_response
     return llm_response
 
-def generate_json_anthropic(prompt, client, model_name, max_retry):
+def generate_json_anthropic(prompt, client, model_name, max_retry, scheduler=None, call_info=None):
     for attempt in range(max_retry):
-        completion = client.messages.create(
+        completion = _send(lambda: client.messages.create(
                 model=model_name,
-                max_tokens=8192,
+                max_tokens=ANTHROPIC_MAX_TOKENS,
                 messages=[
-                    {"role": "user", "content": prompt}
+                    {"role": "user", "content": anthropic_content(prompt)}
                 ]
-            )
-        
+            ), scheduler, estimate_tokens(prompt), call_info, usage=lambda completion: anthropic_usage(completion.usage), max_output_tokens=ANTHROPIC_MAX_TOKENS)
+        record_usage(call_info, anthropic_usage(completion.usage))
+
         llm_response = safe_json_load(completion.content[0].text)
         if llm_response == {}:
+                record_parse_failure(call_info)
                 continue
         else:
             return llm_response
     return llm_response
 
+def generate_json_fake(prompt, client, model_name, max_retry, scheduler=None, call_info=None):
+    for attempt in range(max_retry):
+        llm_response = safe_json_load(client.complete(prompt))
+        if llm_response == {}:
+            record_parse_failure(call_info)
+            continue
+        else:
+            return llm_response
+    return llm_response
+
+def generate_json_local(prompt, client, model_name, max_retry, scheduler=None, call_info=None):
+    for attempt in range(max_retry):
+        result = _send(lambda: client.complete(prompt), scheduler, estimate_tokens(prompt), call_info, usage=lambda result: result['usage'], max_output_tokens=client.max_tokens)
+        record_usage(call_info, result['usage'])
+        if call_info is not None:
+            call_info['batch_size'] = result['batch_size']
+        llm_response = safe_json_load(result['text'])
+        if llm_response == {}:
+            record_parse_failure(call_info)
+            continue
+        else:
+            return llm_response
+    return llm_response
+
+def _openai_text_stream(stream, attempt_usage):
+    for chunk in stream:
+        if getattr(chunk, 'usage', None) is not None:
+            # the usage is sent in a last chunk without choices, so it is missing from aborted attempts
+            attempt_usage.update(openai_usage(chunk.usage))
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+def _stream_openai(prompt, client, model_name):
+    started = time.perf_counter()
+    stream = client.chat.completions.create(
+        model = model_name,
+        messages=[
+            {
+                "role": "user",
+                "content":prompt
+            }
+        ],
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+    attempt_usage = dict({})
+    try:
+        text, validator, attempt_stats = consume_json_stream(_openai_text_stream(stream, attempt_usage), started)
+        if not attempt_usage and validator.state == 'complete':
+            # the object can be complete before the last chunk, which carries the usage, has been read
+            for _ in _openai_text_stream(stream, attempt_usage):
+                pass
+        attempt_stats['usage'] = attempt_usage or None
+        return text, validator, attempt_stats
+    finally:
+        # closing the stream ends the request, so an aborted response stops being generated
+        stream.close()
+
+def _stream_anthropic(prompt, client, model_name):
+    started = time.perf_counter()
+    # leaving the context manager closes the connection, so an aborted response stops being generated
+    with client.messages.stream(
+            model=model_name,
+            max_tokens=ANTHROPIC_MAX_TOKENS,
+            messages=[
+                {"role": "user", "content": anthropic_content(prompt)}
+            ]
+        ) as stream:
+        text, validator, attempt_stats = consume_json_stream(stream.text_stream, started)
+        if validator.state == 'complete':
+            # the object can be complete before the message_delta event, which carries the output usage, has been read
+            stream.until_done()
+        # the input usage is known from the first event, and the output usage up to the last event read
+        attempt_stats['usage'] = anthropic_usage(stream.current_message_snapshot.usage)
+        return text, validator, attempt_stats
+
+def generate_json_openai_stream(prompt, client, model_name, max_retry, scheduler=None, call_info=None):
+    '''
+    streams the response and aborts an attempt as soon as it can no longer produce a JSON object
+
+    call_info: optional dictionary, to whose 'attempts' list the timings of each attempt are appended
+    '''
+    return _generate_json_stream(lambda: _stream_openai(prompt, client, model_name), max_retry, scheduler, estimate_tokens(prompt), call_info, None)
+
+def generate_json_anthropic_stream(prompt, client, model_name, max_retry, scheduler=None, call_info=None):
+    '''
+    streams the response and aborts an attempt as soon as it can no longer produce a JSON object
+
+    call_info: optional dictionary, to whose 'attempts' list the timings of each attempt are appended
+    '''
+    return _generate_json_stream(lambda: _stream_anthropic(prompt, client, model_name), max_retry, scheduler, estimate_tokens(prompt), call_info, ANTHROPIC_MAX_TOKENS)
+
+def _generate_json_stream(stream_request, max_retry, scheduler, estimated_tokens, call_info, max_output_tokens):
+    llm_response = {}
+    for attempt in range(max_retry):
+        text, validator, attempt_stats = _send(stream_request, scheduler, estimated_tokens, call_info, usage=lambda result: result[2]['usage'],
+                                               max_output_tokens=max_output_tokens)
+        if call_info is not None:
+            call_info.setdefault('attempts', []).append(attempt_stats)
+            record_usage(call_info, attempt_stats['usage'])
+        if validator.state == 'invalid':
+            logger.warning(f'aborted streamed response: {validator.error}')
+            record_parse_failure(call_info)
+            continue
+        llm_response = safe_json_load(text)
+        if llm_response != {}:
+            return llm_response
+        record_parse_failure(call_info)
+    return llm_response
+
+class LazyModel:
+    '''
+    Stand-in for a model which is only loaded on its first use, such as client.chat or model.encode,
+    so that runs which are served from the caches never pay for loading it.
+    '''
+    def __init__(self, loader):
+        self._loader = loader
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._model is not None
+
+    def load(self):
+        '''
+        returns the model, loading it once if this is its first use
+        '''
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = self._loader()
+        return self._model
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
 class ModelManager:
     def __init__(self):
         self.models = dict({})
         self.model_names = dict({})
         self.model_source = dict({})
         self.max_retries = 3
+        self.cache = None
+        self.cache_bypass = False
+        self.embedding_cache = None
+        self.template_cache = None
+        self.streaming = False
+        # the most recent calls, while the totals of prompt_cache_summary cover every call
+        self.call_stats = collections.deque(maxlen=MAX_CALL_STATS)
+        self.call_totals = dict({'calls': 0, **{key: 0 for key in CACHE_SUMMARY_KEYS}})
+        self.stats_lock = threading.Lock()
+        self.use_scheduler = True
+        self.recorder = None
     
     def load_model_from_source(self, name, source):
         if source == 'openai':
-            from config import openai_api_key
+            import config
             from openai import OpenAI
+            # retries are left to the shared scheduler, which backs off across every caller
             client = OpenAI(
-                api_key=openai_api_key,
+                api_key=config.openai_api_key,
+                base_url=getattr(config, 'openai_base_url', None),
+                max_retries=0,
             )
             return client
         elif source == 'sentence_transformer':
             from sentence_transformers import SentenceTransformer
             return SentenceTransformer(name)
+        elif source in ('onnx', 'onnx_int8'):
+            import config
+            from utils.onnx_embedding import OnnxEmbedding
+            return OnnxEmbedding(name, quantized=source == 'onnx_int8', **getattr(config, 'onnx_embedding_config', dict({})))
         elif source == 'anthropic':
-            from config import anthropic_api_key
+            import config
             import anthropic
-            client = anthropic.Anthropic(api_key=anthropic_api_key)
+            client = anthropic.Anthropic(api_key=config.anthropic_api_key, base_url=getattr(config, 'anthropic_base_url', None), max_retries=0)
             return client
+        elif source == 'local':
+            import config
+            from utils.local_llm import LocalLLM
+            return LocalLLM(name, getattr(config, 'local_llm_base_url', 'http://localhost:8000/v1'), **getattr(config, 'local_llm_config', dict({})))
+        elif source == 'fake':
+            from utils.fake_llm import FakeLLM
+            return FakeLLM()
+        elif source == 'fake_embedding':
+            from utils.fake_llm import FakeEmbedding
+            return FakeEmbedding()
         else:
             raise ValueError(f"Unknown model source '{source}'")
 
+    def enable_cache(self, path='./cache/llm_responses.sqlite', max_entries=10000, max_bytes=512 * 1024 * 1024):
+        '''
+        enables the on-disk response cache for generate_json
+        '''
+        self.cache = ResponseCache(path, max_entries=max_entries, max_bytes=max_bytes)
+        return self.cache
+
+    def enable_embedding_cache(self, path='./cache/embeddings', name='embedding_transformer'):
+        '''
+        enables the persistent embedding cache for the embedding model registered under name
+        '''
+        from utils.embedding_cache import EmbeddingCache
+        self.embedding_cache = EmbeddingCache(path, self.embedding_model_id(name))
+        return self.embedding_cache
+
+    def enable_template_cache(self, path='./cache/templates', threshold=0.95, name='embedding_transformer'):
+        '''
+        enables the semantic cache of sample product templates, which compares products with the embedding model registered under name
+
+        threshold: lowest cosine similarity between two products for one to reuse the template of the other
+        '''
+        from utils.template_cache import TemplateCache
+        self.template_cache = TemplateCache(path, self.models[name], self.embedding_model_id(name), threshold=threshold)
+        return self.template_cache
+
+    def embedding_model_id(self, name):
+        '''
+        returns the name embeddings of the model registered under name are cached and checkpointed under
+        '''
+        if self.model_source[name] == 'sentence_transformer':
+            return self.model_names[name]
+        # the ONNX, int8 and fake variants of a model give different embeddings, so they are kept apart from the original
+        return f'{self.model_names[name]}.{self.model_source[name]}'
+
+    def enable_recording(self, path):
+        '''
+        appends the response of every LLM call to path, so that the run can be replayed offline with the 'fake' source
+        '''
+        from utils.fake_llm import ResponseRecorder
+        self.recorder = ResponseRecorder(path)
+        return self.recorder
+
+    def generation_params(self, name):
+        '''
+        returns the parameters, other than the prompt, that affect the response of the model registered under name
+        '''
+        if self.model_source[name] == 'anthropic':
+            return dict({'max_tokens': ANTHROPIC_MAX_TOKENS})
+        return dict({})
+
+    def model_config(self, name):
+        '''
+        returns the source, model name and generation parameters of the model registered under name
+        '''
+        return dict({'source': self.model_source[name], 'model_name': self.model_names[name], **self.generation_params(name)})
+
+    def batch_transport(self, name):
+        '''
+        returns a BatchTransport for the batch API of the model registered under name
+        '''
+        from utils.batch_api import OpenAIBatchTransport, AnthropicBatchTransport
+        if self.model_source[name] == 'openai':
+            return OpenAIBatchTransport(self.models[name], self.model_names[name])
+        elif self.model_source[name] == 'anthropic':
+            return AnthropicBatchTransport(self.models[name], self.model_names[name], ANTHROPIC_MAX_TOKENS)
+        raise ValueError(f"Model source '{self.model_source[name]}' has no batch API")
+
+    def cached_response(self, name, prompt):
+        '''
+        returns the cached response of the model registered under name to prompt, or None if it is not cached
+        '''
+        if self.cache is None or self.cache_bypass:
+            return None
+        return self.cache.get(response_cache_key(self.model_source[name], self.model_names[name], prompt, self.generation_params(name)))
+
+    def cache_response(self, name, prompt, response):
+        '''
+        caches the response of the model registered under name to prompt, unless it could not be parsed
+        '''
+        if self.cache is None or self.cache_bypass or response == {}:
+            return
+        self.cache.put(response_cache_key(self.model_source[name], self.model_names[name], prompt, self.generation_params(name)), response)
+
     def register_model(self, name, source, model_name, model):
         self.models[name] = model
         self.model_source[name] = source
-        print(self.model_source[name])
+        logger.debug(f'registered {source} model {model_name} as {name}')
         self.model_names[name] = model_name
     
-    def create_model_environ(self, sources, model_names, roles):
+    def create_model_environ(self, sources, model_names, roles, lazy=True):
+        '''
+        registers a model for each role
+
+        lazy: whether to load each model on its first use instead of now
+        '''
         if (len(sources) != len(model_names)) or (len(sources) != len(roles)) :
             raise ValueError("Sources and names must be the same length.")
         for i in range(len(sources)):
-            model = self.load_model_from_source(model_names[i], sources[i])
+            if lazy:
+                model = LazyModel(lambda model_name=model_names[i], source=sources[i]: self.load_model_from_source(model_name, source))
+            else:
+                model = self.load_model_from_source(model_names[i], sources[i])
             self.register_model(roles[i], sources[i], model_names[i], model)
 
-    def generate_json(self, name, prompt,trace_folder=None):
-        print(self.model_source[name])
-        if self.model_source[name] == 'openai':
-            response = generate_json_openai(prompt,self.models[name], self.model_names[name], self.max_retries)
-            if trace_folder:
-                os.makedirs(trace_folder, exist_ok=True)
-                with open(os.path.join(trace_folder, f"{name}_response.json"), 'w') as f:
-                    json.dump(response, f, indent=4)
-            return response
-        elif self.model_source[name] == 'anthropic':
-            response =generate_json_anthropic(prompt, self.models[name], self.model_names[name], self.max_retries)
-            if trace_folder:
-                os.makedirs(trace_folder, exist_ok=True)
-                with open(os.path.join(trace_folder, f"{name}_response.json"), 'w') as f:
-                    json.dump(response, f, indent=4)
-            return response
-        else:
+    def generate_json(self, name, prompt, trace_folder=None, refresh=False):
+        '''
+        generates a JSON response from the model registered under name
+
+        name: role of the model (i.e, llm)
+        prompt: prompt to send to the model
+        trace_folder: folder to record the response in, if any
+        refresh: if True, the cached response is ignored and replaced with a newly generated one
+        '''
+        if self.model_source[name] not in ('openai', 'anthropic', 'local', 'fake'):
             raise ValueError(f"Unrecognized model source for model '{name}'.")
+
+        with get_tracer().span('generate_json', kind='llm_call', role=name, source=self.model_source[name], model=self.model_names[name]) as span:
+            response = None if refresh else self.cached_response(name, prompt)
+            span.set(response_cache_hit=response is not None)
+            if response is None:
+                # streamed calls also record the time to first byte and the time to abort of every attempt
+                call_info = dict({'role': name})
+                # fake models have no rate limits to schedule under
+                scheduler = get_scheduler(self.model_source[name]) if self.use_scheduler and self.model_source[name] != 'fake' else None
+                if self.model_source[name] == 'fake':
+                    generate = generate_json_fake
+                elif self.model_source[name] == 'local':
+                    # local servers are not streamed, so that concurrent calls can be coalesced into batches
+                    generate = generate_json_local
+                elif self.streaming:
+                    generate = generate_json_openai_stream if self.model_source[name] == 'openai' else generate_json_anthropic_stream
+                else:
+                    generate = generate_json_openai if self.model_source[name] == 'openai' else generate_json_anthropic
+                try:
+                    response = generate(prompt, self.models[name], self.model_names[name], self.max_retries, scheduler, call_info)
+                finally:
+                    cost = call_cost(self.model_names[name], call_info)
+                    if cost is not None:
+                        call_info['cost'] = cost
+                    self.record_call_stats(call_info)
+                    span.set(**{key: value for key, value in call_info.items() if key not in ('role', 'attempts')})
+                    if 'attempts' in call_info:
+                        span.set(attempts=len(call_info['attempts']),
+                                 time_to_first_byte=[attempt['time_to_first_byte'] for attempt in call_info['attempts']])
+                span.set(parsed=response != {})
+                logger.debug(f"{name} call: {call_info.get('cached_input_tokens', 0)} of {call_info.get('input_tokens', 0)} input tokens read from the prompt cache, "
+                             f"{call_info.get('output_tokens', 0)} output tokens, {call_info.get('retries', 0)} retries, {call_info.get('parse_failures', 0)} parse failures")
+                # unparseable responses are not cached so that they are retried on the next run
+                self.cache_response(name, prompt, response)
+                if self.recorder is not None and response != {}:
+                    self.recorder.record(prompt, response)
+        if trace_folder:
+            write_trace(trace_folder, name, response)
+        return response
+
+    def record_batch_call(self, name, usage, parsed=True):
+        '''
+        records a request answered through the batch API of the model registered under name, with its usage and cost,
+        in call_stats and as an llm_call span
+
+        usage: tokens reported for the request, in the format of openai_usage or anthropic_usage, or None
+        parsed: whether the response could be parsed
+        '''
+        call_info = dict({'role': name, 'batch': True})
+        record_usage(call_info, usage)
+        if not parsed:
+            record_parse_failure(call_info)
+        cost = call_cost(self.model_names[name], call_info, batch=True)
+        if cost is not None:
+            call_info['cost'] = cost
+        self.record_call_stats(call_info)
+        # batch requests have no wall time of their own, the batch is waited for as a whole
+        get_tracer().record('generate_json', 'llm_call', 0.0, source=self.model_source[name], model=self.model_names[name], parsed=parsed, **call_info)
+
+    def record_call_stats(self, call_info):
+        '''
+        keeps call_info in call_stats, which only holds the last MAX_CALL_STATS calls, and adds its tokens to the totals of prompt_cache_summary
+        '''
+        with self.stats_lock:
+            self.call_stats.append(call_info)
+            self.call_totals['calls'] += 1
+            for key in CACHE_SUMMARY_KEYS:
+                self.call_totals[key] += call_info.get(key, 0)
+
+    def prompt_cache_summary(self):
+        '''
+        returns the total input tokens of the calls made so far, split into tokens read from the provider prompt cache and uncached tokens
+        '''
+        with self.stats_lock:
+            return dict(self.call_totals)
+
     def list_models(self):
         print(f'Model Roles: {self.models.keys()}')
         print(f'Model Sources: {self.model_source.values()}')
@@ -0,0 +1,119 @@
+import os
+import inspect
+import logging
+import numpy as np
+'''
+ONNX Runtime embedding model for the embedding_transformer role, a CPU alternative to the PyTorch sentence transformer.
+The configured sentence transformer is exported to ONNX once, optionally with its weights dynamically quantized to int8,
+and encode keeps the contract of SentenceTransformer.encode that the clustering relies on.
+'''
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ONNX_FOLDER = './models/onnx'
+
+def hub_model_id(model_name):
+    # sentence transformers resolves bare model names, such as all-mpnet-base-v2, to the sentence-transformers organization
+    return model_name if '/' in model_name else f'sentence-transformers/{model_name}'
+
+def export_onnx_model(model_name, folder, quantize=True, opset_version=17):
+    '''
+    exports the transformer of a sentence transformer model to ONNX, and quantizes its weights to int8, unless already done
+
+    model_name: name of the sentence transformer model (i.e, all-mpnet-base-v2)
+    folder: folder the ONNX models and the tokenizer are saved to
+    quantize: whether to also write the dynamically quantized int8 model
+
+    returns the paths of the fp32 model and of the int8 model, which is None if quantize is False
+    '''
+    os.makedirs(folder, exist_ok=True)
+    fp32_path = os.path.join(folder, 'model.onnx')
+    int8_path = os.path.join(folder, 'model_int8.onnx')
+    if not os.path.isfile(fp32_path):
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+        logger.info(f'exporting {model_name} to {fp32_path}')
+        tokenizer = AutoTokenizer.from_pretrained(hub_model_id(model_name))
+        model = AutoModel.from_pretrained(hub_model_id(model_name)).eval()
+        example = tokenizer(['steel production'], return_tensors='pt')
+        axes = dict({'input_ids': {0: 'batch', 1: 'sequence'}, 'attention_mask': {0: 'batch', 1: 'sequence'}, 'last_hidden_state': {0: 'batch', 1: 'sequence'}})
+        # recent versions of torch default to the dynamo exporter, which needs onnxscript and ignores dynamic_axes
+        export_options = dict({'dynamo': False}) if 'dynamo' in inspect.signature(torch.onnx.export).parameters else dict({})
+        # the model is written under a temporary name and renamed, so that an interrupted export is redone
+        with torch.no_grad():
+            torch.onnx.export(model, (example['input_ids'], example['attention_mask']), fp32_path + '.tmp',
+                              input_names=['input_ids', 'attention_mask'], output_names=['last_hidden_state'],
+                              dynamic_axes=axes, opset_version=opset_version, **export_options)
+        tokenizer.save_pretrained(folder)
+        os.replace(fp32_path + '.tmp', fp32_path)
+    if not quantize:
+        return fp32_path, None
+    if not os.path.isfile(int8_path):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        logger.info(f'quantizing {fp32_path} to int8')
+        quantize_dynamic(fp32_path, int8_path + '.tmp', weight_type=QuantType.QInt8)
+        os.replace(int8_path + '.tmp', int8_path)
+    return fp32_path, int8_path
+
+class OnnxEmbedding:
+    '''
+    Sentence embedding model running an ONNX export of a sentence transformer with ONNX Runtime on CPU.
+    Token embeddings are mean pooled over the attention mask, as in all-mpnet-base-v2 and most sentence transformers.
+    '''
+    def __init__(self, model_name, folder=None, quantized=True, batch_size=64, intra_op_threads=None, max_seq_length=384):
+        '''
+        model_name: name of the sentence transformer model, which is exported on first use
+        folder: folder of the exported models, by default a folder per model under DEFAULT_ONNX_FOLDER
+        quantized: whether to run the int8 model rather than the fp32 model
+        batch_size: default number of sentences per inference call
+        intra_op_threads: number of threads used within each operator, None lets ONNX Runtime use every core
+        max_seq_length: number of tokens sentences are truncated to
+        '''
+        import onnxruntime
+        from transformers import AutoTokenizer
+        self.model_name = model_name
+        self.folder = folder or os.path.join(DEFAULT_ONNX_FOLDER, model_name.replace('/', '_'))
+        self.quantized = quantized
+        self.batch_size = batch_size
+        self.max_seq_length = max_seq_length
+        fp32_path, int8_path = export_onnx_model(model_name, self.folder, quantize=quantized)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        self.session = onnxruntime.InferenceSession(int8_path if quantized else fp32_path, sess_options=options, providers=['CPUExecutionProvider'])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+        self.tokenizer = AutoTokenizer.from_pretrained(self.folder)
+        dimension = self.session.get_outputs()[0].shape[-1]
+        self.dimension = dimension if isinstance(dimension, int) else None
+
+    def encode_batch(self, sentences):
+        tokens = self.tokenizer(sentences, padding=True, truncation=True, max_length=self.max_seq_length, return_tensors='np')
+        feed = {name: tokens[name].astype(np.int64) for name in self.input_names if name in tokens}
+        token_embeddings = self.session.run(None, feed)[0]
+        mask = tokens['attention_mask'][..., None].astype(np.float32)
+        return (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+    def encode(self, sentences, normalize_embeddings=True, batch_size=None, **kwargs):
+        '''
+        embeds sentences, with the same arguments and output as SentenceTransformer.encode
+
+        returns a float32 array with one row per sentence
+        '''
+        sentences = [str(sentence) for sentence in sentences]
+        batch_size = batch_size or self.batch_size
+        if len(sentences) == 0:
+            return np.zeros((0, self.dimension or 0), dtype=np.float32)
+        # sentences of similar length are batched together, so that each batch is padded as little as possible
+        order = np.argsort([len(sentence) for sentence in sentences], kind='stable')
+        embeddings = None
+        for start in range(0, len(sentences), batch_size):
+            rows = order[start:start + batch_size]
+            batch_embeddings = self.encode_batch([sentences[row] for row in rows])
+            if embeddings is None:
+                embeddings = np.zeros((len(sentences), batch_embeddings.shape[1]), dtype=np.float32)
+            embeddings[rows] = batch_embeddings
+        if normalize_embeddings:
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings /= np.where(norms == 0, 1.0, norms)
+        return embeddings
@@ -0,0 +1,86 @@
+import os
+import string
+import threading
+'''
+Compilation of prompt templates into a static prefix and a variable suffix.
+Providers cache the longest prefix that repeats across requests, so the static text of a prompt is placed first,
+with its inputs referred to by name, and the values of the inputs are appended after it.
+'''
+
+INPUTS_HEADER = '\n\nThe values of the bracketed inputs used above are:\n'
+
+class SplitPrompt(str):
+    '''
+    Prompt made of a static prefix, which is identical across calls and can be cached by the provider, and a variable suffix.
+    It is the str prefix + suffix, so it can be used anywhere a prompt is expected.
+    '''
+    def __new__(cls, prefix, suffix):
+        prompt = super().__new__(cls, prefix + suffix)
+        prompt.prefix = prefix
+        prompt.suffix = suffix
+        return prompt
+
+    def __getnewargs__(self):
+        return (self.prefix, self.suffix)
+
+class CompiledPrompt:
+    '''
+    Prompt template whose positional {} placeholders are replaced with references to named inputs.
+    format takes the same positional values as str.format on the template, and returns a SplitPrompt.
+    '''
+    def __init__(self, template, fields):
+        '''
+        template: prompt template with one positional {} placeholder per field
+        fields: name of the input of each placeholder, in order; a name can be repeated to reuse an input
+        '''
+        placeholders = [field_name for _, field_name, _, _ in string.Formatter().parse(template) if field_name is not None]
+        if any(field_name != '' for field_name in placeholders):
+            raise ValueError('Prompt templates can only contain positional {} placeholders')
+        if len(placeholders) != len(fields):
+            raise ValueError(f'Prompt template has {len(placeholders)} placeholders but {len(fields)} fields were given')
+        self.fields = list(fields)
+        self.names = list(dict.fromkeys(fields))
+        self.prefix = template.format(*[f'[{field}]' for field in fields]).rstrip() + INPUTS_HEADER
+
+    def format(self, *values):
+        if len(values) != len(self.fields):
+            raise ValueError(f'Expected {len(self.fields)} values, got {len(values)}')
+        inputs = dict({})
+        for field, value in zip(self.fields, values):
+            if field in inputs and inputs[field] != value:
+                raise ValueError(f"Conflicting values for the prompt input '{field}'")
+            inputs[field] = value
+        return SplitPrompt(self.prefix, '\n'.join(f'{field}: {inputs[field]}' for field in self.names))
+
+def anthropic_content(prompt):
+    '''
+    returns the content of an Anthropic user message for prompt, marking the static prefix of a SplitPrompt as cacheable
+    '''
+    if not isinstance(prompt, SplitPrompt):
+        return prompt
+    return [
+        {'type': 'text', 'text': prompt.prefix, 'cache_control': {'type': 'ephemeral'}},
+        {'type': 'text', 'text': prompt.suffix},
+    ]
+
+_compiled_prompts = dict({})
+_compiled_prompts_lock = threading.Lock()
+
+def load_compiled_prompts(folder, prompt_files, prompt_fields):
+    '''
+    reads and compiles the prompt templates of folder, once per process
+
+    folder: folder containing the prompt files
+    prompt_files: dictionary of prompt name to file name
+    prompt_fields: dictionary of prompt name to the input name of each of its placeholders
+
+    returns a dictionary of prompt name to CompiledPrompt
+    '''
+    with _compiled_prompts_lock:
+        if folder not in _compiled_prompts:
+            prompts = dict({})
+            for name, file_name in prompt_files.items():
+                with open(os.path.join(folder, file_name), 'r') as f:
+                    prompts[name] = CompiledPrompt(f.read(), prompt_fields[name])
+            _compiled_prompts[folder] = prompts
+        return _compiled_prompts[folder]
@@ -0,0 +1,105 @@
+import os
+import json
+import zlib
+import time
+import sqlite3
+import hashlib
+import threading
+'''
+Content-addressed on-disk cache for LLM responses.
+Responses are keyed by a hash of the model source, model name, prompt and generation parameters,
+so any change to a prompt or model configuration results in a new entry rather than stale output.
+'''
+
+def response_cache_key(source, model_name, prompt, generation_params=None):
+    '''
+    computes the cache key of a generation request
+
+    source: source of the model (i.e, openai)
+    model_name: name of the model
+    prompt: prompt sent to the model
+    generation_params: dictionary of additional parameters that affect the generated response
+
+    returns the hex digest identifying the request
+    '''
+    payload = json.dumps([source, model_name, str(prompt), generation_params or {}], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    '''
+    SQLite backed cache of parsed LLM responses, stored as compressed JSON.
+    Entries are evicted least recently used first once max_entries or max_bytes is exceeded.
+    '''
+    def __init__(self, path='./cache/llm_responses.sqlite', max_entries=10000, max_bytes=512 * 1024 * 1024):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+        self.connection.commit()
+
+    def get(self, key):
+        '''
+        returns the cached response for key, or None if there is no entry
+        '''
+        with self.lock:
+            row = self.connection.execute('SELECT value FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.connection.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+            self.connection.commit()
+        return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+
+    def put(self, key, response):
+        '''
+        stores response under key and evicts the least recently used entries if the cache is over its bounds
+        '''
+        value = zlib.compress(json.dumps(response, ensure_ascii=False).encode('utf-8'))
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)',
+                (key, value, len(value), time.time())
+            )
+            self._evict()
+            self.connection.commit()
+
+    def _evict(self):
+        count, total_size = self.connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        if count <= self.max_entries and total_size <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in self.connection.execute('SELECT key, size FROM responses ORDER BY last_access ASC').fetchall():
+            if count <= self.max_entries and total_size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            count -= 1
+            total_size -= size
+        self.connection.executemany('DELETE FROM responses WHERE key = ?', evicted)
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute('DELETE FROM responses')
+            self.connection.commit()
+
+    def stats(self):
+        '''
+        returns the hit and miss counters along with the current size of the cache
+        '''
+        with self.lock:
+            count, total_size = self.connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses').fetchone()
+        return dict({'hits': self.hits, 'misses': self.misses, 'entries': count, 'bytes': total_size})
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
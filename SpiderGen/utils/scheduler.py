@@ -0,0 +1,257 @@
+import time
+import random
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+'''
+Rate-limit aware scheduling of LLM requests.
+Each provider has one scheduler per process, shared by every ModelManager and every thread,
+which enforces requests/min and tokens/min budgets and adapts its concurrency to 429 and overload responses.
+'''
+
+RATE_LIMIT_STATUS_CODES = [429, 503, 529]
+TRANSIENT_STATUS_CODES = [408, 409, 500, 502, 504]
+TRANSIENT_ERROR_NAMES = ['APIConnectionError', 'APITimeoutError', 'ConnectionError', 'TimeoutError', 'ReadTimeout', 'ConnectTimeout']
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    '''
+    Token bucket refilled continuously at capacity_per_minute / 60 tokens per second.
+    '''
+    def __init__(self, capacity_per_minute):
+        self.capacity = float(capacity_per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        '''
+        returns how long to wait before amount tokens are available, consuming them if they already are
+        '''
+        self._refill(now)
+        # requests larger than the bucket are let through once it is full, rather than waiting forever
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def adjust(self, amount, now):
+        '''
+        consumes amount more tokens, or gives them back if amount is negative, once the actual size of a request is known
+        '''
+        self._refill(now)
+        # the tokens can go below zero, so that requests which used more than they reserved delay the next ones
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+def classify_error(error):
+    '''
+    returns 'rate_limit' for 429 and overload errors, 'transient' for errors worth retrying, and None otherwise
+    '''
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status in RATE_LIMIT_STATUS_CODES or type(error).__name__ in ['RateLimitError', 'OverloadedError']:
+        return 'rate_limit'
+    if status in TRANSIENT_STATUS_CODES or type(error).__name__ in TRANSIENT_ERROR_NAMES:
+        return 'transient'
+    if status is None and isinstance(error, (ConnectionError, TimeoutError)):
+        return 'transient'
+    return None
+
+def retry_after(error):
+    '''
+    returns the delay in seconds requested by the retry-after headers of an error response, if any
+    '''
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    value = headers.get('retry-after-ms')
+    if value is not None:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def estimate_tokens(prompt, max_output_tokens=0):
+    '''
+    estimates the tokens used by a request, at roughly four characters per token
+    '''
+    return len(str(prompt)) // 4 + max_output_tokens
+
+def usage_tokens(usage):
+    '''
+    returns the input and output tokens counted against the tokens/min limit from a usage dictionary, or None if there is none
+    '''
+    if not usage or 'input_tokens' not in usage:
+        return None
+    return usage['input_tokens'] + usage.get('output_tokens', 0)
+
+class ProviderScheduler:
+    '''
+    Schedules the requests of one provider under its requests/min and tokens/min limits.
+    Concurrency is adapted with additive increase on success and multiplicative decrease on rate limits,
+    retry-after headers pause every request to the provider, and transient errors are retried with exponential jittered backoff.
+    '''
+    def __init__(self, provider, requests_per_minute=None, tokens_per_minute=None, max_concurrency=16, min_concurrency=1,
+                 max_retries=6, base_delay=1.0, max_delay=60.0, expected_output_tokens=1024):
+        self.provider = provider
+        # output tokens reserved per request, a running average of the output tokens that responses report
+        self.expected_output_tokens = float(expected_output_tokens)
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency_limit = float(max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+        self.stats = dict({'requests': 0, 'rate_limited': 0, 'retries': 0, 'queue_time': 0.0})
+
+    def acquire(self, estimated_tokens=0):
+        '''
+        blocks until a request of estimated_tokens can be sent, and returns the time spent waiting
+        '''
+        started = time.monotonic()
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    self.condition.wait(self.paused_until - now)
+                    continue
+                if self.in_flight >= max(self.min_concurrency, int(self.concurrency_limit)):
+                    self.condition.wait()
+                    continue
+                wait = 0.0
+                if self.request_bucket is not None:
+                    wait = self.request_bucket.wait_time(1, now)
+                if wait == 0.0 and self.token_bucket is not None:
+                    wait = self.token_bucket.wait_time(estimated_tokens, now)
+                    if wait > 0.0 and self.request_bucket is not None:
+                        # give back the request that was taken while the tokens are not available yet
+                        self.request_bucket.tokens = min(self.request_bucket.capacity, self.request_bucket.tokens + 1)
+                if wait > 0.0:
+                    self.condition.wait(wait)
+                    continue
+                self.in_flight += 1
+                queue_time = time.monotonic() - started
+                self.stats['requests'] += 1
+                self.stats['queue_time'] += queue_time
+                return queue_time
+
+    def release(self, succeeded):
+        with self.condition:
+            self.in_flight -= 1
+            if succeeded:
+                self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1.0 / max(self.concurrency_limit, 1.0))
+            self.condition.notify_all()
+
+    def rate_limited(self, delay):
+        with self.condition:
+            self.stats['rate_limited'] += 1
+            self.concurrency_limit = max(float(self.min_concurrency), self.concurrency_limit / 2.0)
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            self.condition.notify_all()
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def reserved_tokens(self, estimated_tokens, max_output_tokens=None):
+        '''
+        returns the tokens reserved for a request of estimated_tokens input tokens, with the expected output tokens added
+        '''
+        output_tokens = self.expected_output_tokens if max_output_tokens is None else min(self.expected_output_tokens, max_output_tokens)
+        return estimated_tokens + int(output_tokens)
+
+    def settle(self, reserved, usage):
+        '''
+        corrects the tokens/min budget by the difference between the tokens reserved for a request and those it used
+
+        usage: input and output tokens reported for the request, or None if they are unknown
+        '''
+        used = usage_tokens(usage)
+        if used is None:
+            return
+        with self.condition:
+            if self.token_bucket is not None:
+                # the bucket took at most its capacity for the reservation
+                self.token_bucket.adjust(used - min(reserved, self.token_bucket.capacity), time.monotonic())
+            self.expected_output_tokens += 0.2 * (usage.get('output_tokens', 0) - self.expected_output_tokens)
+            self.condition.notify_all()
+
+    def call(self, request, estimated_tokens=0, call_info=None, usage=None, max_output_tokens=None):
+        '''
+        sends request() under the limits of the provider, retrying rate limits and transient errors
+
+        request: function which sends the request and returns its result
+        estimated_tokens: estimated input tokens of the request, the expected output tokens are reserved on top of them
+        call_info: optional dictionary, in which the queue time and number of retries of the call are accumulated
+        usage: optional function returning the usage reported in the result, with which the reservation is settled
+        max_output_tokens: largest number of output tokens of the request, if it is limited
+        '''
+        reserved = self.reserved_tokens(estimated_tokens, max_output_tokens)
+        for attempt in range(self.max_retries + 1):
+            queue_time = self.acquire(reserved)
+            if call_info is not None:
+                call_info['queue_time'] = call_info.get('queue_time', 0.0) + queue_time
+            try:
+                result = request()
+            except Exception as error:
+                self.release(False)
+                kind = classify_error(error)
+                if kind is None or attempt == self.max_retries:
+                    raise
+                delay = retry_after(error)
+                if delay is None:
+                    delay = self.backoff(attempt)
+                if kind == 'rate_limit':
+                    # the pause applies to every caller of the provider, not only this one
+                    self.rate_limited(delay)
+                else:
+                    time.sleep(delay)
+                with self.condition:
+                    self.stats['retries'] += 1
+                if call_info is not None:
+                    call_info['retries'] = call_info.get('retries', 0) + 1
+                logger.warning(f'{self.provider} request failed with {type(error).__name__}, retrying in {delay:.1f}s')
+                continue
+            self.release(True)
+            if usage is not None:
+                self.settle(reserved, usage(result))
+            return result
+
+_schedulers = dict({})
+_schedulers_lock = threading.Lock()
+
+def get_scheduler(provider):
+    '''
+    returns the scheduler shared by every caller of provider in this process, configured from rate_limits in config.py
+    '''
+    with _schedulers_lock:
+        if provider not in _schedulers:
+            try:
+                import config
+                limits = getattr(config, 'rate_limits', dict({})).get(provider, dict({}))
+            except ImportError:
+                limits = dict({})
+            _schedulers[provider] = ProviderScheduler(provider, **limits)
+        return _schedulers[provider]
@@ -0,0 +1,125 @@
+import re
+import time
+'''
+Incremental validation of streamed LLM responses.
+The validator follows the bracket and string structure of the JSON object as it arrives,
+so that a response which goes off the rails can be aborted before the rest of it is generated.
+'''
+
+# characters of prose (i.e, "Here is the JSON:") allowed before the object, which the lenient parser skips
+MAX_PREAMBLE_CHARS = 300
+# an opening code fence, or any prefix of one, is allowed before the object
+FENCE_PREFIX = re.compile(r'\s*(`{1,3}[A-Za-z]*\s*)?')
+STRING_SPECIAL = dict({
+    '"': re.compile(r'["\\]'),
+    "'": re.compile(r"['\\]"),
+    '”': re.compile(r'[”\\]'),
+    '’': re.compile(r'[’\\]'),
+})
+STRING_CLOSE = dict({'"': '"', "'": "'", '“': '”', '‘': '’'})
+CLOSING_BRACKETS = dict({'}': '{', ']': '['})
+
+class IncrementalJSONValidator:
+    '''
+    Checks the structure of a JSON object as it is streamed, one chunk at a time.
+    state is 'ok' while the object is still valid but incomplete, 'complete' once the outermost object is closed,
+    and 'invalid' once the stream can no longer produce a valid object, with the reason in error.
+    '''
+    def __init__(self, max_preamble_chars=MAX_PREAMBLE_CHARS):
+        self.max_preamble_chars = max_preamble_chars
+        self.preamble = ''
+        self.stack = []
+        self.string_close = None
+        self.escaped = False
+        self.position = 0
+        self.state = 'ok'
+        self.error = None
+
+    def fail(self, reason):
+        self.state = 'invalid'
+        self.error = f'{reason} at char {self.position}'
+        return self.state
+
+    def feed(self, chunk):
+        '''
+        validates the next chunk of the response and returns the resulting state
+        '''
+        i = 0
+        n = len(chunk)
+        while i < n and self.state == 'ok':
+            if not self.stack:
+                # before the object: only whitespace, a code fence, and at most max_preamble_chars of prose
+                start = chunk.find('{', i)
+                end = n if start == -1 else start
+                self.preamble += chunk[i:end]
+                self.position += end - i
+                i = end
+                if FENCE_PREFIX.fullmatch(self.preamble) is None and len(self.preamble.strip()) > self.max_preamble_chars:
+                    return self.fail('prose before the JSON object')
+                if start != -1:
+                    self.stack.append('{')
+                    self.position += 1
+                    i += 1
+                continue
+            if self.string_close is not None:
+                if self.escaped:
+                    self.escaped = False
+                    self.position += 1
+                    i += 1
+                    continue
+                match = STRING_SPECIAL[self.string_close].search(chunk, i)
+                if match is None:
+                    self.position += n - i
+                    i = n
+                    continue
+                self.position += match.start() - i
+                i = match.start()
+                if chunk[i] == '\\':
+                    self.escaped = True
+                else:
+                    self.string_close = None
+                self.position += 1
+                i += 1
+                continue
+            char = chunk[i]
+            if char in STRING_CLOSE:
+                self.string_close = STRING_CLOSE[char]
+            elif char == '{' or char == '[':
+                self.stack.append(char)
+            elif char in CLOSING_BRACKETS:
+                if self.stack[-1] != CLOSING_BRACKETS[char]:
+                    return self.fail(f"mismatched '{char}'")
+                self.stack.pop()
+                if not self.stack:
+                    self.state = 'complete'
+            self.position += 1
+            i += 1
+        return self.state
+
+def consume_json_stream(text_chunks, started, max_preamble_chars=MAX_PREAMBLE_CHARS):
+    '''
+    reads streamed text until the JSON object is complete, the stream ends, or the validator aborts it
+
+    text_chunks: iterator over the text of the streamed response
+    started: time.perf_counter() value at which the request was issued
+    max_preamble_chars: characters of prose, besides a code fence, allowed before the object before the stream is aborted
+
+    returns the text read, the validator, and the timings of the attempt
+    '''
+    validator = IncrementalJSONValidator(max_preamble_chars)
+    chunks = []
+    attempt_stats = dict({'time_to_first_byte': None})
+    for text in text_chunks:
+        if attempt_stats['time_to_first_byte'] is None:
+            attempt_stats['time_to_first_byte'] = time.perf_counter() - started
+        chunks.append(text)
+        if validator.feed(text) != 'ok':
+            break
+    elapsed = time.perf_counter() - started
+    if validator.state == 'invalid':
+        attempt_stats['time_to_abort'] = elapsed
+        attempt_stats['abort_reason'] = validator.error
+    else:
+        attempt_stats['time_to_complete'] = elapsed
+    attempt_stats['chars'] = sum(len(text) for text in chunks)
+    return ''.join(chunks), validator, attempt_stats
@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import numpy as np
+from utils.embedding_cache import EmbeddingCache
+'''
+Semantic cache of sample product templates.
+Templates are keyed by an embedding of the name and description of their product, so that a product which is nearly
+identical to one templated before (i.e, "LED bulb" in two lighting categories) reuses its template instead of calling the LLM.
+Entries are scoped by the template prompt and LLM configuration, so a template is never reused across prompts or models.
+'''
+
+def template_cache_text(product, product_description):
+    '''
+    returns the text embedded to compare products
+    '''
+    return f'{product}: {product_description}'
+
+class TemplateCache:
+    '''
+    SQLite store of templates with the embeddings of their products in a memory-mapped EmbeddingCache.
+    lookup returns the template of the most similar product of the same scope whose cosine similarity is at least threshold.
+    '''
+    def __init__(self, path, transformer_model, model_name, threshold=0.95):
+        '''
+        path: folder of the cache
+        transformer_model: embedding model with a sentence transformers style encode method
+        model_name: identifier of the embedding model, the embeddings of each model are stored separately
+        threshold: lowest cosine similarity between two products for one to reuse the template of the other
+        '''
+        self.transformer_model = transformer_model
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        # embeddings of the stored products only
+        self.embeddings = EmbeddingCache(os.path.join(path, 'embeddings'), model_name)
+        self.connection = sqlite3.connect(os.path.join(path, 'templates.sqlite'), check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS templates ('
+            'scope TEXT NOT NULL, text TEXT NOT NULL, product TEXT NOT NULL, description TEXT, category TEXT, '
+            'template TEXT NOT NULL, created REAL NOT NULL, reuses INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (scope, text))'
+        )
+        self.connection.commit()
+
+    def lookup(self, product, product_description, scope):
+        '''
+        finds the template of the product most similar to product
+
+        scope: identifier of the template prompt and LLM configuration the template has to be generated with
+
+        returns a dictionary with the 'template', and the 'product', 'description', 'category' and 'similarity' of the
+        product it was generated for, or None if no stored product is similar enough
+        '''
+        # the query is embedded without the embedding cache, so products which miss do not grow it
+        encoded = np.asarray(self.transformer_model.encode(np.array([template_cache_text(product, product_description)]), normalize_embeddings=True))[0]
+        with self.lock:
+            texts = [row[0] for row in self.connection.execute('SELECT text FROM templates WHERE scope = ?', (scope,))]
+        match = None
+        if len(texts) > 0:
+            # only the products stored in the scope are ranked, their embeddings were cached when they were stored
+            similarities = self.embeddings.encode(self.transformer_model, texts) @ encoded
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                match = (texts[best], float(similarities[best]))
+        with self.lock:
+            if match is None:
+                self.misses += 1
+                return None
+            text, similarity = match
+            matched_product, description, category, template = self.connection.execute(
+                'SELECT product, description, category, template FROM templates WHERE scope = ? AND text = ?', (scope, text)).fetchone()
+            self.hits += 1
+            self.connection.execute('UPDATE templates SET reuses = reuses + 1 WHERE scope = ? AND text = ?', (scope, text))
+            self.connection.commit()
+        return dict({'template': json.loads(template), 'product': matched_product, 'description': description,
+                     'category': category, 'similarity': similarity})
+
+    def put(self, product, product_description, template, scope, product_category_name=None):
+        '''
+        stores the template generated for a product
+        '''
+        text = template_cache_text(product, product_description)
+        self.embeddings.encode(self.transformer_model, [text])
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO templates (scope, text, product, description, category, template, created) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (scope, text, product, product_description, product_category_name, json.dumps(template, ensure_ascii=False), time.time()))
+            self.connection.commit()
+
+    def stats(self):
+        '''
+        returns the hit and miss counters, the hit rate and the number of stored templates
+        '''
+        with self.lock:
+            entries = self.connection.execute('SELECT COUNT(*) FROM templates').fetchone()[0]
+        lookups = self.hits + self.misses
+        return dict({'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else None, 'entries': entries})
+
+    def close(self):
+        with self.lock:
+            self.connection.close()